@@ -0,0 +1,241 @@
+"""An asyncio flavour of machination.webclient.WebClient.
+
+AsyncWebClient makes the same calls as WebClient, with the same
+authentication methods, but call() and memo() are coroutines, so that
+many independent calls can be in flight at once:
+
+  async with AsyncWebClient(url, 'public', 'person') as wc:
+      types = await asyncio.gather(
+          *[wc.memo('TypeInfo', t) for t in type_ids]
+          )
+
+At most max_concurrent calls are sent to the hierarchy at once; the
+rest wait their turn. Requests go over persistent HTTP/1.1
+connections made with asyncio streams. cosign needs urllib's cookie
+and redirect handling, so cosign calls (and calls through a proxy)
+are made by a WebClient in a thread instead.
+"""
+import asyncio
+import http.client as http_client
+import io
+import urllib.error as urllib_error
+import urllib.parse as urllib_parse
+from lxml import etree
+from machination import context
+from machination.webclient import WebClient, BATCH_HEADER, client_ssl_context
+
+l = context.logger
+
+
+class AsyncWebClient(object):
+    """Machination WebClient for asyncio"""
+
+    def __init__(self, hierarchy_url, authen_type, obj_type,
+                 credentials=None, service_id=None, max_concurrent=8):
+        '''Create a new AsyncWebClient
+
+        Arguments are as for WebClient, plus:
+
+        max_concurrent (=8): The most calls to have in flight at once.
+        '''
+        # Authentication is set up exactly as a WebClient does it.
+        self.wc = WebClient(hierarchy_url, authen_type, obj_type,
+                            credentials=credentials, service_id=service_id)
+        self.url = self.wc.url
+        self.encoding = self.wc.encoding
+        self.max_concurrent = max_concurrent
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        # Idle [reader, writer] pairs
+        self.idle = []
+        # {serialised call: task} for memo() calls in flight
+        self.memo_tasks = {}
+
+    from_service_elt = classmethod(WebClient.from_service_elt.__func__)
+    from_service_id = classmethod(WebClient.from_service_id.__func__)
+
+    async def call(self, name, *args):
+        '''Invoke method name in hierarchy with arguments *args.
+        '''
+        l.lmsg("calling " + name + " on " + self.url)
+        call_elt = self.wc.call_elt(name, *args)
+        l.dmsg(etree.tostring(call_elt, pretty_print=True))
+        async with self.semaphore:
+            s = (await self.post(
+                    etree.tostring(call_elt, encoding=self.encoding),
+                    retry=name in self.wc.read_only_calls
+                    )).decode(self.encoding)
+        return self.wc.answer(etree.fromstring(s))
+
+    async def call_many(self, calls):
+        '''Invoke several methods in hierarchy at once.
+
+        calls: a list of (name, args) pairs.
+
+        Returns a list of the results, in order. The calls are made
+        concurrently (up to max_concurrent at a time) rather than
+        batched into one request as WebClient.call_many() does.
+        '''
+        return await asyncio.gather(
+            *[self.call(name, *args) for name, args in calls]
+            )
+
+    async def memo(self, name, *args):
+        '''Invoke method name in hierarchy and memoise results.
+
+        Results are kept in the same sort of ResponseCache as
+        WebClient.memo() uses (self.wc.memo_cache). Callers asking for
+        the same thing while it is being fetched wait for that one
+        call. Failed calls are not remembered.
+        '''
+        key = etree.tostring(self.wc.call_elt(name, *args))
+        found, result = self.wc.memo_cache.lookup(name, key)
+        if found:
+            return result
+        task = self.memo_tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.call(name, *args))
+            self.memo_tasks[key] = task
+        try:
+            result = await asyncio.shield(task)
+        finally:
+            if task.done() and self.memo_tasks.get(key) is task:
+                del self.memo_tasks[key]
+                if not task.cancelled() and task.exception() is None:
+                    self.wc.memo_cache.store(name, key, result)
+        return result
+
+    async def help(self):
+        return await self.call("Help")
+
+    async def post(self, data, retry=False):
+        '''POST data to self.url and return the body of the response.
+
+        Raises urllib.error.HTTPError for anything but a 200 response.
+        retry is as for WebClient.post().
+        '''
+        if not self.wc.use_pool:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.wc.post, data)
+        parts = urllib_parse.urlsplit(self.url)
+        request = (
+            'POST {} HTTP/1.1\r\n'
+            'Host: {}\r\n'
+            'Content-Type: application/x-www-form-urlencoded;charset={}\r\n'
+            'Content-Length: {}\r\n'
+            '\r\n'.format(parts.path or '/', parts.netloc, self.encoding,
+                          len(data))
+            ).encode('latin-1') + data
+        while True:
+            conn = self.idle.pop() if self.idle else None
+            reused = conn is not None
+            if conn is None:
+                conn = await self.connect()
+            reader, writer = conn
+            answered = False
+            try:
+                writer.write(request)
+                await writer.drain()
+                status_line = await reader.readline()
+                if not status_line:
+                    raise http_client.RemoteDisconnected(
+                        'connection closed by server')
+                answered = True
+                status, reason, msg, body, keep = await self.read_response(
+                    reader, status_line
+                    )
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                # The server may close an idle connection whenever it
+                # likes. If it did so before answering, send again on
+                # another connection, but only if that is safe.
+                if retry and reused and not answered:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keep and len(self.idle) < self.max_concurrent:
+                self.idle.append(conn)
+            else:
+                writer.close()
+            if status != 200:
+                raise urllib_error.HTTPError(self.url, status, reason, msg,
+                                             io.BytesIO(body))
+            self.wc.batch_supported = msg.get(BATCH_HEADER) is not None
+            return body
+
+    async def connect(self):
+        '''Return [reader, writer] for a new connection to the hierarchy.
+        '''
+        parts = urllib_parse.urlsplit(self.url)
+        if parts.scheme == 'https':
+            reader, writer = await asyncio.open_connection(
+                parts.hostname, parts.port or 443,
+                ssl=client_ssl_context(*self.wc.ssl_files),
+                server_hostname=parts.hostname
+                )
+        else:
+            reader, writer = await asyncio.open_connection(
+                parts.hostname, parts.port or 80
+                )
+        return [reader, writer]
+
+    async def read_response(self, reader, status_line):
+        '''Read the rest of an HTTP/1.1 response from reader.
+
+        status_line is the response's first line, already read.
+
+        Returns (status, reason, headers, body, keep_alive).
+        '''
+        version, status, reason = (
+            status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) +
+            ['']
+            )[:3]
+        head = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise asyncio.IncompleteReadError(b''.join(head), None)
+            head.append(line)
+            if line in (b'\r\n', b'\n'):
+                break
+        msg = http_client.parse_headers(io.BytesIO(b''.join(head)))
+        keep = (version == 'HTTP/1.1' and
+                msg.get('Connection', '').lower() != 'close')
+        if msg.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # Skip any trailers.
+                    while (await reader.readline()) not in (b'\r\n', b'\n',
+                                                            b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif msg.get('Content-Length') is not None:
+            body = await reader.readexactly(int(msg.get('Content-Length')))
+        else:
+            body = await reader.read()
+            keep = False
+        return int(status), reason, msg, body, keep
+
+    async def close(self):
+        '''Close all idle connections.
+        '''
+        idle, self.idle = self.idle, []
+        for reader, writer in idle:
+            writer.close()
+        for reader, writer in idle:
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.close()
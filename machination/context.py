@@ -21,6 +21,7 @@ import os
 import io
 from lxml import etree
 from machination.logger import Logger
+from machination import statusfile
 import errno
 
 desired_status = None
@@ -159,11 +160,23 @@ def get_worker_elt(name, status_elt = None):
         '/status/worker[@id="{}"]'.format(name)
         )[0]
 
+def _file_stamp(fname):
+    """Return something which changes when fname does, or None."""
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
 desired_status_file = os.path.join(status_dir(), "desired-status.xml")
+desired_status_stamp = _file_stamp(desired_status_file)
 # Try loading any existing desired_status to find out how we
 # should ask for a new one (:-))
 try:
-    desired_status = etree.parse(desired_status_file)
+    desired_status = statusfile.StatusStore(
+        desired_status_file,
+        generations=statusfile.DEFAULT_GENERATIONS
+        ).load()
 except IOError:
     # Uh oh - didn't work. Could be corrupt or perhaps this is
     # the first run.
@@ -173,7 +186,7 @@ except IOError:
     else:
         # No desired_status: create one that update won't use,
         # but other progs will.
-        desired_status = etree.parse(
+        desired_status = statusfile.parse(
             io.StringIO(
                 '''
 <status autoconstructed="1">
@@ -200,6 +213,28 @@ except IOError:
             welt.append(ssl_elt)
 
 machination_worker_elt = get_worker_elt('__machination__')
+
+def reload_desired_status():
+    """Reload desired_status if desired-status.xml has changed.
+
+    desired-status.xml is otherwise only read when this module is
+    first imported, which is too seldom for a long running process
+    (see machination.service.resident). Logging is not reconfigured.
+
+    Returns True if desired_status was reloaded.
+    """
+    global desired_status, desired_status_stamp, machination_worker_elt
+    stamp = _file_stamp(desired_status_file)
+    if stamp is None or stamp == desired_status_stamp:
+        return False
+    desired_status = statusfile.StatusStore(
+        desired_status_file,
+        generations=statusfile.DEFAULT_GENERATIONS
+        ).load()
+    desired_status_stamp = stamp
+    machination_worker_elt = get_worker_elt('__machination__')
+    return True
+
 logging_elts = machination_worker_elt.xpath(
     'logging'
     )
@@ -602,19 +602,20 @@ class HModel(QStandardItemModel):
         type_id = self.get_value(index, 'type_id')
         if type_id == 'machination:hc':
             return_list = []
-            attachments = wc.call(
-                'ListAttachments', self.get_path(index),
-                {'get_members':0}
-                )
-            for newatt in attachments:
+            with wc.batch() as b:
+                attachments = b.call(
+                    'ListAttachments', self.get_path(index),
+                    {'get_members':0}
+                    )
+                contents = b.call(
+                    'ListContents', self.get_path(index)
+                    )
+            for newatt in attachments.result:
                 newatt['__branch__'] = 'attachments'
-            return_list.extend(attachments)
-            contents = wc.call(
-                'ListContents', self.get_path(index)
-                )
-            for newobj in contents:
+            return_list.extend(attachments.result)
+            for newobj in contents.result:
                 newobj['__branch__'] = 'contents'
-            return_list.extend(contents)
+            return_list.extend(contents.result)
             return return_list
 
         # Can't look up external set members
@@ -631,15 +632,21 @@ class HModel(QStandardItemModel):
         # Fetch set_members
         if wc.memo('TypeInfo', type_id).get('name') == 'set':
             members = wc.call('SetMembers', self.get_spec(index))
-            objs = []
-            for member in members:
-                if member[0] == '1':
-                    # internal member
-                    obj = wc.call(
+            # Fetch all the internal members in one go
+            with wc.batch() as b:
+                fetches = [
+                    b.call(
                         'FetchObject', '{}:{}'.format(
                             wc.memo('TypeInfo', member[1]).get('name'), member[2]
                             )
-                        )
+                        ) if member[0] == '1' else None
+                    for member in members
+                    ]
+            objs = []
+            for member, fetch in zip(members, fetches):
+                if member[0] == '1':
+                    # internal member
+                    obj = fetch.result
 #                    print("found member {}".format(obj))
                     obj['__branch__'] = 'set_members'
                     obj['obj_id'] = obj['id']
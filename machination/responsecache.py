@@ -0,0 +1,182 @@
+"""Memoise the results of hierarchy calls (see WebClient.memo()).
+
+A ResponseCache holds call results for a time which depends on the
+call (TypeInfo answers hardly ever change, most others might at any
+moment) and keeps no more than max_entries of them, throwing away the
+least recently used first.
+
+It may also keep results on disk, so that they survive from one
+process to the next. Only calls explicitly marked for the disk store
+go there: the default is just the type information calls, which are
+the same for everyone and which the GUI needs before it can show
+anything.
+
+Results are stored in Machination transport XML (see xmldata), each
+in its own file named after a hash of the call, and written via a
+rename so that processes sharing the store never see half an entry.
+"""
+from lxml import etree
+from machination.xmldata import from_xml, to_xml
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_MAX_ENTRIES = 1024
+# Seconds to keep results of calls not mentioned in DEFAULT_CALLS.
+DEFAULT_TTL = 300
+# {call name: [ttl, keep on disk?]}
+DEFAULT_CALLS = {
+    'TypeInfo': [3600, True],
+    'AllTypesInfo': [3600, True],
+    'TypeId': [3600, True],
+    }
+
+
+class ResponseCache(object):
+    """A bounded, expiring store of call results."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL,
+                 calls=None, store_dir=None):
+        """ResponseCache constructor
+
+        Args:
+          max_entries(=DEFAULT_MAX_ENTRIES): most results to hold in
+            memory.
+          ttl(=DEFAULT_TTL): seconds to keep results for.
+          calls(=DEFAULT_CALLS): {call name: [ttl, disk]} for calls
+            whose results should be kept for some other time and
+            whether they should go in the disk store.
+          store_dir(=None): directory for the disk store. No disk
+            store if None.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.calls = dict(DEFAULT_CALLS if calls is None else calls)
+        self.store_dir = store_dir
+        # {key: [expiry time, result]}, least recently used first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evictions': 0,
+            }
+
+    def call_ttl(self, name):
+        """Return the number of seconds to keep results of name for."""
+        return self.calls.get(name, [self.ttl])[0]
+
+    def on_disk(self, name):
+        """Return True if results of name go in the disk store."""
+        return (self.store_dir is not None and
+                self.calls.get(name, [None, False])[1])
+
+    def lookup(self, name, key):
+        """Return [True, result] for key if it is held, else [False, None].
+
+        key is the serialised <r> element for the call (which name is
+        the call name of).
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return [True, entry[1]]
+                del self.entries[key]
+                self.stats['expired'] += 1
+        if self.on_disk(name):
+            entry = self.disk_load(key, now)
+            if entry is not None:
+                with self.lock:
+                    self.stats['disk_hits'] += 1
+                    self._hold(key, entry)
+                return [True, entry[1]]
+        with self.lock:
+            self.stats['misses'] += 1
+        return [False, None]
+
+    def store(self, name, key, result):
+        """Remember result as the answer to the call in key."""
+        entry = [time.time() + self.call_ttl(name), result]
+        with self.lock:
+            self._hold(key, entry)
+        if self.on_disk(name):
+            self.disk_store(key, entry)
+
+    def get(self, name, key, func):
+        """Return the result for key, calling func() to get it if need be."""
+        found, result = self.lookup(name, key)
+        if not found:
+            result = func()
+            self.store(name, key, result)
+        return result
+
+    def _hold(self, key, entry):
+        """Put entry in memory, evicting if full. Call with self.lock."""
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def clear(self):
+        """Forget everything, on disk too."""
+        with self.lock:
+            self.entries.clear()
+        if self.store_dir is not None and os.path.isdir(self.store_dir):
+            for fname in os.listdir(self.store_dir):
+                if fname.endswith('.xml'):
+                    try:
+                        os.remove(os.path.join(self.store_dir, fname))
+                    except OSError:
+                        pass
+
+    def disk_name(self, key):
+        """Return the disk store file name for key."""
+        return os.path.join(self.store_dir,
+                            hashlib.sha1(key).hexdigest() + '.xml')
+
+    def disk_load(self, key, now):
+        """Return [expiry, result] for key from the disk store, or None."""
+        fname = self.disk_name(key)
+        try:
+            elt = etree.parse(fname).getroot()
+            expires = float(elt.get('expires'))
+            if etree.tostring(elt[0]) != key:
+                # sha1 collision or a different call
+                return None
+            if expires <= now:
+                os.remove(fname)
+                return None
+            return [expires, from_xml(elt[1])]
+        except (OSError, etree.XMLSyntaxError, IndexError, TypeError,
+                ValueError):
+            return None
+
+    def disk_store(self, key, entry):
+        """Write entry for key to the disk store.
+
+        The disk store is only a help: failure to write to it is
+        ignored.
+        """
+        elt = etree.Element('memo', expires=repr(entry[0]))
+        elt.append(etree.fromstring(key))
+        elt.append(to_xml(entry[1]))
+        tmpname = None
+        try:
+            os.makedirs(self.store_dir, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=self.store_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(etree.tostring(elt))
+            os.replace(tmpname, self.disk_name(key))
+        except OSError:
+            if tmpname is not None and os.path.exists(tmpname):
+                os.remove(tmpname)
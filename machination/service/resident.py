@@ -0,0 +1,195 @@
+"""Run Machination update cycles in a resident process.
+
+The win32 service starts a new python process for each update. This
+daemon (meant for Linux, but not tied to it) listens for 'kicks' on
+the daemon address and port configured in the __machination__ worker:
+
+  <daemon address="" port="1313" sleeptime="10000"/>
+
+and runs each update cycle in process with one long lived Update
+object, so worker objects, parsed worker descriptions and cached
+worker statuses carry over from one cycle to the next. Any connection
+to the port is a kick. After a kick no more are accepted for
+sleeptime milliseconds.
+
+Before each cycle desired-status.xml is reloaded if it has changed,
+and any worker whose files have changed is reloaded and made afresh.
+If the rest of the machination package has changed (a self update,
+say) the daemon restarts itself instead.
+"""
+
+from machination import context
+from machination import utils
+from machination.update import Update
+import importlib
+import os
+import socket
+import select
+import sys
+import time
+import traceback
+
+l = context.logger
+
+# The machination package directory
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def tree_stamp(top, skip=()):
+    """Return something which changes when any .py file under top does.
+
+    Directories in skip (full paths) are not looked in.
+    """
+    stamp = []
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames[:] = sorted(
+            d for d in dirnames
+            if d != '__pycache__' and os.path.join(dirpath, d) not in skip
+            )
+        for f in sorted(filenames):
+            if f.endswith('.py'):
+                st = os.stat(os.path.join(dirpath, f))
+                stamp.append((f, st.st_mtime_ns, st.st_size))
+    return stamp
+
+
+class ResidentDaemon(object):
+    """Listen for kicks and run update cycles in this process."""
+
+    def __init__(self, update=None, address=None, port=None,
+                 sleeptime=None):
+        """ResidentDaemon constructor
+
+        Args:
+          update(=None): the Update object to run cycles with. A new
+            one is made if not given.
+          address, port, sleeptime(=None): override the daemon
+            element of the __machination__ worker. port 0 picks a
+            free port (see self.port once listen() has been called).
+        """
+        delts = context.machination_worker_elt.xpath('daemon')
+        delt = delts[0] if delts else None
+
+        def config(value, att, default):
+            if value is not None:
+                return value
+            if delt is not None and delt.get(att) is not None:
+                return delt.get(att)
+            return default
+        self.address = config(address, 'address', '')
+        self.port = int(config(port, 'port', 1313))
+        self.sleeptime = int(config(sleeptime, 'sleeptime', 10000))
+
+        self.update = update or Update()
+        self.sock = None
+        self.core_stamp = self.machination_stamp()
+        # {worker name: tree_stamp() of its package when loaded}
+        self.worker_stamps = {}
+        # Stamp workers as they are imported: a stamp taken after the
+        # cycle would miss changes made while it ran.
+        self.update.before_import = self.stamp_worker
+
+    def listen(self):
+        """Open the kick socket."""
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.address, self.port))
+        self.port = self.sock.getsockname()[1]
+        self.sock.listen(5)
+
+    def close(self):
+        """Close the kick socket."""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def wait_for_kick(self, timeout=None):
+        """Wait up to timeout seconds for a kick. True if there was one."""
+        readable, w, x = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return False
+        conn, addr = self.sock.accept()
+        conn.close()
+        l.lmsg('Kicked by {}'.format(addr[0]))
+        return True
+
+    def serve(self, cycles=None):
+        """Run an update cycle for each kick, forever or cycles times."""
+        self.listen()
+        l.lmsg('Waiting for kicks on port {}'.format(self.port))
+        try:
+            while cycles is None or cycles > 0:
+                if not self.wait_for_kick():
+                    continue
+                kicked = time.monotonic()
+                # Like the win32 service, stop listening while we work
+                # and for sleeptime after a kick.
+                self.close()
+                self.run_cycle()
+                if cycles is not None:
+                    cycles -= 1
+                wait = self.sleeptime / 1000 - (time.monotonic() - kicked)
+                if wait > 0 and (cycles is None or cycles > 0):
+                    time.sleep(wait)
+                self.listen()
+        finally:
+            self.close()
+
+    def run_cycle(self):
+        """Reload whatever has changed, then do one update cycle."""
+        self.reload_changed()
+        self.update.new_cycle()
+        start = time.monotonic()
+        try:
+            self.update.do_update()
+        except Exception as e:
+            l.emsg('Update cycle failed: {}\n{}'.format(
+                    e, traceback.format_exc()))
+        else:
+            l.lmsg('Update cycle took {:.2f}s'.format(
+                    time.monotonic() - start))
+
+    def reload_changed(self):
+        """Bring desired status and worker code up to date.
+
+        Restarts the whole process if machination itself has changed:
+        there is no safe way to reload it in place.
+        """
+        if self.machination_stamp() != self.core_stamp:
+            l.lmsg('Machination has changed, restarting')
+            self.close()
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        if context.reload_desired_status():
+            l.lmsg('Reloaded {}'.format(context.desired_status_file))
+        for name, stamp in list(self.worker_stamps.items()):
+            if self.worker_stamp(name) == stamp:
+                continue
+            l.lmsg('Worker {} has changed, reloading it'.format(name))
+            module = sys.modules.get('machination.workers.' + name)
+            if module is not None:
+                try:
+                    importlib.reload(module)
+                except Exception as e:
+                    l.emsg('Failed to reload worker {}: {}'.format(name, e))
+            self.update.forget_worker(name)
+            del self.worker_stamps[name]
+
+    def machination_stamp(self):
+        """Return tree_stamp() for machination apart from workers."""
+        return tree_stamp(package_dir, skip=(utils.worker_dir(),))
+
+    def worker_stamp(self, name):
+        """Return tree_stamp() for worker name's files."""
+        return tree_stamp(utils.worker_dir(name))
+
+    def stamp_worker(self, name):
+        """Remember worker name's files as they are about to be loaded."""
+        self.worker_stamps[name] = self.worker_stamp(name)
+
+
+def main(args):
+    ResidentDaemon().serve()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
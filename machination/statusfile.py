@@ -0,0 +1,194 @@
+"""Read and write Machination status files.
+
+Status files (previous-status.xml, desired-status.xml and friends) are
+always wanted in mc14n canonical form: no comments, no tails and no
+text in elements which have children. Most of the nodes in a pretty
+printed status file are the ignorable white space that mc14n throws
+away, so parse() has libxml2 drop it while parsing rather than
+building python proxies for it only to delete it afterwards.
+
+Status files are written atomically (see write()), and StatusStore
+keeps a few previous generations of a status file to fall back on if
+the current one is lost.
+
+This module only depends on lxml so that it can be used from
+machination.context, which machination.xmltools itself imports.
+"""
+from lxml import etree
+import io
+import os
+import shutil
+import tempfile
+
+# Previous generations of each status file kept by default.
+DEFAULT_GENERATIONS = 2
+
+# Drops white space only text nodes in elements with element
+# children: mc14n would remove those anyway.
+_blank_parser = etree.XMLParser(remove_blank_text=True)
+# libxml2 also drops white space next to a CDATA section in a text
+# element, which mc14n keeps, so documents with CDATA are parsed
+# normally.
+_plain_parser = etree.XMLParser()
+
+
+def canonicalize(elt):
+    """Canonicalize elt in place and return it (see xmltools.mc14n())."""
+    if isinstance(elt, etree._ElementTree):
+        elt = elt.getroot()
+    if isinstance(elt, etree._Comment):
+        elt.getparent().remove(elt)
+        return elt
+    # One flat pass rather than a python call per node.
+    for e in elt.iter():
+        e.tail = None
+        # Any children (including comments) => not a text element.
+        if len(e):
+            e.text = None
+    for comment in list(elt.iter(etree.Comment)):
+        comment.getparent().remove(comment)
+    return elt
+
+
+def parse(source):
+    """Parse source and return a canonicalized ElementTree.
+
+    source is a file name or a file like object. Equivalent to
+    ``mc14n(etree.parse(source))``, but quicker.
+    """
+    base_url = None
+    if hasattr(source, 'read'):
+        data = source.read()
+    else:
+        base_url = source
+        with open(source, 'rb') as f:
+            data = f.read()
+    if isinstance(data, str):
+        parser = _plain_parser if '<![CDATA[' in data else _blank_parser
+        data = io.StringIO(data)
+    else:
+        parser = _plain_parser if b'<![CDATA[' in data else _blank_parser
+        data = io.BytesIO(data)
+    tree = etree.parse(data, parser, base_url=base_url)
+    canonicalize(tree.getroot())
+    return tree
+
+
+def _atomic_write(fname, data, sync=False, before_rename=None):
+    """Write bytes data to fname via a temporary file and a rename.
+
+    Readers see either the old contents of fname or the new ones,
+    never a partly written file. With sync=True the temporary file is
+    fsynced before the rename, so that the new contents are on disk
+    before the old ones go. before_rename(), if given, is called
+    just before the rename.
+    """
+    fd, tmpname = tempfile.mkstemp(
+        dir=os.path.dirname(fname) or '.',
+        prefix=os.path.basename(fname) + '.',
+        suffix='.tmp'
+        )
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            # mkstemp() makes files only their owner can read.
+            try:
+                mode = os.stat(fname).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o644
+            os.chmod(tmpname, mode)
+            f.write(data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        if before_rename is not None:
+            before_rename()
+        os.replace(tmpname, fname)
+    except:
+        os.remove(tmpname)
+        raise
+
+
+class StatusStore(object):
+    """A status file and its previous generations.
+
+    Each write() goes to a temporary file which is fsynced once and
+    then renamed over the status file, so a crash part way through
+    never leaves a truncated status behind. With generations=N the
+    status file being replaced is first kept as fname.1 (fname.1
+    moving to fname.2 and so on up to fname.N), and load() falls back
+    to the newest of those which can be read if fname itself is
+    missing or corrupt.
+    """
+
+    def __init__(self, fname, generations=0):
+        self.fname = fname
+        self.generations = generations
+        # Generation the last load() came from: 0 is fname itself.
+        self.loaded_generation = None
+
+    def generation_name(self, n):
+        """Return the file name of generation n (0 is the current one)."""
+        if n == 0:
+            return self.fname
+        return '{}.{}'.format(self.fname, n)
+
+    def rotate(self):
+        """Shift fname and its generations up one, dropping the oldest.
+
+        fname becomes generation 1 through a hard link (or a copy
+        where there can't be one) rather than a rename, so that it is
+        never missing for readers which open it directly.
+        """
+        for n in range(self.generations, 1, -1):
+            older = self.generation_name(n - 1)
+            if os.path.exists(older):
+                os.replace(older, self.generation_name(n))
+        first = self.generation_name(1)
+        if os.path.exists(first):
+            os.remove(first)
+        if os.path.exists(self.fname):
+            try:
+                os.link(self.fname, first)
+            except OSError:
+                shutil.copy2(self.fname, first)
+
+    def write(self, status):
+        """Atomically write status (an element) as the current status.
+
+        status should already be canonical.
+        """
+        before_rename = None
+        if self.generations:
+            before_rename = self.rotate
+        _atomic_write(self.fname,
+                      etree.tostring(status, pretty_print=True),
+                      sync=True,
+                      before_rename=before_rename)
+
+    def load(self):
+        """Return the canonicalized ElementTree of the newest status.
+
+        Parses fname. If that fails, tries each generation in turn and
+        raises the error from fname if none of them can be read.
+        """
+        error = None
+        for n in range(self.generations + 1):
+            try:
+                tree = parse(self.generation_name(n))
+            except (OSError, etree.XMLSyntaxError) as e:
+                if error is None:
+                    error = e
+                continue
+            self.loaded_generation = n
+            return tree
+        raise error
+
+
+def write(status, fname):
+    """Atomically write status to fname (see StatusStore.write())."""
+    StatusStore(fname).write(status)
+
+
+def load(fname):
+    """Return the canonicalized ElementTree from status file fname."""
+    return StatusStore(fname).load()
@@ -4,35 +4,86 @@
 from machination import context
 from machination.xmltools import XMLCompare
 from machination.xmltools import MRXpath
+from machination.xmltools import FrozenMRXpath
 from machination.xmltools import generate_wus
-from machination.xmltools import apply_wu
+from machination.xmltools import apply_wus
 from machination.xmltools import pstring
 from machination.xmltools import AssertionCompiler
 from machination.xmltools import mc14n
+from machination.xmltools import mhash
+from machination.xmltools import strip_hashes
+from machination.xmltools import HASH_NS
 from machination.xmltools import get_fullpos
+from machination.xmltools import WorkerDescription
+from machination.xmltools import MRXIndex
+from machination.xmltools import resolve
+from machination.xmltools import HASH_ATT
 from machination import utils
+from machination import statusfile
 from machination.webclient import WebClient
+from machination.xmldata import from_xml, to_xml
 from lxml import etree
 from lxml.builder import E
 import copy
-import topsort
+import collections
+import concurrent.futures
 import argparse
 import os
 import importlib
 import sys
 import pprint
 import traceback
+import time
+import inspect
+import itertools
 
 l = context.logger
 
+# Seconds to trust a cached assertion list for (see
+# Update.fetch_assertions()). Library items can change without the
+# assertion list changing, so every so often the list is downloaded
+# and compiled whether the server says it has changed or not.
+ASSERTION_LIST_MAX_AGE = 86400
+
 class Update(object):
 
     def __init__(self, initial_status=None, desired_status=None):
         self.workers = {}
+        # Called with a worker's name just before it is imported (see
+        # machination.service.resident), or None.
+        self.before_import = None
         mc14n(context.desired_status)
+        # Statuses handed to us may have been edited since any hashes
+        # were stored on them. Hash copies: the caller still owns the
+        # originals.
+        if initial_status is not None:
+            initial_status = mc14n(copy.deepcopy(initial_status))
+            mhash(initial_status)
+        if desired_status is not None:
+            desired_status = mc14n(copy.deepcopy(desired_status))
+            mhash(desired_status)
         self._initial_status = initial_status
         self._desired_status = desired_status
         self._previous_status = None
+        # {worker name: [expiry time, status element]}
+        self._status_cache = {}
+
+    def new_cycle(self):
+        """Forget the statuses worked out in the last update cycle.
+
+        Worker objects and cached worker statuses are kept, so one
+        Update can run cycle after cycle (see
+        machination.service.resident).
+        """
+        self.results = None
+        self._initial_status = None
+        self._desired_status = None
+        self._previous_status = None
+
+    def forget_worker(self, name):
+        """Drop the worker object for name so that it is made afresh."""
+        self.workers.pop(name, None)
+        self.invalidate_status(name)
 
     def do_update(self):
         """Perform an update cycle"""
@@ -42,9 +93,24 @@ class Update(object):
         l.dmsg('desired:\n%s' % pstring(self.desired_status()), 10)
         l.dmsg('initial:\n%s' % pstring(self.initial_status()), 10)
         comp = XMLCompare(copy.deepcopy(self.initial_status()),
-                          self.desired_status())
+                          self.desired_status(),
+                          hashed=True)
         l.dmsg('xpaths by state:\n' + pprint.pformat(comp.bystate), 10)
 
+        try:
+            deps = self.desired_status().xpath('/status/deps')[0]
+        except IndexError:
+            deps = etree.fromstring('<status><deps/></status>')[0]
+        wudeps = comp.wudeps(deps.iterchildren(tag=etree.Element))
+
+        # Generate every work unit in one pass, with positions worked
+        # out against the final desired order. Each is handed out once
+        # the work it depends on is done.
+        todo = comp.find_work().union(*wudeps)
+        wus, working = generate_wus(todo, comp, keep_working=False)
+        for wu in wus:
+            l.dmsg(pstring(wu), 10)
+
         # See if we have to do a self update
         iv_mrx = MRXpath(
             '/status/worker[@id="__machination__"]/installedVersion'
@@ -53,8 +119,12 @@ class Update(object):
         selfupdate_bundles = set()
         if iv_mrx.to_xpath() in comp.find_work():
             # installedVersion has changed somehow
-            wus, working = generate_wus({iv_mrx.to_xpath()}, comp)
-            wu = wus[0] if wus else etree.Element('wu', op='nothing')
+            wu = etree.Element('wu', op='nothing')
+            for ivwu in wus:
+                if (ivwu.get('id') == iv_mrx.to_xpath() and
+                    ivwu.get('op') in ('add', 'deepmod')):
+                    wu = ivwu
+                    break
             if wu.get('op') == 'add' or wu.get('op') == 'deepmod':
                 # Definitely updating
                 l.lmsg(
@@ -81,25 +151,22 @@ class Update(object):
 #                worker = self.worker('fetcher')
 #                for wu in fetcher_wus:
 
-        try:
-            deps = self.desired_status().xpath('/status/deps')[0]
-        except IndexError:
-            deps = etree.fromstring('<status><deps/></status>')[0]
-        wudeps = comp.wudeps(deps.iterchildren(tag=etree.Element))
-
         # Track success/failure of work units.
         #
         # Before a work unit is attempted work_status[wu] should not
         # exist.
         #
-        # Afterward, work_status[wu] should contain an array with a
-        # status (True = succeeded, False = failed) and either the wu
-        # element or an error message as appropriate:
+        # Afterward, work_status[wu] should contain a list with an
+        # entry for each work unit with that id (there may be more
+        # than one: a datamod and a move, say). Each entry is an array
+        # with a status (True = succeeded, False = failed) and either
+        # the wu element or an error message as appropriate:
         #
         # {
-        #  wu1: [True, wu_elt],
-        #  wu2: [False, "Worker 'splat' not available"]
-        #  wu3: [False, "Dependency 'wu2' failed"]
+        #  wu1: [[True, wu_elt]],
+        #  wu2: [[False, "Worker 'splat' not available"]]
+        #  wu3: [[False, "Dependency 'wu2' failed"]]
+        #  wu4: [[True, datamod_wu_elt], [True, move_wu_elt]]
         # }
         work_status = {}
         # set up a dictionary:
@@ -124,126 +191,21 @@ class Update(object):
                 # entry for dep[1] does not exist, create it
                 work_depends[dep[1]] = [dep[0]]
 #        l.dmsg('work_depends = {}'.format(pprint.pformat(work_depends)))
-        # we need to make all workunits depend on something for
-        # topsort to work
-        if selfupdate:
-            # selfupdate_bundles should be done first
-            wudeps.extend([['', x] for x in selfupdate_bundles])
-        else:
-            wudeps.extend([['', x] for x in comp.find_work()])
-#        l.dmsg('wudeps = {}'.format(pprint.pformat(wudeps)))
 
         wu_updated_status = copy.deepcopy(self.initial_status())
 
-        i = 0
-#        failures = []
-        for lev in iter(topsort.topsort_levels(wudeps)):
-            i += 1
-            if i == 1:
-                # this is the fake workunit '' we put in above
-                continue
-            l.dmsg('xpaths for level {}:\n'.format(i) + pprint.pformat(lev), 10)
-            wus, working_elt = generate_wus(set(lev), comp)
-
-#            l.dmsg(pstring(self.initial_status(),10))
-#            l.dmsg(pstring(self.desired_status(),10))
-            for wu in wus:
-                l.dmsg(pstring(wu), 10)
-
-            add_map = {}
-            for wu in wus:
-                # If it's an add for a worker, add the worker element
-                wu_mrx = MRXpath(wu.get('id'))
-                if wu_mrx.to_noid_path() == '/status/worker' and wu.get('op') == 'add':
-                    l.lmsg('Adding worker element ' + wu_mrx.to_xpath())
-                    wu_updated_status.xpath('/status')[0].append(
-                        etree.Element(
-                            'worker',
-                            id = wu_mrx.id()
-                            )
-                        )
-                    continue
-
-                # If it's an add, we need to add it to the add_map so
-                # that adds still function properly if they get out of
-                # order or previous adds have failed.
-                if wu.get('op') == 'add':
-                    add_map[wu.get('id')] = get_fullpos(
-                        wu.get('pos'),
-                        MRXpath(wu.get('id')).parent()
-                        )
-
-                # check to make sure any dependencies have been done
-                check = self.check_deps(wu, work_depends, work_status)
-                if not check[0]:
-                    l.wmsg("Failing {}: dep {} failed".format(wu.get('id'), check[1]))
-                    work_status[wu.get('id')] = [
-                        False, "Dependency '{}' failed".format(check[1])
-                        ]
-                    # don't include this wu in work to be done
-                    continue
-
-                wname = MRXpath(wu.get('id')).workername(prefix='/status')
-                worker = self.worker(wname)
-                l.lmsg('dispatching to ' + wname)
-                l.dmsg('work:\n' + pstring(wu))
-                if worker:
-                    # need to wrap the wu in a wus element
-                    workelt = etree.Element('wus',worker=wname)
-                    workelt.append(copy.deepcopy(wu))
-                    try:
-                        results = worker.do_work(workelt)
-                    except Exception as e:
-                        exc_type, exc_value, exc_tb = sys.exc_info()
-                        # There's only one, but in future there might
-                        # be more - loop over them.
-                        for curwu in workelt:
-                            work_status[curwu.get('id')] = [
-                                False,
-                                "Exception in worker {}\n{}".format(
-                                    wname, str(e)
-                                    )
-                                ]
-                            l.emsg(
-                                "Exception during {} - failing it\n{}".format(
-                                        curwu.get('id'),
-                                        ''.join(traceback.format_tb(exc_tb)) +
-                                        repr(e)
-                                        )
-                                    )
-                    else:
-                        self.process_results(
-                            results,
-                            workelt,
-                            work_status
-                            )
-                        wid = wu.get('id')
-                        completed = work_status.get(wid)
-                        if completed[0]:
-                            # Apply successes to wu_updated_status
-                            l.dmsg('Marking {} succeeded.'.format(wid))
-                            wu_updated_status = apply_wu(
-                                completed[1],
-                                wu_updated_status,
-                                add_map = add_map)
-                        else:
-                            l.dmsg('Marking {} failed.'.format(wid))
-#                            failures.append([wid, completed[1]])
-
-                else:
-                    # No worker: fail this set of work
-                    work_status[wu.get('id')] = [
-                        False,
-                        "No worker '{}'".format(wname)
-                        ]
-
-            # TODO(colin): parallelise downloads and other work
+        # Each work unit starts as soon as everything it depends on
+        # has finished rather than waiting for a whole topsort level.
+        graph = WorkGraph(comp.find_work(), work_depends)
+        ran = self.run_graph(
+            graph, wus, work_depends, work_status, wu_updated_status
+            )
 
         # Report successes
         l.lmsg(
             'The following work units reported success:\n{}'.format(
                 pprint.pformat(
-                    [k for k, v in work_status.items() if v[0]]
+                    [k for k, v in work_status.items() for r in v if r[0]]
                     )
                 )
             )
@@ -251,27 +213,335 @@ class Update(object):
         l.wmsg(
             'The following work units reported failure:\n{}'.format(
                 pprint.pformat(
-                    [[k, v[1]] for k, v in work_status.items() if not v[0]]
+                    [[k, r[1]] for k, v in work_status.items()
+                     for r in v if not r[0]]
                     )
                 )
             )
-        # write calculated status to file
         fname = os.path.join(context.status_dir(), 'previous-status.xml')
-        with open(fname, 'w') as prev:
-            prev.write(etree.tostring(
-                    wu_updated_status,
-                    pretty_print=True
-                    ).decode())
-
-        # see how the status has changed including calls to generate_status()
-        new_status = self.gather_status()
-
-        # write this status out as previous_status.xml
-        with open(fname, 'w') as prev:
-            prev.write(etree.tostring(
-                    new_status,
-                    pretty_print = True
-                    ).decode())
+
+        # see how the status of the workers that did work has changed
+        # according to their generate_status(), only for the wus they
+        # did if they can. The rest keep their elements from
+        # wu_updated_status.
+        try:
+            new_status = self.refresh_status(workers=ran,
+                                             status=wu_updated_status,
+                                             paths=ran)
+        except Exception:
+            # Don't lose track of the work done: keep the calculated
+            # status instead.
+            self.write_status(wu_updated_status, fname)
+            raise
+
+        # write this status out as previous_status.xml, once per
+        # cycle. Last run's status becomes the newest previous
+        # generation.
+        self.write_status(new_status, fname)
+
+    def write_status(self, status, fname):
+        """Write status to fname with freshly calculated hashes."""
+        mhash(status)
+        etree.cleanup_namespaces(status, top_nsmap={'mhash': HASH_NS})
+        self.status_store(fname).write(status)
+
+    def status_store(self, fname):
+        """Return a statusfile.StatusStore for fname."""
+        return statusfile.StatusStore(fname, **self.statusfiles_config())
+
+    def statusfiles_config(self):
+        """Return {option: value} for status files.
+
+        Configured by::
+
+          <statusfiles generations="2"/>
+
+        in the __machination__ worker element. generations previous
+        versions of each status file are kept to fall back on (see
+        statusfile.StatusStore). The default is to keep
+        statusfile.DEFAULT_GENERATIONS generations.
+        """
+        config = {
+            'generations': statusfile.DEFAULT_GENERATIONS,
+            }
+        try:
+            selt = context.machination_worker_elt.xpath('statusfiles')[0]
+        except IndexError:
+            return config
+        config['generations'] = int(
+            selt.get('generations', config['generations'])
+            )
+        return config
+
+    def dispatch_config(self):
+        """Return [executor, max_workers] from the __machination__ worker.
+
+        Configured by::
+
+          <dispatch executor="serial|thread|process" maxWorkers="4"/>
+
+        in the __machination__ worker element. The default is to run
+        work serially.
+        """
+        try:
+            delt = context.machination_worker_elt.xpath('dispatch')[0]
+        except IndexError:
+            return ['serial', 1]
+        executor = delt.get('executor', 'serial')
+        if executor not in ('serial', 'thread', 'process'):
+            l.wmsg('Unknown dispatch executor "{}", using serial'.format(
+                    executor))
+            executor = 'serial'
+        max_workers = int(delt.get('maxWorkers', os.cpu_count() or 1))
+        return [executor, max_workers]
+
+    def run_graph(self, graph, wus, work_depends, work_status, status):
+        """Do the work in graph, each wu as soon as its deps are done.
+
+        The planned work units for each group of nodes are handed to
+        workers in batches as the group becomes ready. Most workers
+        have one batch in progress at a time, holding all of their
+        queued wus. A worker which can do several at once (see
+        work_concurrency()) gets a batch per node instead, and has up
+        to that many in progress, so a slow wu only holds up work that
+        depends on it. Up to maxWorkers (see dispatch_config())
+        batches run at once.
+
+        Args:
+          graph: WorkGraph of work unit xpaths
+          wus: list of all wus, in the order generated. A node may
+            have more than one (a datamod and a move, say).
+          work_depends: {wu: [wus, it, depends, on]}
+          work_status: dictionary to record results in
+          status: status element to apply successful work to (in
+            place)
+
+        Returns:
+          {worker name: [ids of the wus it was handed]}
+        """
+        executor, max_workers = self.dispatch_config()
+        pool = None
+        if executor == 'serial' or max_workers < 2:
+            max_workers = 1
+        elif executor == 'process':
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers)
+        else:
+            pool = thread_pool(max_workers)
+
+        # {wu_id: [wus, in, the, order, generated]}
+        planned = {}
+        # position of each wu in the order generated
+        rank = {}
+        # Where each add should go, so that adds still function
+        # properly if they get out of order or previous adds have
+        # failed.
+        add_map = {}
+        for i, wu in enumerate(wus):
+            planned.setdefault(wu.get('id'), []).append(wu)
+            rank[wu] = i
+            wu_mrx = MRXpath(wu.get('id'))
+            if (wu.get('op') == 'add' and
+                wu_mrx.to_noid_path() != '/status/worker'):
+                add_map[wu.get('id')] = get_fullpos(wu.get('pos'),
+                                                    wu_mrx.parent())
+        # {node: number of its dispatched wus not yet finished}
+        outstanding = {}
+        # wus waiting for their worker to be free: {wname: [wu, ...]}
+        queued = {}
+        # batches in progress: {future: [wname, wus_elt]}
+        running = {}
+        # {wname: batches it may have in progress at once}
+        limits = {}
+        ran = {}
+        try:
+            while True:
+                ready = graph.take_ready()
+                while ready:
+                    self.prepare_work(
+                        ready, planned, rank, work_depends, work_status,
+                        status, outstanding, queued)
+                    for node in ready:
+                        if not outstanding.get(node):
+                            graph.finish(node)
+                    ready = graph.take_ready()
+
+                busy = collections.Counter(
+                    wname for wname, workelt in running.values())
+                for wname in list(queued):
+                    if wname not in limits:
+                        limits[wname] = self.work_concurrency(wname)
+                    while (queued.get(wname) and
+                           len(running) < max_workers and
+                           busy[wname] < limits[wname]):
+                        workelt = etree.Element('wus', worker=wname)
+                        for wu in self.next_batch(
+                                queued, wname,
+                                limits[wname] > 1 and max_workers > 1):
+                            workelt.append(copy.deepcopy(wu))
+                        running[self.submit(
+                                pool, executor, wname, workelt)] = [
+                            wname, workelt]
+                        busy[wname] += 1
+                        ran.setdefault(wname, []).extend(
+                            wu.get('id') for wu in workelt)
+
+                if not running:
+                    break
+                done, not_done = concurrent.futures.wait(
+                    running,
+                    return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                for future in done:
+                    wname, workelt = running.pop(future)
+                    try:
+                        outcome = future.result()
+                    except Exception as e:
+                        # the pool itself failed (a process died, say)
+                        outcome = [False, str(e), traceback.format_exc()]
+                    if executor == 'process' and outcome[0]:
+                        outcome[1] = etree.fromstring(outcome[1])
+                    self.merge_outcome(
+                        wname, workelt, outcome, work_status, status, add_map)
+                    for wu in workelt:
+                        node = wu.get('id')
+                        outstanding[node] -= 1
+                        if not outstanding[node]:
+                            graph.finish(node)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        if graph.unfinished:
+            raise Exception(
+                'Dependency cycle between work units:\n{}'.format(
+                    pprint.pformat(sorted(graph.unfinished))
+                    )
+                )
+        return ran
+
+    def prepare_work(self, ready, planned, rank, work_depends, work_status,
+                     status, outstanding, queued):
+        """Queue the planned wus for ready nodes with their workers.
+
+        Work units which need no worker are done here and those which
+        can't be done are failed. The rest are appended to
+        queued[wname] and counted in outstanding[node].
+        """
+        wus = [wu for node in ready for wu in planned.pop(node, ())]
+        wus.sort(key=rank.get)
+
+        for wu in wus:
+            # If it's an add for a worker, add the worker element
+            wu_mrx = MRXpath(wu.get('id'))
+            if wu_mrx.to_noid_path() == '/status/worker' and wu.get('op') == 'add':
+                l.lmsg('Adding worker element ' + wu_mrx.to_xpath())
+                status.xpath('/status')[0].append(
+                    etree.Element(
+                        'worker',
+                        id = wu_mrx.id()
+                        )
+                    )
+                continue
+
+            # check to make sure any dependencies have been done
+            check = self.check_deps(wu, work_depends, work_status)
+            if not check[0]:
+                l.wmsg("Failing {}: dep {} failed".format(wu.get('id'), check[1]))
+                work_status.setdefault(wu.get('id'), []).append([
+                    False, "Dependency '{}' failed".format(check[1])
+                    ])
+                # don't include this wu in work to be done
+                continue
+
+            wname = wu_mrx.workername(prefix='/status')
+            if self.worker(wname):
+                l.lmsg('dispatching to ' + wname)
+                l.dmsg('work:\n' + pstring(wu))
+                node = wu.get('id')
+                outstanding[node] = outstanding.get(node, 0) + 1
+                queued.setdefault(wname, []).append(wu)
+            else:
+                # No worker: fail this set of work
+                work_status.setdefault(wu.get('id'), []).append([
+                    False,
+                    "No worker '{}'".format(wname)
+                    ])
+
+    def next_batch(self, queued, wname, per_node):
+        """Take the next batch of wus for worker wname off queued.
+
+        The batch is all of the worker's queued wus or, if per_node is
+        True, those for the node queued first.
+        """
+        wus = queued.pop(wname)
+        if not per_node:
+            return wus
+        node = wus[0].get('id')
+        rest = [wu for wu in wus if wu.get('id') != node]
+        if rest:
+            queued[wname] = rest
+        return [wu for wu in wus if wu.get('id') == node]
+
+    def work_concurrency(self, name):
+        """Return how many batches of work worker name may do at once."""
+        return self.description_setting(name, 'concurrent_work', 1)
+
+    def submit(self, pool, executor, wname, workelt):
+        """Start worker wname on workelt, return a Future for the outcome.
+
+        With no pool, or a thread pool and a worker which must be
+        called from this thread (see in_caller_thread()), the work is
+        done straight away in this thread.
+        """
+        if pool is None or (executor == 'thread' and
+                            self.in_caller_thread(wname)):
+            future = concurrent.futures.Future()
+            future.set_result(run_work(self.worker(wname), workelt))
+            return future
+        if executor == 'process':
+            # elements can't be pickled: send them as text
+            return pool.submit(
+                run_work_in_process, wname, etree.tostring(workelt))
+        return pool.submit(run_work, self.worker(wname), workelt)
+
+    def merge_outcome(self, wname, workelt, outcome, work_status, status,
+                      add_map):
+        """Record the outcome of a batch and apply its successes to status."""
+        if outcome[0]:
+            results = self.process_results(outcome[1], workelt)
+        else:
+            # An exception fails every wu in the batch
+            results = []
+            for curwu in workelt:
+                results.append([
+                    False,
+                    "Exception in worker {}\n{}".format(
+                        wname, outcome[1]
+                        )
+                    ])
+                l.emsg(
+                    "Exception during {} - failing it\n{}".format(
+                        curwu.get('id'),
+                        outcome[2]
+                        )
+                    )
+
+        succeeded = []
+        for curwu, completed in zip(workelt, results):
+            wid = curwu.get('id')
+            if completed is None:
+                l.emsg('No result for {} - failing it'.format(wid))
+                completed = [False, 'Worker did not report a result']
+            elif completed[0]:
+                l.dmsg('Marking {} succeeded.'.format(wid))
+                succeeded.append(completed[1])
+            else:
+                l.dmsg('Marking {} failed.'.format(wid))
+            work_status.setdefault(wid, []).append(completed)
+        # Apply successes to wu_updated_status
+        apply_wus(succeeded, status, add_map = add_map)
+        # Even failed work may have changed something.
+        self.invalidate_status(wname)
 
     def check_deps(self, wu, work_depends, work_status):
         """Check status of dependencies of a work unit (wu)
@@ -284,8 +554,9 @@ class Update(object):
             # this work depends on some other work check to
             # see if any have failed
             for dep_id in work_depends.get(wu.get('id')):
-                if work_status.get(dep_id) and not work_status.get(dep_id)[0]:
-                    return [False, dep_id]
+                for done in work_status.get(dep_id, ()):
+                    if not done[0]:
+                        return [False, dep_id]
         return [True]
 
 
@@ -309,43 +580,119 @@ class Update(object):
             l.lmsg('Connecting to service "{}"'.format(service_id))
             # find the machination id for this service
             mid = context.get_id(service_id)
-            wc = WebClient.from_service_id(service_id, 'os_instance')
+            wc = self.webclient(service_id)
 #            channel = wc.call("ProfChannel", 'os_instance')
             try:
-                data = wc.call('GetAssertionList',
-                               'os_instance',
-                               mid)
+                data, revision, unchanged = self.fetch_assertions(wc, mid)
             except:
                 # couldn't dowload assertions - go with last desireed
-                # status. Should already be canonicalized.
+                # status.
                 l.wmsg('Failed to download assertions - using desired status from context.')
+                data = None
+            else:
+                if (unchanged and not
+                    context.desired_status.getroot().get('autoconstructed')):
+                    # desired-status.xml was compiled from these
+                    # assertions: no need to compile them again.
+                    l.lmsg('Assertions unchanged - using desired status from context.')
+                    data = None
+            if data is None:
+                # Should already be canonicalized.
                 self._desired_status = copy.deepcopy(
                     context.desired_status.getroot()
                     )
+                mhash(self._desired_status)
             else:
                 # we do have some assertions - compile them
 #                pprint.pprint(data)
+                # compile() eats data: keep a copy to cache.
+                data_elt = None
+                if revision is not None and not unchanged:
+                    data_elt = to_xml(data)
                 ac = AssertionCompiler(wc)
                 self._desired_status, res = ac.compile(data)
                 mc14n(self._desired_status)
                 # Save as desired-status.xml
-                with open(
-                    os.path.join(
-                        context.status_dir(),
-                        'desired-status.xml'
-                        ),
-                    'w') as ds:
-                    ds.write(etree.tostring(
-                            self._desired_status,
-                            pretty_print=True).decode())
+                self.write_status(
+                    self._desired_status,
+                    os.path.join(context.status_dir(), 'desired-status.xml')
+                    )
+                # Only now is it safe to say which assertions
+                # desired-status.xml came from.
+                if data_elt is not None:
+                    self.save_assertion_list(revision, data_elt)
 
         return self._desired_status
 
+    def webclient(self, service_id):
+        """Return a WebClient for talking to service_id."""
+        return WebClient.from_service_id(service_id, 'os_instance')
+
+    def assertion_list_file(self):
+        """Return the name of the assertion list cache file."""
+        return os.path.join(context.status_dir(), 'assertion-list.xml')
+
+    def load_assertion_list(self):
+        """Return [revision, fetched, assertions] from the cache.
+
+        fetched is the time the assertions were downloaded. Returns
+        [None, None, None] if there is no usable cached list.
+        """
+        try:
+            elt = etree.parse(self.assertion_list_file()).getroot()
+            return [elt.get('revision'), float(elt.get('fetched')),
+                    from_xml(elt[0])]
+        except (IOError, etree.XMLSyntaxError, IndexError, TypeError,
+                ValueError):
+            return [None, None, None]
+
+    def save_assertion_list(self, revision, data_elt):
+        """Cache transport XML data_elt as the assertions for revision."""
+        fname = self.assertion_list_file()
+        elt = etree.Element('assertionList', revision=revision,
+                            fetched=repr(time.time()))
+        elt.append(data_elt)
+        tmpname = fname + '.tmp'
+        with open(tmpname, 'wb') as f:
+            f.write(etree.tostring(elt))
+        os.replace(tmpname, fname)
+
+    def fetch_assertions(self, wc, mid):
+        """Return [assertions, revision, unchanged] from the hierarchy.
+
+        If a cached assertion list (see load_assertion_list()) is
+        younger than ASSERTION_LIST_MAX_AGE, the server is only asked
+        for the assertions if they have changed. If they haven't,
+        unchanged is True and the cached assertions are returned
+        without downloading them. revision is the server's name for
+        this version of the assertions, or None if the server doesn't
+        do GetAssertionListIfChanged.
+        """
+        revision, fetched, cached = self.load_assertion_list()
+        if fetched is None or time.time() - fetched > ASSERTION_LIST_MAX_AGE:
+            revision = None
+        try:
+            ans = wc.call('GetAssertionListIfChanged',
+                          'os_instance',
+                          mid,
+                          revision)
+        except Exception as e:
+            if 'no such call' not in str(e):
+                raise
+            # An older server
+            return [wc.call('GetAssertionList', 'os_instance', mid),
+                    None, False]
+        if revision is not None and ans.get('not_modified'):
+            l.lmsg('Assertions unchanged since revision {}'.format(revision))
+            return [cached, revision, True]
+        return [ans['assertions'], ans['revision'], False]
+
     def load_previous_status(self):
         """Load previous_status.xml"""
         fname = os.path.join(context.status_dir(), 'previous-status.xml')
+        store = self.status_store(fname)
         try:
-            self._previous_status = etree.parse(fname).getroot()
+            self._previous_status = store.load().getroot()
         except IOError:
             # couldn't read file may be lack of permission or not exists
             # if not exists (first run?) we should make a new status
@@ -353,7 +700,9 @@ class Update(object):
                 self._previous_status = E.status()
             else:
                 raise
-        mc14n(self._previous_status)
+        if store.loaded_generation:
+            l.wmsg('Could not read {}, using generation {}'.format(
+                    fname, store.loaded_generation))
         return self._previous_status
 
     def previous_status(self):
@@ -363,55 +712,254 @@ class Update(object):
         return self._previous_status
 
     def gather_status(self):
-        """Invoke all workers' generate_status() and gather into one."""
+        """Invoke all workers' generate_status() and gather into one.
+
+        Workers without a generate_status() keep their element from
+        previous-status.xml. See worker_statuses() for concurrency and
+        caching.
+        """
         l.lmsg('Gathering status from workers.')
-        status = copy.deepcopy(self.load_previous_status())
-        # find all workers
+        return self.refresh_status()
+
+    def refresh_status(self, workers=None, status=None, paths=None):
+        """Return a copy of status with workers' elements regenerated.
+
+        Args:
+          workers: names of the workers to call generate_status() for.
+            None means all workers in status or desired status.
+          status: status element to start from. Defaults to
+            previous-status.xml.
+          paths: {worker name: [xpaths]}. Workers listed here whose
+            generate_status() takes a paths argument are only asked
+            for the elements at those xpaths, which are then spliced
+            into their elements from status (see splice_status()).
+
+        Worker elements not regenerated are kept as they are in
+        status, with their stored hashes.
+        """
+        if status is None:
+            status = self.load_previous_status()
+        status = copy.deepcopy(status)
         stelt = status.xpath('/status')[0]
-        done = set()
-        for welt in status.xpath('/status/worker'):
-            # the following should create a worker object and store it
-            # in self.workers
-            worker = self.worker(welt.get("id"))
-            if worker is not None:
-                try:
-                    wstatus = worker.generate_status()
-                except AttributeError:
-                    # No generate_status method: leave the previous
-                    # status element intact. This will, in effect,
-                    # cause the status to be tracked by do_update()
-                    # when it writes sucessful changes to
-                    # previous_status.xml
-                    pass
-                stelt.remove(welt)
-                try:
-                    stelt.append(wstatus)
-                except Exception as e:
-                    stelt.append(welt)
-            done.add(welt.get('id'))
-        for welt in self.desired_status().xpath('/status/worker'):
-            if welt.get("id") in done:
+        previous = {welt.get('id'): welt
+                    for welt in status.xpath('/status/worker')}
+        if workers is None:
+            # Workers in status, then any new ones from desired status.
+            workers = list(previous)
+            for welt in self.desired_status().xpath('/status/worker'):
+                if welt.get('id') not in previous:
+                    workers.append(welt.get('id'))
+        else:
+            l.lmsg('Refreshing status from workers: {}'.format(
+                    ', '.join(sorted(workers))))
+        statuses = self.worker_statuses(workers, paths)
+        unspliced = []
+        for name, [wstatus, wpaths] in statuses.items():
+            if wpaths is not None:
+                if not self.splice_status(status, wstatus, wpaths):
+                    unspliced.append(name)
+        if unspliced:
+            l.wmsg('Could not splice partial status from {}, '
+                   'regenerating in full'.format(', '.join(unspliced)))
+            statuses.update(self.worker_statuses(unspliced))
+        for name, [wstatus, wpaths] in statuses.items():
+            if wpaths is not None:
+                # spliced in already
                 continue
-            worker = self.worker(welt.get("id"))
-            if worker is not None:
-                try:
-                    wstatus = worker.generate_status()
-                except AttributeError:
-                    # No generate_status method and no previous status
-                    # element, create one
-                    #stelt.append(etree.Element('worker', id=welt.get('id')))
-                    pass
-                else:
-                    stelt.append(wstatus)
+            if name in previous:
+                stelt.replace(previous[name], wstatus)
+            else:
+                stelt.append(wstatus)
         mc14n(status)
+        # Kept elements have good hashes, freshly generated ones have
+        # none.
+        mhash(status, trust_stored=True)
         return status
 
+    def splice_status(self, status, wstatus, paths):
+        """Splice the elements at paths from wstatus into status.
+
+        wstatus is a partial worker element from generate_status(paths)
+        and paths are /status/worker[@id=...]/... xpaths of elements.
+        An element at one of paths in status is replaced by the one
+        in wstatus, removed if wstatus doesn't have it, or appended
+        to its parent if only wstatus has it.
+
+        Returns False, leaving status untouched, if that isn't
+        possible: a path isn't below a worker element or is an
+        attribute, status lacks the worker element or the parent of
+        a new element, or a new element would go in an ordered list.
+        """
+        wname = wstatus.get('id')
+        wd = WorkerDescription(wname, prefix='/status')
+        idx = MRXIndex(status)
+        spliced = []
+        plan = []
+        for mrx in sorted({FrozenMRXpath(p) for p in paths}, key=len):
+            if mrx.workername(prefix='/status') != wname:
+                return False
+            if not mrx.is_element() or mrx.length() < 3:
+                return False
+            if any(done.could_be_parent_of(mrx) for done in spliced):
+                # inside an element already being spliced
+                continue
+            # wstatus may not be the root of its tree
+            new = resolve(wstatus, '/'.join(mrx.to_xpath_list()[3:]))
+            old = resolve(idx, mrx)
+            if old is None and new is None:
+                continue
+            parent = resolve(idx, mrx.parent())
+            if parent is None:
+                return False
+            if old is None and new is not None and wd.is_ordered(
+                mrx.parent()):
+                return False
+            spliced.append(mrx)
+            plan.append([parent, old, new])
+
+        for parent, old, new in plan:
+            if new is None:
+                if old is not None:
+                    parent.remove(old)
+            elif old is None:
+                parent.append(copy.deepcopy(new))
+            else:
+                parent.replace(old, copy.deepcopy(new))
+            # Stored hashes above the change are stale now.
+            for elt in itertools.chain([parent], parent.iterancestors()):
+                elt.attrib.pop(HASH_ATT, None)
+        return True
+
+    def worker_statuses(self, names, paths=None):
+        """Return {name: [status element, paths]} for workers in names.
+
+        paths is None for a full worker element, or the xpaths a
+        partial one was generated for (see refresh_status()). Workers
+        which don't exist or have no generate_status() are left out.
+        generate_status() is called for up to maxWorkers (see
+        dispatch_config()) workers at once in threads, unless the
+        dispatch executor is serial or the worker must be called from
+        this thread (see in_caller_thread()). Statuses are always
+        gathered in this process: worker objects live here.
+
+        A worker whose description declares info:statusTTL has its
+        full status cached for that many seconds (see status_ttl()),
+        or until work is done by it (see invalidate_status()).
+        """
+        if paths is None:
+            paths = {}
+        statuses = {}
+        todo = []
+        now = time.monotonic()
+        for name in names:
+            # Create worker objects here rather than in the pool.
+            worker = self.worker(name)
+            if worker is None:
+                continue
+            wpaths = paths.get(name)
+            if wpaths is not None and takes_paths(worker):
+                todo.append([name, list(wpaths)])
+                continue
+            cached = self._status_cache.get(name)
+            if cached is not None and cached[0] > now:
+                l.dmsg('Using cached status for {}'.format(name))
+                statuses[name] = [copy.deepcopy(cached[1]), None]
+            else:
+                todo.append([name, None])
+
+        executor, max_workers = self.dispatch_config()
+        if executor == 'serial':
+            pooled = []
+        else:
+            pooled = [job for job in todo
+                      if not self.in_caller_thread(job[0])]
+        if len(pooled) < 2:
+            pooled = []
+        generated = {}
+        if pooled:
+            with thread_pool(min(max_workers, len(pooled))) as pool:
+                futures = [[job[0], pool.submit(
+                            self.generate_worker_status, *job)]
+                           for job in pooled]
+                for job in todo:
+                    if job not in pooled:
+                        generated[job[0]] = self.generate_worker_status(*job)
+                for name, future in futures:
+                    generated[name] = future.result()
+        else:
+            for job in todo:
+                generated[job[0]] = self.generate_worker_status(*job)
+
+        for name, wpaths in todo:
+            wstatus = generated[name]
+            if wstatus is None:
+                continue
+            ttl = self.status_ttl(name)
+            if ttl and wpaths is None:
+                self._status_cache[name] = [now + ttl,
+                                            copy.deepcopy(wstatus)]
+            statuses[name] = [wstatus, wpaths]
+        return statuses
+
+    def generate_worker_status(self, name, paths=None):
+        """Return worker name's generate_status() without hashes, or None.
+
+        None means the worker has no generate_status(). If paths is
+        not None it is passed on to generate_status().
+        """
+        try:
+            if paths is None:
+                wstatus = self.worker(name).generate_status()
+            else:
+                wstatus = self.worker(name).generate_status(paths=paths)
+        except AttributeError:
+            # No generate_status method: leave the previous status
+            # element intact. This will, in effect, cause the status
+            # to be tracked by do_update() when it writes sucessful
+            # changes to previous_status.xml
+            return None
+        if wstatus is None:
+            return None
+        return strip_hashes(wstatus)
+
+    def status_ttl(self, name):
+        """Return seconds worker name's generated status may be reused."""
+        return self.description_setting(name, 'status_ttl', 0) or 0
+
+    def in_caller_thread(self, name):
+        """Return True if worker name must not be called from a pool thread.
+
+        Such workers hold objects (COM objects made when the worker
+        was, say) which only work in the thread that made them.
+        """
+        return self.description_setting(name, 'caller_thread', False)
+
+    def description_setting(self, name, method, default):
+        """Return WorkerDescription(name).method(), or default.
+
+        default is used, with a warning, if worker name's description
+        can't be read: a broken description shouldn't stop its
+        status being gathered.
+        """
+        try:
+            return getattr(WorkerDescription(name), method)()
+        except Exception as e:
+            l.wmsg("Can't read description of worker {}: {}".format(
+                    name, e))
+            return default
+
+    def invalidate_status(self, name):
+        """Forget any cached status for worker name."""
+        self._status_cache.pop(name, None)
+
     def worker(self, name):
         """Get the worker object for name."""
         if name in self.workers:
             return self.workers[name]
 
         l.lmsg('Importing {}'.format(name))
+        if self.before_import is not None:
+            self.before_import(name)
         try:
             wmod = importlib.import_module('machination.workers.' + name)
             w = wmod.Worker()
@@ -437,15 +985,141 @@ class Update(object):
             l.lmsg('Worker {} imported'.format(name))
         return w
 
-    def process_results(self, res, workelt, work_status):
+    def process_results(self, res, workelt):
+        """Match the results reported by a worker to the wus in workelt.
+
+        Several wus in workelt may have the same id (a datamod and a
+        move of the same element, say): results for that id are
+        matched to them in order.
+
+        Args:
+          res: results element returned by worker.do_work(workelt)
+          workelt: the wus element handed to the worker
+
+        Returns:
+          a list with, for each wu in workelt, [True, wu], [False,
+          message] or None if the worker reported nothing for it.
+        """
+        # {wu id: indexes in workelt of wus with that id not yet
+        # reported on}
+        pending = {}
+        for i, wu in enumerate(workelt):
+            pending.setdefault(wu.get('id'), collections.deque()).append(i)
+        results = [None] * len(workelt)
         for ru in res:
+            wid = ru.get('id')
+            if not pending.get(wid):
+                l.wmsg('Ignoring result for {}: no such wu '
+                       'outstanding'.format(wid))
+                continue
+            i = pending[wid].popleft()
             if ru.get("status") == "success":
-                l.lmsg('{} reports success'.format(ru.get('id')))
-                wu = workelt.xpath('wu[@id="{}"]'.format(ru.get('id')))[0]
-                work_status[ru.get('id')] = [True, wu]
+                l.lmsg('{} reports success'.format(wid))
+                results[i] = [True, workelt[i]]
             else:
-                l.emsg('{} reports failure'.format(ru.get('id')))
-                work_status[ru.get('id')] = [False, ru.get('message')]
+                l.emsg('{} reports failure'.format(wid))
+                results[i] = [False, ru.get('message')]
+        return results
+
+class WorkGraph(object):
+    """Hand out work units as the work they depend on is finished.
+
+    Unlike topsort levels, a node becomes ready as soon as all of its
+    own dependencies have finished: a slow work unit only holds up
+    the work that depends on it.
+    """
+
+    def __init__(self, nodes, depends):
+        """WorkGraph constructor
+
+        Args:
+          nodes: iterable of nodes (work unit xpaths)
+          depends: {node: [nodes, it, depends, on]}. Nodes mentioned
+            here are added to the graph if they aren't in nodes.
+        """
+        # {node: set of unfinished nodes it depends on}
+        self.waiting = {node: set() for node in nodes}
+        # {node: set of nodes depending on it}
+        self.dependents = {}
+        for node, deps in depends.items():
+            self.waiting.setdefault(node, set())
+            for dep in deps:
+                self.waiting.setdefault(dep, set())
+                self.waiting[node].add(dep)
+                self.dependents.setdefault(dep, set()).add(node)
+        self.unfinished = set(self.waiting)
+        self.ready = sorted(n for n, deps in self.waiting.items() if not deps)
+
+    def take_ready(self):
+        """Return the list of nodes that have become ready to start."""
+        ready, self.ready = self.ready, []
+        return ready
+
+    def finish(self, node):
+        """Mark node finished, making ready any nodes only waiting on it."""
+        if node not in self.unfinished:
+            return
+        self.unfinished.discard(node)
+        for dependent in sorted(self.dependents.get(node, ())):
+            deps = self.waiting[dependent]
+            deps.discard(node)
+            if not deps:
+                self.ready.append(dependent)
+
+
+def run_work(worker, workelt):
+    """Call worker.do_work(workelt), catching any exception.
+
+    Returns:
+      [True, results] or [False, message, traceback_text]
+    """
+    try:
+        return [True, worker.do_work(workelt)]
+    except Exception as e:
+        exc_type, exc_value, exc_tb = sys.exc_info()
+        return [False,
+                str(e),
+                ''.join(traceback.format_tb(exc_tb)) + repr(e)]
+
+
+def init_pool_thread():
+    """Prepare a pool thread for calling workers.
+
+    Windows workers use COM (through WMI or win32com), which has to be
+    initialised in each thread that uses it.
+    """
+    if sys.platform == 'win32':
+        import pythoncom
+        pythoncom.CoInitialize()
+
+
+def thread_pool(max_workers):
+    """Return a ThreadPoolExecutor whose threads can call workers."""
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers, initializer=init_pool_thread)
+
+
+# The Update whose worker objects run_work_in_process() uses: one per
+# pool process, so each worker is only made once in each.
+_process_update = None
+
+
+def run_work_in_process(wname, workstr):
+    """Do work for worker wname in a separate process.
+
+    Used by Update.submit() with a process pool: work and results
+    are passed as serialised XML. Worker objects are kept for the
+    life of the process rather than made afresh for every batch.
+    """
+    global _process_update
+    if _process_update is None:
+        _process_update = Update()
+    outcome = run_work(_process_update.worker(wname),
+                       etree.fromstring(workstr))
+    if outcome[0]:
+        outcome[1] = etree.tostring(outcome[1])
+    return outcome
+
 
 class WorkerError(Exception):
     def __init__(self, wname, epy, eol):
@@ -458,6 +1132,15 @@ class WorkerError(Exception):
         return 'Could not load worker "{}" as python module or OL worker:\n\nPython import error:\n{}\n\nOL worker error:\n{}'.format(self.wname, self.epy, self.eol)
 
 
+def takes_paths(worker):
+    """True if worker.generate_status() accepts a paths argument."""
+    try:
+        params = inspect.signature(worker.generate_status).parameters
+    except (AttributeError, TypeError, ValueError):
+        return False
+    return 'paths' in params
+
+
 class OLWorker(object):
     """Other Language Worker: wrapper for workers not in python."""
 
@@ -2,10 +2,13 @@ import pprint
 import sys
 import os
 import errno
-import functools
+import hashlib
+import threading
 from lxml import etree
 from machination.xmldata import from_xml, to_xml
 from machination import context
+from machination.responsecache import ResponseCache
+from machination.responsecache import DEFAULT_TTL, DEFAULT_CALLS
 #from machination.xmltools import pstring
 from machination.cosign import CosignPasswordMgr, CosignHandler
 
@@ -16,22 +19,78 @@ l = context.logger
 # url and http request handling
 try:
     import urllib.request as urllib_request
+    import urllib.error as urllib_error
+    import urllib.parse as urllib_parse
     import http.client as http_client
 except ImportError:
     import urllib2 as urllib_request
+    import urllib2 as urllib_error
+    import urlparse as urllib_parse
     import httplib as http_client
+import io
 import ssl
-#
-# memoisation
-try:
-    getattr(functools, 'lru_cache')
-except AttributeError:
-    from machination import threebits
-    functools.lru_cache = threebits.lru_cache
-
 
 import http.cookiejar
 
+# Calls which only read from the hierarchy. If the connection drops
+# before any answer comes back they can safely be sent again: the
+# server may have acted on a call before it went.
+READ_ONLY_CALLS = frozenset([
+    'AgroupMembers',
+    'AllTypesInfo',
+    'FetchObject',
+    'GetAssertionList',
+    'GetAssertionListIfChanged',
+    'GetLibraryItem',
+    'Help',
+    'ListAttachments',
+    'ListContents',
+    'ServiceConfig',
+    'TypeId',
+    'TypeInfo',
+    ])
+
+# {(keyfile, certfile): [file stamps, SSLContext]}
+_ssl_contexts = {}
+_ssl_contexts_lock = threading.Lock()
+
+def client_ssl_context(keyfile=None, certfile=None):
+    """Return an SSLContext for connecting to a hierarchy.
+
+    With a certfile the context presents that client certificate and
+    (as Machination always has) does not check the server's. Without
+    one it is python's default, verifying context.
+
+    Contexts are cached: making one means reading and parsing the key
+    and certificate, which used to happen for every call. A context is
+    made afresh if keyfile or certfile change (re-registration, say).
+    """
+    stamp = []
+    for fname in (keyfile, certfile):
+        try:
+            st = os.stat(fname)
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except (OSError, TypeError):
+            stamp.append(None)
+    with _ssl_contexts_lock:
+        cached = _ssl_contexts.get((keyfile, certfile))
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        if certfile is None:
+            context = ssl.create_default_context()
+        else:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            try:
+                context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+            except IOError as e:
+                if e.errno == errno.ENOENT:
+                    e.filename = '{} or {}'.format(keyfile, certfile)
+                raise
+        _ssl_contexts[(keyfile, certfile)] = [stamp, context]
+        return context
+
 class HTTPSClientAuthHandler(urllib_request.HTTPSHandler):
     def __init__(self, key, cert):
         urllib_request.HTTPSHandler.__init__(self)
@@ -47,23 +106,12 @@ class HTTPSClientAuthHandler(urllib_request.HTTPSHandler):
     def getConnection(self, host, timeout=None):
         # See if we're using a version of python with ssl.SSLContext
         # (3.2 or above)
-        try:
-            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-        except AttributeError:
-            context = None
-
-        if context:
+        if hasattr(ssl, 'SSLContext'):
             # python >= 3.2
-            context.verify_mode = ssl.CERT_NONE
-            context.load_cert_chain(certfile=self.cert, keyfile=self.key)
-            try:
-                con = http_client.HTTPSConnection(host,
-                                                  context=context,
-                                                  check_hostname=False)
-            except IOError as e:
-                if e.errno == errno.ENOENT:
-                    e.filename = '{} or {}'.format(self.key, self.cert)
-                    raise
+            return http_client.HTTPSConnection(
+                host,
+                context=client_ssl_context(self.key, self.cert)
+                )
         else:
             # python < 3.2
             try:
@@ -77,6 +125,192 @@ class HTTPSClientAuthHandler(urllib_request.HTTPSHandler):
 
         return con
 
+class PooledHTTPSConnection(http_client.HTTPSConnection):
+    """HTTPSConnection which resumes its pool's last TLS session."""
+
+    def __init__(self, host, port=None, pool=None, **kwargs):
+        http_client.HTTPSConnection.__init__(self, host, port, **kwargs)
+        self.pool = pool
+
+    def connect(self):
+        http_client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(
+            self.sock,
+            server_hostname=self.host,
+            session=self.pool.tls_session
+            )
+
+    def save_session(self):
+        """Give our TLS session to the pool for new connections."""
+        # TLS 1.3 session tickets only turn up once there has been
+        # some data, so this is done after each response.
+        if self.sock is not None and self.sock.session is not None:
+            self.pool.tls_session = self.sock.session
+
+    def close(self):
+        # Called before the response body is read if the server said
+        # it will close the connection.
+        self.save_session()
+        http_client.HTTPSConnection.close(self)
+
+class ConnectionPool(object):
+    """Persistent HTTP/1.1 connections to one host.
+
+    urlopen() asks the server to close the connection after every
+    request, so each call to the hierarchy used to pay for a new TCP
+    connection and a full TLS handshake. A ConnectionPool keeps up to
+    maxsize idle connections open for the next request and, for https,
+    remembers the last TLS session so that new connections can resume
+    it rather than doing a full handshake.
+
+    Safe to use from several threads at once: each request has a
+    connection to itself.
+    """
+
+    def __init__(self, scheme, netloc, ssl_context=None, maxsize=4,
+                 timeout=None):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.ssl_context = ssl_context
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.tls_session = None
+        self.idle = []
+        self.lock = threading.Lock()
+        # Connections made, for the curious (and the tests).
+        self.connections = 0
+
+    def new_connection(self):
+        """Return a new, not yet connected, connection to our host."""
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        with self.lock:
+            self.connections += 1
+        if self.scheme == 'https':
+            return PooledHTTPSConnection(self.netloc, pool=self,
+                                         context=self.ssl_context,
+                                         **kwargs)
+        return http_client.HTTPConnection(self.netloc, **kwargs)
+
+    def request(self, method, path, body=None, headers=None, retry=False):
+        """Send a request, return (status, reason, headers, body).
+
+        The server may close an idle connection whenever it likes. With
+        retry=True, a request sent on a reused connection which the
+        server closes before any of the response arrives is sent again
+        on another connection. Only for requests which are safe to
+        repeat: the server may have acted on the first one.
+        """
+        headers = dict(headers or {})
+        while True:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            reused = conn is not None
+            if conn is None:
+                conn = self.new_connection()
+            answered = False
+            try:
+                conn.request(method, path, body, headers)
+                res = conn.getresponse()
+                answered = True
+                data = res.read()
+            except (http_client.BadStatusLine, ConnectionError) as e:
+                conn.close()
+                # A BadStatusLine with a line means some of a response
+                # did arrive (RemoteDisconnected's line is empty).
+                if (retry and reused and not answered and
+                    not getattr(e, 'line', '')):
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+            if self.scheme == 'https':
+                conn.save_session()
+            if res.will_close:
+                conn.close()
+            else:
+                with self.lock:
+                    if len(self.idle) < self.maxsize:
+                        self.idle.append(conn)
+                        conn = None
+                if conn is not None:
+                    conn.close()
+            return res.status, res.reason, res.msg, data
+
+    def close(self):
+        """Close all idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+# {(scheme, netloc, SSLContext): ConnectionPool}
+_pools = {}
+_pools_lock = threading.Lock()
+
+def connection_pool(url, ssl_context=None):
+    """Return the ConnectionPool shared by everything talking to url."""
+    parts = urllib_parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc, ssl_context)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(parts.scheme, parts.netloc,
+                                         ssl_context)
+        return _pools[key]
+
+# Header on hierarchy responses if the server takes batched calls.
+BATCH_HEADER = 'X-Machination-Batch'
+
+class BatchResult(object):
+    """The result of a call in a Batch, once the batch has been sent."""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.result = None
+
+class Batch(object):
+    """Collect calls to send to the hierarchy together.
+
+    with wc.batch() as b:
+        atts = b.call('ListAttachments', path)
+        contents = b.call('ListContents', path)
+    # atts.result and contents.result are now set
+
+    The calls are sent (with WebClient.call_many()) when the with
+    block ends, or when run() is called.
+    """
+
+    def __init__(self, wc):
+        self.wc = wc
+        self.pending = []
+
+    def call(self, name, *args):
+        '''Queue a call of name with *args and return its BatchResult.
+        '''
+        res = BatchResult(name, args)
+        self.pending.append(res)
+        return res
+
+    def run(self):
+        '''Send all the queued calls.
+        '''
+        pending, self.pending = self.pending, []
+        results = self.wc.call_many(
+            [(res.name, res.args) for res in pending]
+            )
+        for res, result in zip(pending, results):
+            res.result = result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.run()
+
 class WebClient(object):
     """Machination WebClient"""
 
@@ -110,6 +344,14 @@ class WebClient(object):
         self.l = context.logger
         self.cookie_file = os.path.join(context.status_dir(), 'cookies.txt')
         self.cookie_jar = None
+        # (keyfile, certfile) for the 'cert' method
+        self.ssl_files = (None, None)
+        # Whether the server takes batched calls (see call_many()).
+        # None until we have heard from it.
+        self.batch_supported = None
+        # Calls which may be sent again after a dropped connection
+        # (see post()).
+        self.read_only_calls = READ_ONLY_CALLS
         handlers = []
 
         if self.authen_type == 'cosign':
@@ -163,6 +405,7 @@ class WebClient(object):
             handlers.append(
                 HTTPSClientAuthHandler(keyfile,certfile)
                 )
+            self.ssl_files = (keyfile, certfile)
 
         elif self.authen_type == 'debug':
             try:
@@ -189,6 +432,14 @@ class WebClient(object):
                 )
 
         self.opener = urllib_request.build_opener(*handlers)
+        self.memo_cache = ResponseCache(**self.memo_cache_config())
+
+        # Calls go over a pool of persistent connections (see
+        # connection_pool()), except for cosign, which needs urllib's
+        # cookie and redirect handling, and when there is a proxy in
+        # the way.
+        self.use_pool = (self.authen_type != 'cosign' and
+                         not self.proxied())
 
     # Convenience method for constructing wc from an etree element.
     @classmethod
@@ -244,34 +495,172 @@ class WebClient(object):
         '''Invoke method name in hierarchy with arguments *args.
         '''
         l.lmsg("calling " + name + " on " + self.url)
-        call_elt = etree.Element("r", call=name)
-        for arg in args:
-            call_elt.append(to_xml(arg))
+        call_elt = self.call_elt(name, *args)
         l.dmsg(etree.tostring(call_elt, pretty_print=True))
 
         # construct and send a request
-        r = urllib_request.Request(
-            self.url,
+        s = self.post(
             etree.tostring(call_elt, encoding=self.encoding),
-            {'Content-Type':
-                 'application/x-www-form-urlencoded;charset=%s' % self.encoding}
-            )
-        urllib_request.install_opener(self.opener)
-        f = urllib_request.urlopen(r)
-        s = f.read().decode(self.encoding)
+            retry=name in self.read_only_calls
+            ).decode(self.encoding)
 #        print("got:\n" + s)
-        elt = etree.fromstring(s)
+        return self.answer(etree.fromstring(s))
+
+    def call_elt(self, name, *args):
+        '''Return the <r> element for a call of name with *args.
+        '''
+        call_elt = etree.Element("r", call=name)
+        for arg in args:
+            call_elt.append(to_xml(arg))
+        return call_elt
+
+    def answer(self, elt):
+        '''Return the python data in answer elt, raising any error in it.
+        '''
         if elt.tag == 'error':
             msg = elt.xpath('message/text()')[0]
             raise Exception('error at the server end:\n' + msg)
-        ret = from_xml(elt)
-        return ret
+        return from_xml(elt)
+
+    def call_many(self, calls):
+        '''Invoke several methods in hierarchy, in one request if possible.
+
+        calls: a list of (name, args) pairs, args being a list or tuple
+          of arguments.
+
+        Returns a list of the results, in order. If any of the calls
+        fail then the exception call() would have raised for the first
+        of them is raised.
+
+        Servers which support it say so in a BATCH_HEADER header on
+        their responses. Calls to other servers are made one by one.
+        '''
+        calls = [(name, tuple(args)) for name, args in calls]
+        if self.batch_supported is False or len(calls) < 2:
+            return [self.call(name, *args) for name, args in calls]
+        l.lmsg("calling {} on {}".format(
+                ', '.join(name for name, args in calls), self.url
+                ))
+        batch_elt = etree.Element("r", call="Batch")
+        for name, args in calls:
+            batch_elt.append(self.call_elt(name, *args))
+        l.dmsg(etree.tostring(batch_elt, pretty_print=True))
+        elt = etree.fromstring(
+            self.post(
+                etree.tostring(batch_elt, encoding=self.encoding),
+                retry=all(name in self.read_only_calls
+                          for name, args in calls)
+                ).decode(self.encoding)
+            )
+        if not self.batch_supported:
+            # We didn't know and it turns out the server can't: it
+            # will have said there is no such call as Batch.
+            return [self.call(name, *args) for name, args in calls]
+        if elt.tag == 'error':
+            self.answer(elt)
+        if elt.tag != 'batch' or len(elt) != len(calls):
+            raise Exception(
+                'expected {} answers to batched call, got:\n{}'.format(
+                    len(calls), etree.tostring(elt).decode(self.encoding)
+                    )
+                )
+        return [self.answer(answer) for answer in elt]
+
+    def batch(self):
+        '''Return a Batch context for collecting calls for call_many().
+        '''
+        return Batch(self)
+
+    def proxied(self):
+        '''Return True if requests to self.url would go via a proxy.
+        '''
+        parts = urllib_parse.urlsplit(self.url)
+        return (parts.scheme in urllib_request.getproxies() and
+                not urllib_request.proxy_bypass(parts.hostname))
+
+    def pool(self):
+        '''Return the ConnectionPool for self.url.
+        '''
+        return connection_pool(self.url, client_ssl_context(*self.ssl_files))
+
+    def post(self, data, retry=False):
+        '''POST data to self.url and return the body of the response.
+
+        Raises urllib.error.HTTPError for anything but a 200 response.
+        With retry=True data may be sent again if a pooled connection
+        is closed before the server answers (see
+        ConnectionPool.request()): only for read only calls.
+        '''
+        headers = {'Content-Type':
+                       'application/x-www-form-urlencoded;charset=%s' %
+                   self.encoding}
+        if not self.use_pool:
+            r = urllib_request.Request(self.url, data, headers)
+            urllib_request.install_opener(self.opener)
+            f = urllib_request.urlopen(r)
+            self.batch_supported = f.headers.get(BATCH_HEADER) is not None
+            return f.read()
+        parts = urllib_parse.urlsplit(self.url)
+        status, reason, msg, body = self.pool().request(
+            'POST', parts.path or '/', data, headers, retry=retry
+            )
+        if status != 200:
+            raise urllib_error.HTTPError(self.url, status, reason, msg,
+                                         io.BytesIO(body))
+        self.batch_supported = msg.get(BATCH_HEADER) is not None
+        return body
 
-    @functools.lru_cache(maxsize=None)
     def memo(self, name, *args):
         '''Invoke method name in hierarchy and memoise results.
+
+        Results are kept in self.memo_cache (see memo_cache_config())
+        for a time which depends on name.
         '''
-        return self.call(name, *args)
+        return self.memo_cache.get(
+            name,
+            etree.tostring(self.call_elt(name, *args)),
+            lambda: self.call(name, *args)
+            )
+
+    def memo_cache_config(self):
+        '''Return ResponseCache keyword arguments from the config.
+
+        Configured by::
+
+          <memo maxEntries="1024" ttl="300" disk="1">
+            <call id="TypeInfo" ttl="3600" disk="1"/>
+          </memo>
+
+        in the __machination__ worker element. ttl is the number of
+        seconds to keep results for, unless overridden for a call
+        (the type information calls have their own defaults: see
+        responsecache.DEFAULT_CALLS). With disk="1" the results of
+        calls marked disk="1" are also kept in context.cache_dir(), so
+        that they outlive the process. Without any memo element,
+        responsecache's defaults are used and nothing is kept on disk.
+        '''
+        config = {}
+        try:
+            melt = context.machination_worker_elt.xpath('memo')[0]
+        except IndexError:
+            return config
+        if melt.get('maxEntries') is not None:
+            config['max_entries'] = int(melt.get('maxEntries'))
+        if melt.get('ttl') is not None:
+            config['ttl'] = float(melt.get('ttl'))
+        config['calls'] = dict(DEFAULT_CALLS)
+        for celt in melt.xpath('call'):
+            config['calls'][celt.get('id')] = [
+                float(celt.get('ttl', config.get('ttl', DEFAULT_TTL))),
+                celt.get('disk') == '1'
+                ]
+        if melt.get('disk') == '1':
+            config['store_dir'] = os.path.join(
+                context.cache_dir(),
+                'memo',
+                hashlib.sha1(self.url.encode('utf-8')).hexdigest()
+                )
+        return config
 
     def help(self):
         return self.call("Help")
@@ -153,7 +153,7 @@ class Worker(object):
             # otherwise all work units will be marked as failures.
             try:
                 results.append(handler(wu))
-            except as e:
+            except Exception as e:
                 # Of course the work unit in which an exception occurs
                 # should be an error.
                 results.append(
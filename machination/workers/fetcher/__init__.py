@@ -458,17 +458,37 @@ class Worker(object):
 
         return res
 
-    def generate_status(self):
+    def generate_status(self, paths=None):
+        """Generate the worker status element.
+
+        If paths (a list of /status/worker[@id='fetcher']/... xpaths)
+        is given, only the config and bundle elements at those paths
+        are generated rather than every bundle in the cache.
+        """
         w_elt = etree.Element("worker")
         w_elt.set("id", self.name)
 
+        if paths is None:
+            want_config = True
+            bundles = self.list_bundles()
+        else:
+            want_config = False
+            bundles = []
+            for path in paths:
+                mrx = MRXpath(path)
+                if mrx.name() == "config":
+                    want_config = True
+                elif mrx.name() == "bundle" and os.path.isdir(
+                    os.path.join(self.cache_dir, mrx.id())):
+                    bundles.append(mrx.id())
+
         # First subelement is config
-        if len(self.config_elt):
+        if want_config and len(self.config_elt):
             w_elt.append(self.config_elt)
 
         # Loop through bundle elements.
 
-        for bundle in self.list_bundles():
+        for bundle in bundles:
             if bundle[0] == ".":
               continue
 
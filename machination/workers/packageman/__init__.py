@@ -46,7 +46,6 @@ class Worker(object):
         "Process the work units and return their status."
         result = []
 
-        pref_mrx = MRXpath("/status/worker[@id='packageman']")
         for wu in work_list:
             if wu[0].tag != "package":
                 msg = "Work unit of type: " + wu[0].tag
@@ -60,9 +59,10 @@ class Worker(object):
             operator = "_{}".format(wu.attrib["op"])
             res = getattr(self, operator)(wu)
             if res.attrib["status"] == "success":
-                self.s_elt = xmltools.apply_wu(wu,
-                                               self.s_elt,
-                                               prefix=pref_mrx)
+                # Later work looks at s_elt: keep it up to date in
+                # place. It is the packageman worker element, so its
+                # parent is /status.
+                xmltools.apply_wus([wu], self.s_elt, prefix="/status")
             result.append(res)
         self._write_status()
         return result
@@ -32,7 +32,9 @@ import sys
 import shlex
 from machination import context
 from machination import utils
+from machination import statusfile
 import hashlib
+import pickle
 
 l = context.logger
 
@@ -43,34 +45,60 @@ except AttributeError:
     from machination import threebits
     functools.lru_cache = threebits.lru_cache
 
+# Merkle hashes of subtrees are stored in this attribute (see mhash())
+HASH_NS = 'https://github.com/machination/ns/hash'
+HASH_ATT = '{%s}hash' % HASH_NS
+
 def mc14n(elt):
     '''Machination canonicalization
 
-    Mostly strip ignorable white space from data elements'''
+    Mostly strip ignorable white space from data elements: comments
+    and tails are removed, as is the text of any element which has
+    children. The work is done by statusfile.canonicalize().'''
 
-    # Make sure we are working on an element
-    if isinstance(elt, etree._ElementTree):
-        elt = elt.getroot()
+    return statusfile.canonicalize(elt)
 
-    # Strip comments
-    if isinstance(elt, etree._Comment):
-        elt.getparent().remove(elt)
+def mhash(elt, trust_stored=False):
+    '''Calculate and store Merkle style hashes for elt and descendants.
 
-    # No tails (not for /local/ people)
-    elt.tail = None
+    The hash of an element covers its tag, attributes (apart from the
+    hash itself), text and the hashes of its element children in
+    order. Hashes are stored in the HASH_ATT attribute so that they
+    are written out with status files and XMLCompare can skip
+    subtrees which are identical on both sides.
 
-    # C14n of children
-    children = 0
-    for e in elt.iterchildren():
-        mc14n(e)
-        children = children + 1
+    Hashes should be calculated after mc14n() and recalculated after
+    any change to the tree: a stale hash will hide real differences.
 
-    # If elt has any children then it can't be a text element. Note
-    # this include comment children => no comments in text bearing
-    # elements.
-    if children:
-        elt.text = None
+    Args:
+      elt: an etree Element or ElementTree
+      trust_stored(=False): reuse hashes already stored on descendants
+        of elt instead of recalculating them. The hash of elt itself
+        is always recalculated.
+
+    Returns:
+      the hash of elt as a hex string
+    '''
+    if isinstance(elt, etree._ElementTree):
+        elt = elt.getroot()
 
+    atts = [(k, v) for k, v in sorted(elt.items()) if k != HASH_ATT]
+    h = hashlib.sha1(repr((elt.tag, atts, elt.text)).encode('utf8'))
+    for child in elt.iterchildren(tag=etree.Element):
+        chash = child.get(HASH_ATT) if trust_stored else None
+        if chash is None:
+            chash = mhash(child, trust_stored)
+        h.update(chash.encode('ascii'))
+    digest = h.hexdigest()
+    elt.set(HASH_ATT, digest)
+    return digest
+
+def strip_hashes(elt):
+    '''Remove any stored Merkle hashes from elt and its descendants.'''
+    if isinstance(elt, etree._ElementTree):
+        elt = elt.getroot()
+    etree.strip_attributes(elt, HASH_ATT)
+    etree.cleanup_namespaces(elt)
     return elt
 
 def pstring_old(e, top=True, depth=0, istring='  '):
@@ -102,7 +130,7 @@ def pstring(e):
     return etree.tostring(e, pretty_print = True).decode()
 
 
-def generate_wus(todo, comp, orderstyle="move"):
+def generate_wus(todo, comp, orderstyle="move", keep_working=True):
     """Return a list of workunits from todo list guided by template.
 
     Args:
@@ -122,18 +150,34 @@ def generate_wus(todo, comp, orderstyle="move"):
     move: move(tag1[id1],tag2[id2]) - move tag1[id1] after tag2[id2].
     removeadd: remove(tag1[id1]) followed by add(tag1[id1],tag2[id2]).
     swap: swap(tag1[id1],tag2[id2]).
+    keep_working: return a copy of the working element. Callers only
+    interested in the work units should set this to False.
 
     Returns:
-    a list of work unit (wu) elements
-
-    Side Effects:
-    ``working`` will be altered to the nearest desired status that
-    ``todo`` allows. This is usually the desired status within
-    the current independent work set.
+    (wus, working): a list of work unit (wu) elements and the working
+    element altered to the nearest desired status that ``todo``
+    allows (None if keep_working is False). This is usually the
+    desired status within the current independent work set.
+
+    The changes are worked out on ``comp.leftxml`` itself through a
+    TreeJournal and undone before returning: neither ``comp.leftxml``
+    nor ``comp.rightxml`` is copied or left altered.
     """
 
-    working = copy.deepcopy(comp.leftxml)
-    template = copy.deepcopy(comp.rightxml)
+    journal = TreeJournal()
+    try:
+        wus, working = _generate_wus(todo, comp, journal, keep_working)
+    finally:
+        journal.rollback()
+    return wus, working
+
+
+def _generate_wus(todo, comp, journal, keep_working):
+    """Do the work for generate_wus(), changing comp.leftxml via journal."""
+    working = comp.leftxml
+    template = comp.rightxml
+    windex = MRXIndex(working)
+    tindex = MRXIndex(template)
     wds = comp.wds()
 #        actions = comp.actions(comp.bystate['datadiff'])
 #        actions = {'remove': todo & comp.bystate['left'],
@@ -144,22 +188,31 @@ def generate_wus(todo, comp, orderstyle="move"):
     wus = []
 
     # removes
+    # Find and copy every element to remove before taking any out of
+    # working: a worker removed first would take the work units inside
+    # it with it.
+    removed = []
     for rx in comp.actions()['remove'] & todo:
-        rx = MRXpath(rx)
+        rx = FrozenMRXpath(rx)
         wd = wds[rx.workername("/status")]
         # todo should always be workunits
         if not wd.is_workunit(rx):
             raise Exception('Trying to remove %s, which is not a work unit'
                             % rx.to_xpath())
-        for e in working.xpath(rx.to_xpath()):
-            e.getparent().remove(e)
+        e = resolve(windex, rx)
         # <wu op="remove" id="rx"/>
         l.dmsg('generating remove for {}'.format(rx.to_xpath()))
-        wus.append(E.wu(copy.deepcopy(e), op="remove", id=rx.to_xpath()))
+        wu = E.wu(op="remove", id=rx.to_xpath())
+        if e is not None:
+            wu.append(copy.deepcopy(e))
+            removed.append(e)
+        wus.append(wu)
+    for e in removed:
+        journal.remove(e)
 
     # data only modified
     for mx in comp.actions()['datamod'] & todo:
-        mx = MRXpath(mx)
+        mx = FrozenMRXpath(mx)
         wd = wds[mx.workername("/status")]
         # every action should be a valid work unit
         if not wd.is_workunit(mx):
@@ -167,14 +220,13 @@ def generate_wus(todo, comp, orderstyle="move"):
                             % mx.to_xpath())
         # alter the working XML
         # find the element to modify
-        try:
-            e = working.xpath(mx.to_xpath())[0]
-            te = template.xpath(mx.to_xpath())[0]
-        except IndexError:
+        e = resolve(windex, mx)
+        te = resolve(tindex, mx)
+        if e is None or te is None:
             # no results
             raise Exception("could not find %s in working or template " %
                             mx.to_abbrev_xpath())
-        e.text = te.text
+        journal.set_text(e, te.text)
         # generate wu
         wus.append(
             E.wu(copy.deepcopy(e), op="datamod", id=mx.to_xpath())
@@ -203,7 +255,7 @@ def generate_wus(todo, comp, orderstyle="move"):
     #    = remove element from working
 
     for mx in comp.actions()['deepmod'] & todo:
-        mx = MRXpath(mx)
+        mx = FrozenMRXpath(mx)
         wd = wds[mx.workername("/status")]
         # every action should be a valid work unit
         if not wd.is_workunit(mx):
@@ -211,18 +263,18 @@ def generate_wus(todo, comp, orderstyle="move"):
                             % mx.to_xpath())
         # alter the working XML
         # find the element to modify
-        # We might reject the mod, so we need to work on a copy of working
-        w2 = copy.deepcopy(working)
-        try:
-            e = w2.xpath(mx.to_xpath())[0]
-            te = template.xpath(mx.to_xpath())[0]
-        except IndexError:
+        # We might reject the mod: remember where to roll back to
+        mark = journal.mark()
+        e = resolve(windex, mx)
+        te = resolve(tindex, mx)
+        if e is None or te is None:
             # no results
             raise Exception("could not find %s in working or template " %
                             mx.to_abbrev_xpath())
 
         e_to_remove = set()
         e_removed = set()
+        e_subwus = set()
         e_to_move = {}
         elts_changed = False
         atts_changed = False
@@ -240,18 +292,17 @@ def generate_wus(todo, comp, orderstyle="move"):
                 continue
 
             if wd.find_workunit(se_mrx) != wd.find_workunit(mx):
-                # se must have a more specific workunit than mx,
-                # remove from working - another workunit is in charge
+                # se must have a more specific workunit than mx:
+                # another workunit is in charge. Leave it in working
+                # for that workunit but keep it out of this one.
 #                l.dmsg('deepmod more specific work unit for ' + se_mrx.to_xpath(), 10)
-                e_to_remove.add(se_mrx.to_xpath())
+                e_subwus.add(se_mrx.to_xpath())
                 e_removed.add(se_mrx.to_xpath())
                 continue
 
             # find equivalent element from template.
-            try:
-                ste = template.xpath(se_mrx.to_xpath())[0]
-#                l.dmsg('deepmod found {} in template'.format(se_mrx.to_xpath()))
-            except IndexError:
+            ste = resolve(tindex, se_mrx)
+            if ste is None:
                 # xpath doesn't exist in template, remove
                 elts_changed = True
                 e_to_remove.add(se_mrx.to_xpath())
@@ -263,19 +314,19 @@ def generate_wus(todo, comp, orderstyle="move"):
                 if k in ste.keys():
                     if se.get(k) != ste.get(k):
                         atts_changed = True
-                        se.set(k, ste.get(k))
+                        journal.set(se, k, ste.get(k))
                 else:
                     atts_changed = True
-                    del se.attrib[k]
+                    journal.delete(se, k)
             for k in ste.keys():
                 if k not in se.keys():
                     atts_changed = True
-                    se.set(k, ste.get(k))
+                    journal.set(se, k, ste.get(k))
 
             # change any different text
             if se.text != ste.text:
                 text_changed = True
-                se.text = ste.text
+                journal.set_text(se, ste.text)
 
             if se_mrx.to_xpath() in comp.bystate['orderdiff']\
                     and e != se:
@@ -283,33 +334,31 @@ def generate_wus(todo, comp, orderstyle="move"):
                 elts_changed = True
                 context.logger.dmsg('moving {} subelement {}'.
                                     format(mx.to_xpath(), se_mrx.to_xpath()))
-                prevwe = closest_shared_previous(w2,
-                                                 template,
+                prevwe = closest_shared_previous(windex,
+                                                 tindex,
                                                  se_mrx)
                 if prevwe is None:
                     parent_mrx = MRXpath(ste.getparent())
-                    parent = w2.xpath(parent_mrx.to_xpath())[0]
+                    parent = resolve(windex, parent_mrx)
                     index = 0
                 else:
                     parent = se.getparent()
                     index = parent.index(prevwe) + 1
-                e_to_move[se_mrx.to_xpath] = [se, index]
+                e_to_move[se_mrx.freeze()] = [se, index]
 
         for xp in e_to_remove:
-            rem = e.xpath(xp)[0]
-            rem.getparent().remove(rem)
+            journal.remove(resolve(windex, xp))
 
-        for xp in e_to_move:
-            se, index = e_to_move[xp]
+        for smx in e_to_move:
+            se, index = e_to_move[smx]
             parent = se.getparent()
-            parent.remove(se)
-            parent.insert(index, se)
+            journal.remove(se)
+            journal.insert(parent, index, se)
 
         for ste in te.iter(tag=etree.Element):
             ste_mrx = MRXpath(ste)
-            try:
-                se = w2.xpath(ste_mrx.to_xpath())[0]
-            except IndexError:
+            se = resolve(windex, ste_mrx)
+            if se is None:
                 # ste doesn't exist in working.
 
                 # Don't add if ste is a work unit
@@ -327,21 +376,21 @@ def generate_wus(todo, comp, orderstyle="move"):
 
                 # find the first previous xpath that also exists
                 # in working
-                prevwe = closest_shared_previous(w2,
-                                                 template,
-                                                 MRXpath(ste))
+                prevwe = closest_shared_previous(windex,
+                                                 tindex,
+                                                 ste_mrx)
 
                 # We can just add to working because we aren't
                 # iterating over part of it
                 if prevwe is None:
                     parent_mrx = MRXpath(ste.getparent())
-                    wep = w2.xpath(parent_mrx.to_xpath())[0]
+                    wep = resolve(windex, parent_mrx)
                     index = 0
                 else:
                     wep = prevwe.getparent()
                     index = wep.index(prevwe) + 1
                 elts_changed = True
-                wep.insert(index, add)
+                journal.insert(wep, index, add)
             else:
                 continue
 
@@ -349,12 +398,15 @@ def generate_wus(todo, comp, orderstyle="move"):
         l.dmsg('Checking changes for deepmod {}'.format(mx.to_xpath()), 10)
         if elts_changed or atts_changed or text_changed:
             l.dmsg('Adding deepmod {}'.format(mx.to_xpath()), 10)
-            old_elt = working.xpath(mx.to_xpath())[0]
-            new_elt = w2.xpath(mx.to_xpath())[0]
-            old_elt.getparent().replace(old_elt, new_elt)
+            submark = journal.mark()
+            for xp in e_subwus:
+                journal.remove(resolve(windex, xp))
             wus.append(
                 E.wu(copy.deepcopy(e), op="deepmod", id=mx.to_xpath())
                 )
+            journal.rollback(submark)
+        else:
+            journal.rollback(mark)
 
     # add and reorder
     # iterate over elements in template and see if working needs them
@@ -363,8 +415,8 @@ def generate_wus(todo, comp, orderstyle="move"):
         tmrx = MRXpath(te)
         if tmrx.to_xpath() not in todo:
             continue
-        welts = working.xpath(tmrx.to_xpath())
-        if welts:
+        welt = resolve(windex, tmrx)
+        if welt is not None:
             # there is a corresponding element in working, check if it
             # is in the right position
 
@@ -384,23 +436,23 @@ def generate_wus(todo, comp, orderstyle="move"):
                     continue
 
             # no move needed if previous for welts[0] and te are the same
-            if MRXpath(te.getprevious()) == MRXpath(welts[0].getprevious()):
+            if MRXpath(te.getprevious()) == MRXpath(welt.getprevious()):
                 continue
 
             # find the first previous element that also exists in working
-            prev = closest_shared_previous(working,
-                                           template,
+            prev = closest_shared_previous(windex,
+                                           tindex,
                                            tmrx)
             # find the parent from working
-            wparent = working.xpath(tmrx.parent().to_xpath())[0]
+            wparent = resolve(windex, tmrx.parent())
             if prev is None:
                 # move to first child
-                wparent.insert(0, welts[0])
+                journal.insert(wparent, 0, welt)
                 # remember position for wu
                 pos = "<first>"
             else:
                 # insert after prev
-                wparent.insert(wparent.index(prev) + 1, welts[0])
+                journal.insert(wparent, wparent.index(prev) + 1, welt)
                 pos = MRXpath(prev)[-1].to_xpath()
 
             # generate a work unit
@@ -449,9 +501,8 @@ def generate_wus(todo, comp, orderstyle="move"):
 #                wparent = child
 
             # can't add to a parent that doesn't exist
-            try:
-                wparent = working.xpath(tmrx.parent().to_xpath())[0]
-            except IndexError:
+            wparent = resolve(windex, tmrx.parent())
+            if wparent is None:
                 raise Exception("trying to add " + tmrx.to_xpath() +
                                 " but its parent does not exist")
 
@@ -459,25 +510,25 @@ def generate_wus(todo, comp, orderstyle="move"):
             add_elt = copy.deepcopy(te)
             # strip out any sub work units - they should be added later
             for subadd in add_elt.iterdescendants():
-                sub_mrx = MRXpath(subadd)
-                sub_mrx[:0] = tmrx
-                del sub_mrx.rep[0]
+                # path of subadd relative to add_elt, grafted onto tmrx
+                sub_mrx = MRXpath._from_rep(tmrx.rep +
+                                            MRXpath(subadd).rep[2:])
                 if wd.is_workunit(sub_mrx):
                     # is a workunit: remove
                     subadd.getparent().remove(subadd)
 
             # find the first previous element that also exists in working
-            prev = closest_shared_previous(working,
-                                           template,
+            prev = closest_shared_previous(windex,
+                                           tindex,
                                            tmrx)
 
             if prev is None:
                 # add as first child
-                wparent.insert(0, add_elt)
+                journal.insert(wparent, 0, add_elt)
                 pos = "<first>"
             else:
                 # add after wprev[0]
-                wparent.insert(wparent.index(prev) + 1, add_elt)
+                journal.insert(wparent, wparent.index(prev) + 1, add_elt)
                 pos = MRXpath(prev)[-1].to_xpath()
 
             # generate a work unit
@@ -488,21 +539,103 @@ def generate_wus(todo, comp, orderstyle="move"):
                      pos=pos)
                 )
 
+    # Copied elements carry stored hashes which will be stale after
+    # the changes above and mean nothing to workers.
+    for wu in wus:
+        strip_hashes(wu)
+    if keep_working:
+        working = strip_hashes(copy.deepcopy(working))
+    else:
+        working = None
+
     # these are the droids you are looking for...
     return wus, working
 
 
+class TreeJournal(object):
+    """Record changes made to element trees so they can be undone.
+
+    generate_wus() alters its working tree through a TreeJournal
+    instead of altering copies: a rejected change, or everything done
+    in a pass, can be rolled back without cloning the document.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def mark(self):
+        """return a marker to pass to rollback()"""
+        return len(self.entries)
+
+    def set(self, elt, key, value):
+        """set attribute key of elt to value"""
+        self.entries.append(['att', elt, key, elt.get(key)])
+        elt.set(key, value)
+
+    def delete(self, elt, key):
+        """delete attribute key from elt"""
+        self.entries.append(['att', elt, key, elt.get(key)])
+        del elt.attrib[key]
+
+    def set_text(self, elt, text):
+        """set text of elt"""
+        self.entries.append(['text', elt, elt.text])
+        elt.text = text
+
+    def remove(self, elt):
+        """remove elt from its parent"""
+        parent = elt.getparent()
+        self.entries.append(['place', elt, parent, parent.index(elt)])
+        parent.remove(elt)
+
+    def insert(self, parent, index, elt):
+        """insert elt (new or moved from elsewhere) into parent at index"""
+        old = elt.getparent()
+        self.entries.append(
+            ['place', elt, old, None if old is None else old.index(elt)]
+            )
+        parent.insert(index, elt)
+
+    def rollback(self, mark=0):
+        """undo changes (most recent first) back to mark"""
+        while len(self.entries) > mark:
+            entry = self.entries.pop()
+            elt = entry[1]
+            if entry[0] == 'att':
+                if entry[3] is None:
+                    del elt.attrib[entry[2]]
+                else:
+                    elt.set(entry[2], entry[3])
+            elif entry[0] == 'text':
+                elt.text = entry[2]
+            else:
+                if elt.getparent() is not None:
+                    elt.getparent().remove(elt)
+                if entry[2] is not None:
+                    entry[2].insert(entry[3], elt)
+
+
 def closest_shared_previous(working, template, xp):
-    """find the closest sibling in working that is prior to xpath xp in template"""
-    xp = MRXpath(xp)
-    prevte = template.xpath(xp.to_xpath())[0].getprevious()
+    """find the closest sibling in working that is prior to xpath xp in template
+
+    working and template may be elements or MRXIndex objects (see
+    resolve()).
+    """
+    prevte = resolve(template, xp).getprevious()
     while prevte is not None:
-        prevwes = working.xpath(MRXpath(prevte).to_xpath())
-        if prevwes:
-            return prevwes[0]
+        prevwe = resolve(working, MRXpath(prevte))
+        if prevwe is not None:
+            return prevwe
         prevte = prevte.getprevious()
     return None
 
+def _xpath_step(elt):
+    """Return the last step of MRXpath(elt).to_xpath() for element elt"""
+    if 'id' in elt.keys():
+        return "%s[@id='%s']" % (elt.tag,
+                                 MRXpath.quote_id(MRXpath, elt.get('id')))
+    return elt.tag
+
 def strip_prefix(string, prefix = None):
     """Strip a prefix from a string.
 
@@ -551,13 +684,16 @@ def get_fullpos(pos, parent_mrx):
     fullpos.append(pos)
     return fullpos.to_xpath()
 
-def _addpos_to_index(fullpos, stelt, add_map):
+def _addpos_to_index(fullpos, find, add_map):
+    """Return the index to add at for full position xpath fullpos.
+
+    find is a function returning the element at a full xpath or None.
+    """
     if fullpos == '<first>':
         return 0
     # try to find the element corresponding to pos
-    try:
-        prev = stelt.xpath(fullpos)[0]
-    except IndexError:
+    prev = find(fullpos)
+    if prev is None:
         # Uh oh - couldn't find element at pos. That probably
         # means it was supposed to be added by a previous work
         # unit that failed, or some add workunits are being applied
@@ -568,9 +704,9 @@ def _addpos_to_index(fullpos, stelt, add_map):
             raise IndexError('No {} element found and no add_map'.format(fullpos))
         newpos = add_map.get(fullpos)
         if newpos:
-            return _addpos_to_index(newpos, stelt, add_map)
+            return _addpos_to_index(newpos, find, add_map)
         else:
-            raise IndexError('No pos found after following add_map:\n'.format(pprint.pformat(add_map)))
+            raise IndexError('No pos found after following add_map:\n{}'.format(pprint.pformat(add_map)))
     return prev.getparent().index(prev) + 1
 
 def apply_wu(wu, stelt, prefix = None, add_map = None):
@@ -579,25 +715,82 @@ def apply_wu(wu, stelt, prefix = None, add_map = None):
     Arguments:
       wu: work unit element
       stelt: status element
+      prefix: MRXpath of the parent of stelt if stelt is not the
+        status element (see apply_wus())
+      add_map: see apply_wus()
     Returns:
       copy of status element with wu applied
     """
-    if prefix:
-        prefix = MRXpath(prefix)
-    stelt = add_prefix_elts(copy.deepcopy(stelt), prefix)
+    return apply_wus([wu], copy.deepcopy(stelt), prefix, add_map)
+
+def apply_wus(wus, stelt, prefix = None, add_map = None):
+    """Apply work units, in order, to a status element in place.
+
+    Unlike apply_wu() nothing is copied: stelt itself is changed, so
+    applying N work units costs N lookups rather than N copies of the
+    document. Elements are found through an MRXIndex of stelt.
+
+    Arguments:
+      wus: iterable of work unit elements
+      stelt: status element to change
+      prefix: MRXpath of the parent of stelt if stelt is not the
+        status element. For example a worker can keep its own
+        ``<worker id="name">`` element up to date with prefix
+        '/status'.
+      add_map: {wu_id: fullpos} recording where each add was meant to
+        go. Used to find a place for an add when its previous
+        sibling is missing (a previous add failed or adds are being
+        applied out of order).
+    Returns:
+      stelt
+    """
+    index = MRXIndex(stelt)
+    prefix_rep = MRXpath(prefix).rep if prefix else None
+    # rooted reps start with ('',), then the prefix steps
+    base = len(prefix_rep) if prefix else 1
+
+    def local_rep(mrx):
+        # steps from stelt to the node at full MRXpath mrx
+        rep = MRXpath(mrx).rep
+        if prefix and rep[:base] != prefix_rep:
+            return None
+        top = rep[base:base + 1]
+        if(not top or top[0][0] != stelt.tag or
+           (len(top[0]) > 1 and top[0][1] != stelt.get('id'))):
+            return None
+        return rep[base + 1:]
+
+    def find(mrx):
+        rep = local_rep(mrx)
+        if rep is None:
+            return None
+        if not rep:
+            return stelt
+        return index.resolve(MRXpath._from_rep(rep))
+
+    for wu in wus:
+        _apply_one_wu(wu, stelt, find, add_map)
+    return stelt
+
+def _apply_one_wu(wu, stelt, find, add_map):
+    """Apply wu to stelt in place for apply_wus()."""
     xpath = wu.get('id')
     op = wu.get('op')
     if op == 'add':
         parent_mrx = MRXpath(xpath).parent()
-        parent_elt = stelt.xpath(parent_mrx.to_xpath())[0]
+        parent_elt = find(parent_mrx)
+        if parent_elt is None:
+            raise IndexError('No {} element found'.format(parent_mrx))
     else:
-        tgt_elt = stelt.xpath(xpath)[0]
+        tgt_elt = find(xpath)
+        if tgt_elt is None:
+            raise IndexError('No {} element found'.format(xpath))
         parent_elt = tgt_elt.getparent()
     if op == 'add':
         # The element to add is in wu[0]
         pos = wu.get('pos')
         parent_elt.insert(
-            _addpos_to_index(get_fullpos(pos, parent_mrx), stelt, add_map),
+            _addpos_to_index(get_fullpos(pos, parent_mrx), find, add_map),
             copy.deepcopy(wu[0])
             )
     elif op == 'remove':
@@ -609,35 +802,156 @@ def apply_wu(wu, stelt, prefix = None, add_map = None):
         if pos == '<first>':
             parent_elt.insert(0, tgt_elt)
         else:
-            prev = stelt.xpath(strip_prefix(pos, strip))[0]
+            # pos is the last step of the previous sibling's xpath
+            prev = resolve(parent_elt, pos)
+            if prev is None:
+                raise IndexError('No {} element found to move {} after'.
+                                 format(pos, xpath))
             parent_elt.insert(
                 parent_elt.index(prev) + 1,
                 tgt_elt
                 )
     elif op == 'deepmod':
         mrx = MRXpath(xpath)
-        orig_elt = stelt.xpath(xpath)[0]
-        new_top = add_prefix_elts(copy.deepcopy(wu[0]), mrx.parent())
-        new_elt = new_top.xpath(xpath)[0]
+        new_elt = copy.deepcopy(wu[0])
         wd = WorkerDescription(mrx.workername('/status'), '/status')
+        depth = len(MRXpath(tgt_elt).rep)
+        restored = set()
 
-        for elt in orig_elt.iter(tag = etree.Element):
-            elt_mrx = MRXpath(elt)
-            # All workunit elements in orig_elt but not in new_elt
+        for elt in tgt_elt.iterdescendants(tag = etree.Element):
+            if elt.getparent() in restored:
+                restored.add(elt)
+                continue
+            rel = MRXpath(elt).rep[depth:]
+            # All workunit elements in tgt_elt but not in new_elt
             # should be added back in (they were stripped when the
-            # deepmod was created).
-            #
-            # TODO(colin): preserve the original order
-#            print(elt_mrx.to_xpath())
-            if wd.is_workunit(elt_mrx) and not new_top.xpath(elt_mrx.to_xpath()):
-                new_elt.append(copy.deepcopy(elt))
+            # deepmod was created), in their original place.
+            if(not wd.is_workunit(MRXpath._from_rep(mrx.rep + rel)) or
+               _walk_mrx(new_elt, rel, _find_child) is not None):
+                continue
+            restored.add(elt)
+            new_parent = new_elt
+            if len(rel) > 1:
+                new_parent = _walk_mrx(new_elt, rel[:-1], _find_child)
+                if new_parent is None:
+                    # original parent has gone: best we can do
+                    new_parent = new_elt
+            pos = 0
+            prev = elt.getprevious()
+            while prev is not None:
+                if isinstance(prev.tag, str):
+                    new_prev = _walk_mrx(new_parent,
+                                         MRXpath(prev).rep[-1:],
+                                         _find_child)
+                    if new_prev is not None:
+                        pos = new_parent.index(new_prev) + 1
+                        break
+                prev = prev.getprevious()
+            new_parent.insert(pos, copy.deepcopy(elt))
         # now the deepmod element should represent the new state
-        parent_elt.replace(orig_elt, new_elt)
+        parent_elt.replace(tgt_elt, new_elt)
+
+# Characters that may not appear in an unquoted name or id.
+_MRX_SPECIAL = frozenset("/[]@='\"")
+
+
+def _mrx_error(path, pos, msg):
+    return Exception("bad MRXpath %r at position %d: %s" % (path, pos, msg))
+
+
+def _mrx_bare(path, pos):
+    """Scan an unquoted name or id starting at pos, return (text, end)"""
+    end = pos
+    n = len(path)
+    while end < n and path[end] not in _MRX_SPECIAL and not path[end].isspace():
+        end += 1
+    return path[pos:end], end
+
+
+def _mrx_quoted(path, pos):
+    """Scan a quoted string starting at pos, return (text, end)"""
+    quote = path[pos]
+    chars = []
+    i = pos + 1
+    n = len(path)
+    while i < n:
+        c = path[i]
+        if c == '\\' and i + 1 < n:
+            chars.append(path[i + 1])
+            i += 2
+        elif c == quote:
+            return ''.join(chars), i + 1
+        else:
+            chars.append(c)
+            i += 1
+    raise _mrx_error(path, pos, "unterminated quoted string")
+
+
+@functools.lru_cache(maxsize=10000)
+def _parse_mrxpath(path):
+    """Parse an MRXpath string into a tuple representation.
+
+    Single pass over the string. Results are cached, so parsing the
+    same path again returns the same (shared, immutable) tuple.
+    """
+    rep = []
+    n = len(path)
+    pos = 0
+    if path.startswith('/'):
+        rep.append(('',))
+        pos = 1
+    elif not path:
+        return ()
+    while True:
+        if rep and rep[-1][0].startswith('@'):
+            raise _mrx_error(path, pos,
+                             "cannot add more to an attribute xpath")
+        if pos < n and path[pos] == '@':
+            name, pos = _mrx_bare(path, pos + 1)
+            if not name:
+                raise _mrx_error(path, pos, "expecting an attribute name")
+            rep.append(('@' + name,))
+        else:
+            name, pos = _mrx_bare(path, pos)
+            if not name:
+                raise _mrx_error(path, pos, "expecting an element name")
+            if pos < n and path[pos] == '[':
+                pos += 1
+                if pos < n and path[pos] == '@':
+                    # [@id='something']
+                    att, pos = _mrx_bare(path, pos + 1)
+                    if att != 'id':
+                        raise _mrx_error(path, pos,
+                                         "only @id may be used in a predicate")
+                    if pos >= n or path[pos] != '=':
+                        raise _mrx_error(path, pos, "expecting '='")
+                    pos += 1
+                    if pos >= n or path[pos] not in '\'"':
+                        raise _mrx_error(path, pos,
+                                         "expecting a quoted id")
+                    idname, pos = _mrx_quoted(path, pos)
+                elif pos < n and path[pos] in '\'"':
+                    # ['something']
+                    idname, pos = _mrx_quoted(path, pos)
+                else:
+                    # [something]
+                    idname, pos = _mrx_bare(path, pos)
+                    if not idname:
+                        raise _mrx_error(path, pos, "expecting an id")
+                if pos >= n or path[pos] != ']':
+                    raise _mrx_error(path, pos, "expecting ']'")
+                pos += 1
+                rep.append((name, idname))
+            else:
+                rep.append((name,))
+        if pos >= n:
+            break
+        if path[pos] != '/':
+            raise _mrx_error(path, pos,
+                             "unexpected character %r" % path[pos])
+        pos += 1
+    return tuple(rep)
 
-    if prefix:
-        return stelt.xpath(prefix.to_xpath())[0][0]
-    else :
-        return stelt
 
 class MRXpath(object):
     """Manipulate Machination restricted xpaths.
@@ -656,36 +970,24 @@ class MRXpath(object):
 
     b[id1]/c
 
+    MRXpath objects can be changed in place. Use :meth:`freeze` (or
+    :class:`FrozenMRXpath`) to get an immutable version suitable for
+    use as a dictionary key or set member.
     """
 
-    # A quick lexer, trick found at
-    # http://www.evanfosmark.com/2009/02/sexy-lexing-with-python/
-    # Thanks for your article Evan
-    def token_qstring(scanner, token):
-        token = re.sub(r'\\(.)', r'\1', token)
-        return "QSTRING", token[1:-1]
-    def token_sep(scanner, token): return "SEP", token
-    def token_bracket(scanner, token): return "BRACKET", token
-    def token_op(scanner, token): return "OP", token
-    def token_at(scanner, token): return "AT", token
-    def token_name_or_id(scanner, token):
-        if re.search(token, r'[\.]'):
-            return "ID", token
-        else:
-            return "NAME", token
-
-    scanner = re.Scanner([
-            ("'(?:\\\\.|[^'])*'|\"(?:\\\\.|[^\"])*\"", token_qstring),
-            (r"/", token_sep),
-            (r"[\[\]]", token_bracket),
-            (r"=", token_op),
-            (r"@", token_at),
-            (r"[\{\}\w\*\.]*", token_name_or_id),
-            ])
+    __slots__ = ('rep', 'xp_cache')
 
     def __init__(self, path=None, att=None):
         self.set_path(path, att)
 
+    @classmethod
+    def _from_rep(cls, rep):
+        """Make an MRXpath directly from a tuple representation"""
+        mrx = cls.__new__(cls)
+        mrx.rep = rep
+        mrx.xp_cache = None
+        return mrx
+
     def set_path(self, path, att=None):
         """Set representation based on ``path``
 
@@ -698,33 +1000,25 @@ class MRXpath(object):
         attributes::
           set_path("/path/to/@attribute")
           set_path(etree_element,att="attribute_name")
+
+        The representation is a tuple of tuples, one per step:
+        ``('',)`` for the root, ``(name,)`` or ``(name, id)`` for
+        elements and ``('@name',)`` for attributes. String paths are
+        parsed by a cached parser, so repeated paths share their
+        representation.
         """
         self._clear_cache()
         if path is None:
-            self.rep = []
+            self.rep = ()
             return
 
-        if isinstance(path, list):
-            self.rep = copy.deepcopy(path)
+        if isinstance(path, str):
+            self.rep = _parse_mrxpath(path)
         elif isinstance(path, MRXpath):
-            # clone another MRXpath
-            self.rep = path.clone_rep()
-        elif isinstance(path, str):
-            # a string, break it up and store the pieces
-            self.rep = []
-            tokens, remainder = MRXpath.scanner.scan(path)
-            if tokens[0][0] == "SEP":
-                # rooted xpath, need an empty name to start
-                working = [('NAME', '')]
-            else:
-                working = []
-            for token in tokens:
-                if token[0] == "SEP":
-                    self.rep.append(self.tokens_to_rep(working))
-                    working = []
-                else:
-                    working.append(token)
-            self.rep.append(self.tokens_to_rep(working))
+            # representation is immutable, so it can be shared
+            self.rep = path.rep
+        elif isinstance(path, (list, tuple)):
+            self.rep = tuple(tuple(item) for item in path)
         elif isinstance(path, etree._Element):
             # an etree element, follow parents to root
             elt = path
@@ -732,66 +1026,25 @@ class MRXpath(object):
             if att is not None:
                 if att not in elt.keys():
                     raise Exception("Cannot make a path to an attribute that does not exist")
-                path.append(["@" + att])
+                path.append(("@" + att,))
             while(elt is not None):
-                item = [elt.tag]
-                if "id" in elt.keys():
-                    item.append(elt.get("id"))
-                path.append(item)
+                elt_id = elt.get("id")
+                if elt_id is None:
+                    path.append((elt.tag,))
+                else:
+                    path.append((elt.tag, elt_id))
                 elt = elt.getparent()
-            path.append([""])
+            path.append(("",))
             path.reverse()
-            self.rep = path
-
-    # TODO: this parser is fragile and doesn't give sensible error messages
-    def tokens_to_rep(self, tokens):
-        if self.rep and self.is_attribute():
-            raise Exception("cannot add more to an attribute xpath")
-        if tokens[0][0] == "NAME":
-            name = tokens[0][1]
-            if len(tokens) == 1:
-                # expecting:
-                #  [NAME]
-                # just an element
-                return [name]
-            elif tokens[2][0] == "AT":
-                # expecting:
-                #  [NAME,BRACKET,AT,NAME,OP,QSTRING,BRACKET]
-                # an element with an id passed as [@id="something"]
-                if len(tokens) < 7:
-                    raise Exception("expecting a 7 token sequence: " +
-                                    "[NAME,BRACKET,AT,NAME," +
-                                    "OP,QSTRING,BRACKET] got " +
-                                    repr(tokens))
-                if tokens[5][0] != "QSTRING":
-                    raise Exception("expecting a QSTRING at element 5 of " +
-                                    str(tokens) + " got " + str(tokens[5]))
-                idname = tokens[5][1]
-                return [name, idname]
-            else:
-                # expecting:
-                #  [NAME,BRACKET,QSTRING|NAME|ID,BRACKET]
-                # an element with an id passed as [something]
-                if len(tokens) < 4:
-                    raise Exception("expecting a 4 token sequence: " +
-                                    "[NAME,BRACKET,QSTRING|NAME|ID,BRACKET]" +
-                                    " got " +
-                                    repr(tokens))
-                if (tokens[2][0] != "NAME" and
-                    tokens[2][0] != "QSTRING" and
-                    tokens[2][0] != "ID"):
-                    raise Exception("expecting a QSTRING, NAME or ID at " +
-                                    "element 2 of " +
-                                    str(tokens) + " got " + str(tokens[2]))
-                idname = tokens[2][1]
-                return [name, idname]
-        elif tokens[0][0] == "AT":
-            # an attribute, the next token should be the name
-            return ["@" + tokens[1][1]]
+            self.rep = tuple(path)
 
     def clone_rep(self):
-        """Return a clone of representation"""
-        return copy.deepcopy(self.rep)
+        """Return the representation (immutable, so no copy is needed)"""
+        return self.rep
+
+    def freeze(self):
+        """Return an immutable FrozenMRXpath for the same path"""
+        return FrozenMRXpath(self)
 
     def _clear_cache(self):
         """Clear any accumulated caches. Called when representation changes."""
@@ -821,9 +1074,9 @@ class MRXpath(object):
         else:
             rep = self.rep
         if isinstance(key, int):
-            return MRXpath([rep[key]])
+            return MRXpath._from_rep((rep[key],))
         else:
-            ret = MRXpath(rep[key])
+            ret = MRXpath._from_rep(rep[key])
             if self.is_rooted() and not key.start:
                 ret.reroot()
             return ret
@@ -833,31 +1086,26 @@ class MRXpath(object):
         if isinstance(key, int):
             if self.is_rooted():
                 key += 1
-            del self.rep[key]
+            start, stop = key, key + 1
         elif isinstance(key, slice):
+            start = key.start
+            if start is None:
+                start = 0
+            stop = key.stop
+            if stop is None:
+                stop = len(self)
             if self.is_rooted():
-                start = key.start
-                if start is None:
-                    start = 0
-                stop = key.stop
-                if stop is None:
-                    stop = len(self)
-                key = slice(start + 1, stop + 1, key.step)
-            del self.rep[key]
-            key = key.start
+                start += 1
+                stop += 1
         else:
             raise Exception("don't understand key type " + str(type(key)))
-        for item in MRXpath(value).rep:
-            self.rep.insert(key, item)
-            key += 1
+        self.rep = self.rep[:start] + MRXpath(value).rep + self.rep[stop:]
 
     def append(self, val):
         if self.is_attribute():
             raise Exception("cannot append to an attribute")
         self._clear_cache()
-        val = MRXpath(val)
-        for i in val.rep:
-            self.rep.append(i)
+        self.rep = self.rep + MRXpath(val).rep
 
     def is_attribute(self):
         """True if self represents an attribute, False otherwise"""
@@ -889,14 +1137,16 @@ class MRXpath(object):
         self._clear_cache()
         if len(self.rep) > 0:
             if self.rep[0][0] != '':
-                self.rep.insert(0, [''])
+                self.rep = (('',),) + self.rep
         else:
-            self.rep = [['']]
+            self.rep = (('',),)
         return self
 
     def parent(self):
         """return MRXpath of parent element of rep or None"""
         if len(self.rep) == 2: return None
+        if len(self.rep) > 2 and self.is_rooted():
+            return MRXpath._from_rep(self.rep[:-1])
         return self[:len(self) - 1]
 
     def ancestors(self):
@@ -917,11 +1167,11 @@ class MRXpath(object):
 
     def last_item(self):
         """return MRXpath object representing the last item in this rep"""
-        return MRXpath(self.rep[-1])
+        return MRXpath._from_rep((self.rep[-1],))
 
     def item(self, n):
         """return MRXpath object representing item n in the rep"""
-        return MRXpath(self.rep[0:n + 1])
+        return MRXpath._from_rep(self.rep[0:n + 1])
 
     def name(self):
         """return the name of the object"""
@@ -936,7 +1186,8 @@ class MRXpath(object):
         if self.is_attribute():
             raise Exception("an attribute may not have an id")
         if args:
-            self.rep[-1][1] = str(args[0])
+            self._clear_cache()
+            self.rep = self.rep[:-1] + ((self.rep[-1][0], str(args[0])),)
         if self.is_element():
             if len(self.rep[-1]) > 1:
                 return self.rep[-1][1]
@@ -960,17 +1211,14 @@ class MRXpath(object):
             self.xp_cache = "/".join(["%s[@id='%s']" % (e[0], self.quote_id(e[1])) if len(e) == 2 else e[0] for e in self.rep])
         return self.xp_cache
 
-    @functools.lru_cache(maxsize=None)
     def to_abbrev_xpath(self):
         """return Machination abbreviated xpath string"""
         return "/".join(["%s['%s']" % (e[0], self.quote_id(e[1])) if len(e) == 2 else e[0] for e in self.rep])
 
-    @functools.lru_cache(maxsize=None)
     def to_noid_path(self):
         """return xpath with no ids"""
         return "/".join([e[0] for e in self.rep])
 
-    @functools.lru_cache(maxsize=None)
     def to_xpath_list(self):
         """return list of xpath path elements"""
         return ["%s[@id='%s']" % (e[0], self.quote_id(e[1])) if len(e) == 2 else e[0] for e in self.rep]
@@ -1014,6 +1262,191 @@ class MRXpath(object):
         return True
 
 
+class FrozenMRXpath(MRXpath):
+    """Immutable, hashable MRXpath.
+
+    The xpath string, noid path and hash are worked out once on
+    construction, so hashing and comparing a FrozenMRXpath is cheap and
+    it can safely be used as a dictionary key. A FrozenMRXpath is equal
+    to (and hashes the same as) an MRXpath of the same path.
+
+    Methods which would change the path raise an exception; make a
+    mutable copy with ``MRXpath(frozen)`` instead.
+    """
+
+    __slots__ = ('_hash', '_noid')
+
+    def __init__(self, path=None, att=None):
+        MRXpath.set_path(self, path, att)
+        self.xp_cache = MRXpath.to_xpath(self)
+        self._noid = MRXpath.to_noid_path(self)
+        self._hash = hash(self.xp_cache)
+
+    def _clear_cache(self):
+        # every method that changes the path calls this first
+        if hasattr(self, '_hash'):
+            raise Exception("cannot modify a FrozenMRXpath")
+        self.xp_cache = None
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, FrozenMRXpath):
+            if self._hash != other._hash:
+                return False
+            return self.rep is other.rep or self.xp_cache == other.xp_cache
+        return self.xp_cache == other.to_xpath()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def reroot(self):
+        """return self if already rooted, otherwise raise an exception"""
+        if self.is_rooted():
+            return self
+        return MRXpath.reroot(self)
+
+    def freeze(self):
+        return self
+
+    def to_xpath(self):
+        """return xpath string"""
+        return self.xp_cache
+
+    def to_noid_path(self):
+        """return xpath with no ids"""
+        return self._noid
+
+
+def _find_child(parent, name, idname=None):
+    """return first child of parent called name (with id idname) or None"""
+    for elt in parent.iterchildren(name):
+        if idname is None or elt.get('id') == idname:
+            return elt
+    return None
+
+
+def _walk_mrx(top, rep, find_child):
+    """Follow MRXpath representation rep from top using find_child"""
+    if top is None or not rep:
+        return None
+    if rep[0][0] == '':
+        # rooted: the first step is the document element
+        if len(rep) < 2:
+            return None
+        top = top.getroottree().getroot()
+        name = rep[1][0]
+        if name.startswith('@'):
+            return None
+        if name != '*' and top.tag != name:
+            return None
+        if len(rep[1]) > 1 and top.get('id') != rep[1][1]:
+            return None
+        rep = rep[2:]
+    elt = top
+    for step in rep:
+        if step[0].startswith('@'):
+            return elt.get(step[0][1:])
+        if len(step) > 1:
+            elt = find_child(elt, step[0], step[1])
+        else:
+            elt = find_child(elt, step[0])
+        if elt is None:
+            return None
+    return elt
+
+
+class MRXIndex(object):
+    """Find nodes in a document by MRXpath without using XPath.
+
+    MRXpaths are only ever tag and id steps, so a lookup can walk down
+    from the root one child at a time. Each parent's children are
+    indexed by (tag, id) the first time the parent is walked through,
+    so repeated lookups in the same document are a handful of dict
+    lookups.
+
+    The document may be changed between lookups: an index entry is
+    checked before it is used and a parent's children are re-indexed
+    when the child asked for is missing or has moved.
+    """
+
+    def __init__(self, root):
+        """MRXIndex constructor
+
+        Args:
+          root: an etree Element or ElementTree
+        """
+        self.root = root
+        self.children = {}
+
+    def top(self):
+        """return the element lookups start from"""
+        if isinstance(self.root, etree._ElementTree):
+            return self.root.getroot()
+        return self.root
+
+    def child(self, parent, name, idname=None):
+        """return child of parent called name (with id idname) or None"""
+        if name == '*':
+            return _find_child(parent, name, idname)
+        key = (name, idname)
+        kids = self.children.get(parent)
+        if kids is not None:
+            elt = kids.get(key)
+            if(elt is not None and
+               elt.getparent() is parent and
+               elt.tag == name and
+               (elt.get('id') == idname if idname is not None else
+                # must still be the first child called name
+                next(elt.itersiblings(name, preceding=True), None) is None)):
+                return elt
+        kids = {}
+        for elt in parent.iterchildren(tag=etree.Element):
+            kids.setdefault((elt.tag, None), elt)
+            elt_id = elt.get('id')
+            if elt_id is not None:
+                kids.setdefault((elt.tag, elt_id), elt)
+        self.children[parent] = kids
+        return kids.get(key)
+
+    def resolve(self, mrx):
+        """return the element or attribute value at mrx or None"""
+        if not isinstance(mrx, MRXpath):
+            mrx = MRXpath(mrx)
+        return _walk_mrx(self.top(), mrx.rep, self.child)
+
+    def clear(self):
+        """forget everything indexed so far"""
+        self.children = {}
+
+
+def resolve(root, mrx):
+    """Return the node at MRXpath mrx, or None if there isn't one.
+
+    A cheaper equivalent of ``root.xpath(MRXpath(mrx).to_xpath())[0]``
+    which walks children directly instead of compiling an XPath
+    expression.
+
+    Args:
+      root: an etree Element, ElementTree or an MRXIndex. Rooted
+        paths start from the document element, relative paths from
+        root. Pass an MRXIndex to reuse its child index between
+        lookups.
+      mrx: an MRXpath or anything MRXpath() accepts.
+
+    Returns:
+      An element, an attribute value (for attribute paths) or None.
+    """
+    if isinstance(root, MRXIndex):
+        return root.resolve(mrx)
+    if isinstance(root, etree._ElementTree):
+        root = root.getroot()
+    if not isinstance(mrx, MRXpath):
+        mrx = MRXpath(mrx)
+    return _walk_mrx(root, mrx.rep, _find_child)
+
+
 class Status(object):
     """Encapsulate a status XML element and functionality to manipulate it"""
 
@@ -1194,6 +1627,13 @@ class WorkerDescription:
         'wu': 'https://github.com/machination/ns/workunit',
         'info': 'https://github.com/machination/ns/info'}
 
+    # Compiled descriptions shared by every instance, keyed by
+    # description file (see __registered)
+    registry = {}
+
+    # Bump if the compiled form written to the disk cache changes
+    cache_version = 1
+
     def __init__(self, workername, prefix=None):
         """WorkerDescription init
 
@@ -1209,6 +1649,13 @@ class WorkerDescription:
           prefix(=None): the xpath prefix to worker elements. Used
             when checking worker elements snipped from larger files
             (like desired-status and current-status).
+
+        Description files are compiled once per process (and again if
+        they change on disk) and shared between instances, so
+        constructing a WorkerDescription is cheap. Compiled
+        descriptions are also kept in context.cache_dir() so that a
+        new process only needs to parse a description file when the
+        worker has been upgraded.
         """
 
         self.__clear()
@@ -1218,18 +1665,13 @@ class WorkerDescription:
             # try to find the description file
             descfile = os.path.join(utils.worker_dir(workername),
                                     "description.xml")
-            try:
-                self.desc = etree.parse(descfile).getroot()
-            except IOError:
-                # carry on with defaults if descfile doesn't exist,
-                # but if it does...
-                if os.path.isfile(descfile):
-                    raise
+            self.entry = self.__registered(descfile)
         elif isinstance(workername, etree._Element):
             # this constructor path allows us to instantiate directly from
             # an element for debugging purposes
-            self.desc = workername
+            self.entry['desc'] = workername
             self.workername = self.desc.xpath("/rng:element/rng:attribute[@name='id']/rng:value", namespaces=self.nsmap)[0].text
+            self.entry['paths'] = self.compile_paths()
 
         self.prefix = None
         if prefix:
@@ -1238,12 +1680,163 @@ class WorkerDescription:
     def __clear(self):
         """Clear all cache attributes"""
 
-        self.desc = None
+        self.entry = {'descfile': None,
+                      'mtime': None,
+                      'sha1': None,
+                      'desc': None,
+                      'paths': None,
+                      'elements': None}
         self.workername = None
 #        self.wucache = None
 
-    # should provide the same answer every time...
-    @functools.lru_cache(maxsize=1)
+    @property
+    def desc(self):
+        """The description element, parsed when first asked for"""
+        entry = self.entry
+        if entry['desc'] is None and entry['paths'] is not None:
+            entry['desc'] = etree.parse(entry['descfile']).getroot()
+        return entry['desc']
+
+    @property
+    def paths(self):
+        """Compiled path table (see compile_paths) or None"""
+        return self.entry['paths']
+
+    def __registered(self, descfile):
+        """return the registry entry for descfile
+
+        The entry is made if descfile isn't registered yet or the
+        file has changed since it was, from the disk cache if that is
+        up to date or by compiling descfile otherwise.
+        """
+        try:
+            mtime = os.stat(descfile).st_mtime
+        except OSError:
+            # carry on with defaults if descfile doesn't exist
+            mtime = None
+        entry = WorkerDescription.registry.get(descfile)
+        if entry is not None and entry['mtime'] == mtime:
+            return entry
+        self.entry = {'descfile': descfile,
+                      'mtime': mtime,
+                      'sha1': None,
+                      'desc': None,
+                      'paths': None,
+                      'elements': None}
+        if mtime is not None:
+            self.__load_compiled()
+        WorkerDescription.registry[descfile] = self.entry
+        return self.entry
+
+    def cache_file(self):
+        """return the disk cache file for this worker's description"""
+        return os.path.join(context.cache_dir(), "descriptions",
+                            "{}.pickle".format(self.workername))
+
+    def __load_compiled(self):
+        """fill in self.entry from the disk cache or by compiling"""
+        entry = self.entry
+        cfile = self.cache_file()
+        cached = None
+        try:
+            with open(cfile, "rb") as f:
+                cached = pickle.load(f)
+        except Exception:
+            # missing, truncated, stale or foreign: unpickling can
+            # fail in all sorts of ways, and the cache is only a cache
+            pass
+        if(not isinstance(cached, dict) or
+           cached.get('version') != self.cache_version or
+           cached.get('descfile') != entry['descfile']):
+            cached = None
+        if cached is not None and cached.get('mtime') == entry['mtime']:
+            entry['sha1'] = cached['sha1']
+            entry['paths'] = cached['paths']
+            return
+        # the file may have been touched without changing: check the
+        # content before compiling again
+        with open(entry['descfile'], "rb") as f:
+            content = f.read()
+        entry['sha1'] = hashlib.sha1(content).hexdigest()
+        if cached is not None and cached.get('sha1') == entry['sha1']:
+            entry['paths'] = cached['paths']
+        else:
+            entry['desc'] = etree.fromstring(content,
+                                             base_url=entry['descfile'])
+            entry['paths'] = self.compile_paths()
+        self.__save_compiled(cfile)
+
+    def __save_compiled(self, cfile):
+        """write the compiled description to the disk cache"""
+        entry = self.entry
+        data = {'version': self.cache_version,
+                'descfile': entry['descfile'],
+                'mtime': entry['mtime'],
+                'sha1': entry['sha1'],
+                'paths': entry['paths']}
+        tmpfile = "{}.{}.tmp".format(cfile, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(cfile), exist_ok=True)
+            with open(tmpfile, "wb") as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfile, cfile)
+        except (IOError, OSError) as e:
+            l.wmsg("could not write description cache {}: {}".format(
+                    cfile, e))
+
+    @classmethod
+    def clear_registry(cls):
+        """Forget all registered descriptions"""
+        cls.registry.clear()
+
+    def described_elements(self):
+        """yield (noid_path, rng_element) for each described element
+
+        noid_path is relative to the worker element (/worker/...). If a
+        path is described more than once only the first is yielded.
+        """
+        seen = set()
+        for el in self.desc.iter("{%s}element" % self.nsmap["rng"]):
+            path = "/".join(self.describes_path(el))
+            if path in seen:
+                continue
+            seen.add(path)
+            yield path, el
+
+    def compile_paths(self):
+        """return a table of the paths described by self.desc
+
+        Returns:
+          {noid_path: {'wu': is_workunit, 'ordered': is_ordered}}
+        where noid_path is relative to the worker element
+        (/worker/...), or None if there is no description.
+        """
+        if self.desc is None:
+            return None
+        return {
+            path: {
+                'wu': el.get("{%s}wu" % self.nsmap["wu"]) == "1",
+                'ordered': el.get("{%s}ordered" % self.nsmap["info"]) == "1",
+                }
+            for path, el in self.described_elements()}
+
+    def elements(self):
+        """return {noid_path: rng_element} for the description"""
+        entry = self.entry
+        if entry['elements'] is None:
+            if self.desc is None:
+                entry['elements'] = {}
+            else:
+                entry['elements'] = dict(self.described_elements())
+        return entry['elements']
+
+    def _worker_path(self, xpath):
+        """return xpath as an MRXpath with self.prefix removed"""
+        xpath = MRXpath(xpath)
+        if self.prefix:
+            return xpath[len(self.prefix):].reroot()
+        return xpath
+
     def workunits(self):
         """return a set of valid work unit xpaths
 
@@ -1254,19 +1847,16 @@ class WorkerDescription:
         where the wu:wu attribute is set to '1' or which are direct
         children of the worker element.
         """
-        wus = set()
         # add all 'element' elements which would be direct children of
         # the /worker element or where wu:wu=1
-        for elt in self.desc.iter("{%s}element" % self.nsmap["rng"]):
-            path = self.describes_path(elt)
-
-            # len(path) == 3 comes from the fact that a direct child of
-            # worker will end up with a path like ["","worker","Name"]
-            if(len(path) == 3 or elt.get("{%s}wu" % self.nsmap["wu"]) == "1"):
-                wus.add("/".join(path))
-        return wus
+        #
+        # path.count("/") == 2 comes from the fact that a direct child
+        # of worker will end up with a path like "/worker/Name"
+        if self.paths is None:
+            return set()
+        return {path for path, info in self.paths.items()
+                if path.count("/") == 2 or info['wu']}
 
-    @functools.lru_cache(maxsize=100)
     def get_description(self, xpath):
         """return the description element for xpath"""
         xpath = MRXpath(xpath)
@@ -1276,12 +1866,8 @@ class WorkerDescription:
                 raise Exception("prefix is defined so " + str(xpath) + " should start with " + str(self.prefix))
             # remove the prefix from xpath
             xpath = xpath[len(self.prefix):].reroot()
-        for el in self.desc.iter("{%s}element" % self.nsmap["rng"]):
-            if "/".join(self.describes_path(el)) == xpath.to_noid_path():
-                return el
-        return None
+        return self.elements().get(xpath.to_noid_path())
 
-    @functools.lru_cache(maxsize=100)
     def is_workunit(self, xpath):
         """True if xpath is a valid workunit, False otherwise
 
@@ -1299,16 +1885,15 @@ class WorkerDescription:
           False otherwise
         """
 
-        xpath = MRXpath(xpath)
-        mrx = MRXpath(xpath)[len(self.prefix):].reroot()
+        mrx = self._worker_path(xpath)
 
         # the worker element is always a workunit
         if len(mrx) == 1:
             return True
 
-        if self.desc is not None:
-            desc = self.get_description(xpath)
-            if desc is not None and desc.get("{%s}wu" % self.nsmap["wu"]) == "1":
+        if self.paths is not None:
+            info = self.paths.get(mrx.to_noid_path())
+            if info is not None and info['wu']:
                 return True
             else:
                 return False
@@ -1319,7 +1904,6 @@ class WorkerDescription:
             else:
                 return False
 
-    @functools.lru_cache(maxsize=100)
     def is_ordered(self, xpath):
         """True if xpath preserves order, False otherwise
 
@@ -1332,15 +1916,71 @@ class WorkerDescription:
         Default no description:
           False
         """
-        desc = self.get_description(xpath)
-        if desc.get("{%s}ordered" % self.nsmap["info"]) == "1":
+        if self.paths is None:
+            return False
+        info = self.paths.get(self._worker_path(xpath).to_noid_path())
+        if info is not None and info['ordered']:
             return True
         else:
             return False
 
+    def status_ttl(self):
+        """Seconds a generated status may be reused for, or None
+
+        Indicated by:
+          attribute info:statusTTL="seconds" on the worker element
+
+        Default no indicator or no description:
+          None
+        """
+        if self.desc is None:
+            return None
+        ttl = self.desc.get("{%s}statusTTL" % self.nsmap["info"])
+        if ttl is None:
+            return None
+        return float(ttl)
+
+    def concurrent_work(self):
+        """Number of batches of work the worker can do at once
+
+        A worker which can do more than one gets a batch of its own
+        for each work unit, so that one slow work unit (a big
+        download, say) doesn't hold up the rest. Only for workers
+        whose work units don't rely on being done in order.
+
+        Indicated by:
+          attribute info:concurrentWork="n" on the worker element
+
+        Default no indicator or no description:
+          1
+        """
+        if self.desc is None:
+            return 1
+        n = self.desc.get("{%s}concurrentWork" % self.nsmap["info"])
+        if n is None:
+            return 1
+        return max(int(n), 1)
+
+    def caller_thread(self):
+        """Whether the worker must be called from the calling thread
+
+        For workers holding objects which only work in the thread
+        that made them, like COM objects made in __init__. Their work
+        and statuses are never handed to a thread pool.
+
+        Indicated by:
+          attribute info:callerThread="1" on the worker element
+
+        Default no indicator or no description:
+          False
+        """
+        if self.desc is None:
+            return False
+        return self.desc.get("{%s}callerThread" % self.nsmap["info"]) == "1"
+
     def is_spanned(self, xpath):
         """True if all children are work units, False otherwise"""
-        if self.desc is None:
+        if self.paths is None:
             return False
         for cx in self.element_children(xpath):
             if not self.is_workunit(cx):
@@ -1351,7 +1991,6 @@ class WorkerDescription:
         """Return xpaths for all children of xpath that are elements"""
         pass
 
-    @functools.lru_cache(maxsize=100)
     def describes_path(self, element):
         """Return path in the final document which 'element' describes
         """
@@ -1369,7 +2008,6 @@ class WorkerDescription:
         path.reverse()
         return path
 
-    @functools.lru_cache(maxsize=100)
     def find_workunit(self, xpath):
         """return nearest workunit: xpath or nearest wu ancestor."""
 
@@ -1401,15 +2039,25 @@ class XMLCompare(object):
     the downloaded profile.
     """
 
-    def __init__(self, leftxml, rightxml):
+    def __init__(self, leftxml, rightxml, indexed=True, hashed=False):
         """XMLCompare constructor
 
         Args:
           leftxml: an etree Element
           rightxml: an etree Element
+          indexed(=True): walk each tree once and work from an index
+            of xpath -> node rather than evaluating an xpath for each
+            node in both trees. The results are the same either way;
+            set to False to use the original (slower) xpath engine.
+          hashed(=False): trust hashes stored by mhash() and skip
+            subtrees whose hashes are the same on both sides. Only
+            set this if the hashes are known to be up to date. Implies
+            indexed.
         """
         self.leftxml = leftxml
         self.rightxml = rightxml
+        self.indexed = indexed or hashed
+        self.hashed = hashed
         self.leftset = set()
         self.rightset = set()
         self.bystate = {'left': set(),
@@ -1425,30 +2073,37 @@ class XMLCompare(object):
             'childdiff': 'deepmod',
             'orderdiff': 'reorder'
             }
-        self.workcache = None
+        self.workcache = {}
+        self.wdcache = {}
+        self.actioncache = None
         self.compare()
         context.logger.dmsg('XMLCompare object created')
 
-    @functools.lru_cache(maxsize=None)
     def actions(self):
         """return dictionary of sets as {action: {xpaths}}"""
+        if self.actioncache is not None:
+            return self.actioncache
         actions = {self.diff_to_action[s]: self.find_work() & self.bystate[s] for s in ['left', 'right', 'datadiff', 'childdiff', 'orderdiff']}
 #        actions['all'] = actions['add'] | actions['remove'] | actions['datamod'] | actions['deepmod'] | actions['reorder']
+        self.actioncache = actions
         return actions
 
     def compare(self):
         """Compare the xpath sets and generate a diff dict"""
 
+        if self.indexed:
+            return self.compare_indexed()
+
         for elt in self.leftxml.iter(tag=etree.Element):
             self.leftset.add(MRXpath(elt).to_xpath())
             for att in elt.keys():
-                if att == "id":
+                if att == "id" or att == HASH_ATT:
                     continue
                 self.leftset.add(MRXpath(elt, att=att).to_xpath())
         for elt in self.rightxml.iter(tag=etree.Element):
             self.rightset.add(MRXpath(elt).to_xpath())
             for att in elt.keys():
-                if att == "id":
+                if att == "id" or att == HASH_ATT:
                     continue
                 self.rightset.add(MRXpath(elt, att=att).to_xpath())
 
@@ -1526,6 +2181,208 @@ class XMLCompare(object):
                 self.bystate['orderdiff'].add(mrx.to_xpath())
                 self._set_childdiff(mrx.parent())
 
+    def index_tree(self, top):
+        """Walk the tree under top once and index it by xpath
+
+        Where more than one node has the same xpath the first in
+        document order is indexed, which is what evaluating the xpath
+        would have found.
+
+        Returns:
+          (nodes, prevs, parents):
+            nodes: {xpath: element or attribute value}
+            prevs: {element xpath: previous element sibling xpath or ''}
+            parents: {xpath: parent xpath or None}
+        """
+        index = ({}, {}, {})
+        xp, prev_xp = self._index_top(top, index)
+        self._index_subtree(top, xp, prev_xp, index)
+        return index
+
+    def index_trees(self, left, right):
+        """Index left and right together, skipping identical subtrees
+
+        Like calling index_tree() on left and right, except that where
+        an element has the same stored hash (see mhash()) on both sides
+        its descendants and attributes are left out of both indexes:
+        they can't differ. The element itself is still indexed since
+        its position might.
+
+        Returns:
+          (left_index, right_index) as for index_tree()
+        """
+        lindex = ({}, {}, {})
+        rindex = ({}, {}, {})
+        xp, lprev = self._index_top(left, lindex)
+        rxp, rprev = self._index_top(right, rindex)
+        if xp != rxp:
+            # nothing can be shared
+            self._index_subtree(left, xp, lprev, lindex)
+            self._index_subtree(right, rxp, rprev, rindex)
+            return lindex, rindex
+
+        stack = [(left, right, xp, lprev, rprev)]
+        while stack:
+            lelt, relt, xp, lprev, rprev = stack.pop()
+            lhash = lelt.get(HASH_ATT)
+            if lhash is not None and lhash == relt.get(HASH_ATT):
+                for elt, prev_xp, index in ((lelt, lprev, lindex),
+                                            (relt, rprev, rindex)):
+                    index[0].setdefault(xp, elt)
+                    index[1].setdefault(xp, prev_xp)
+                continue
+            lchildren = self._index_elt(lelt, xp, lprev, lindex)
+            rchildren = self._index_elt(relt, xp, rprev, rindex)
+            lbyxp = {c[1]: c for c in lchildren}
+            rbyxp = {c[1]: c for c in rchildren}
+            if (len(lbyxp) != len(lchildren) or
+                len(rbyxp) != len(rchildren)):
+                # Duplicate xpaths amongst the children (not valid
+                # Machination XML). Their subtrees have to be merged
+                # in document order, so don't try to be clever.
+                for children, index in ((lchildren, lindex),
+                                        (rchildren, rindex)):
+                    for child, cxp, cprev in children:
+                        self._index_subtree(child, cxp, cprev, index)
+                continue
+            for child, cxp, cprev in lchildren:
+                if cxp in rbyxp:
+                    rchild, rcxp, rcprev = rbyxp[cxp]
+                    stack.append((child, rchild, cxp, cprev, rcprev))
+                else:
+                    self._index_subtree(child, cxp, cprev, lindex)
+            for child, cxp, cprev in rchildren:
+                if cxp not in lbyxp:
+                    self._index_subtree(child, cxp, cprev, rindex)
+        return lindex, rindex
+
+    def _index_top(self, top, index):
+        """Index the parent of top, return (xpath, previous xpath)"""
+        top_mrx = MRXpath(top)
+        top_parent = top_mrx.parent()
+        index[2][top_mrx.to_xpath()] = (None if top_parent is None
+                                        else top_parent.to_xpath())
+        prev = next(top.itersiblings(etree.Element, preceding=True), None)
+        return top_mrx.to_xpath(), MRXpath(prev).to_xpath()
+
+    def _index_subtree(self, top, xp, prev_xp, index):
+        """Add top (at xpath xp) and all of its descendants to index"""
+        stack = [(top, xp, prev_xp)]
+        while stack:
+            elt, xp, prev_xp = stack.pop()
+            children = self._index_elt(elt, xp, prev_xp, index)
+            # reversed so that children are popped in document order
+            children.reverse()
+            stack.extend(children)
+
+    def _index_elt(self, elt, xp, prev_xp, index):
+        """Add elt and its attributes to index
+
+        Returns:
+          a list of (child, child xpath, previous child xpath) for the
+          element children of elt in document order.
+        """
+        nodes, prevs, parents = index
+        nodes.setdefault(xp, elt)
+        prevs.setdefault(xp, prev_xp)
+        for att in elt.keys():
+            if att == "id" or att == HASH_ATT:
+                continue
+            axp = "{}/@{}".format(xp, att)
+            nodes.setdefault(axp, elt.get(att))
+            parents.setdefault(axp, xp)
+        children = []
+        prev_xp = ''
+        for child in elt.iterchildren(tag=etree.Element):
+            cxp = "{}/{}".format(xp, _xpath_step(child))
+            parents.setdefault(cxp, xp)
+            children.append((child, cxp, prev_xp))
+            prev_xp = cxp
+        return children
+
+    def compare_indexed(self):
+        """Index based equivalent of compare()
+
+        Each tree is walked once by index_tree() (or both together by
+        index_trees() if hashed is set) and all of the states are then
+        worked out from the indexes without any further xpath
+        evaluation.
+        """
+        left, right = self.leftxml, self.rightxml
+        if isinstance(left, etree._ElementTree):
+            left = left.getroot()
+        if isinstance(right, etree._ElementTree):
+            right = right.getroot()
+        if self.hashed:
+            lindex, rindex = self.index_trees(left, right)
+        else:
+            lindex = self.index_tree(left)
+            rindex = self.index_tree(right)
+        lnodes, lprevs, lparents = lindex
+        rnodes, rprevs, rparents = rindex
+        self.xpath_parents = lparents
+        self.xpath_parents.update(rparents)
+
+        self.leftset = set(lnodes)
+        self.rightset = set(rnodes)
+        self.universalset = self.leftset | self.rightset
+
+        for xpath in self.leftset - self.rightset:
+            self.bystate['left'].add(xpath)
+            self.byxpath[xpath] = 'left'
+
+        for xpath in self.rightset - self.leftset:
+            self.bystate['right'].add(xpath)
+            self.byxpath[xpath] = 'right'
+
+        self.onesideset = self.bystate['left'] | self.bystate['right']
+        self.bothsidesset = self.universalset - self.onesideset
+
+        for xp in self.onesideset:
+            p = self._parent_xpath(xp)
+            if p in self.bothsidesset:
+                self._set_childdiff_xpath(p)
+
+        # data differences
+        for xpath in self.bothsidesset:
+            lval = lnodes[xpath]
+            rval = rnodes[xpath]
+            if isinstance(lval, etree._Element):
+                lval = lval.text
+                rval = rval.text
+            if lval != rval:
+                # only set datadiff if childdiff is not set
+                if xpath not in self.bystate['childdiff']:
+                    self.bystate['datadiff'].add(xpath)
+                    self.byxpath[xpath] = 'datadiff'
+                    self._set_childdiff_xpath(self._parent_xpath(xpath))
+
+        # order differences (prevs only has element xpaths)
+        for xpath in self.bothsidesset:
+            if xpath not in lprevs:
+                continue
+            if lprevs[xpath] != rprevs[xpath]:
+                self.bystate['orderdiff'].add(xpath)
+                self._set_childdiff_xpath(self._parent_xpath(xpath))
+
+    def _parent_xpath(self, xpath):
+        """Return the parent xpath of xpath (or None) using the index"""
+        try:
+            return self.xpath_parents[xpath]
+        except KeyError:
+            p = MRXpath(xpath).parent()
+            return None if p is None else p.to_xpath()
+
+    def _set_childdiff_xpath(self, xpath):
+        """xpath string equivalent of _set_childdiff()"""
+        while xpath is not None:
+            self.bystate['childdiff'].add(xpath)
+            self.bystate['datadiff'].discard(xpath)
+            self.byxpath[xpath] = 'childdiff'
+            xpath = self._parent_xpath(xpath)
+            if xpath in self.bystate['childdiff']:
+                break
+
     def _set_childdiff(self, mrx):
         """set the state of mrx.to_xpath() to 'childdiff'
 
@@ -1545,7 +2402,6 @@ class XMLCompare(object):
         if p and p.to_xpath() not in self.bystate['childdiff']:
             self._set_childdiff(p)
 
-    @functools.lru_cache(maxsize=100)
     def find_work(self, prefix="/status"):
         """return a set of all wus for all diff xpaths in all workers
 
@@ -1553,9 +2409,13 @@ class XMLCompare(object):
           prefix: xpath prefix to parent of worker elements.
         """
 
+        if prefix in self.workcache:
+            return self.workcache[prefix]
+
         diffs = self.bystate['datadiff'] | self.bystate['left'] | self.bystate['right'] | self.bystate['orderdiff']
 
         wi = len(MRXpath(prefix))
+        wds = self.wds(prefix)
 
         wus = set()
         for x in diffs:
@@ -1565,7 +2425,8 @@ class XMLCompare(object):
                 continue
             if len(mrx) < 2:
                 continue
-            wus.add(self.wds(prefix)[mrx[wi].id()].find_workunit(x))
+            wus.add(wds[mrx[wi].id()].find_workunit(x))
+        self.workcache[prefix] = wus
         return wus
 
 #        return {self.wds(prefix)[MRXpath(x)[wi].id()].find_workunit(x) for x in diffs if(len(MRXpath(x)) > 2)}
@@ -1573,10 +2434,15 @@ class XMLCompare(object):
     def wds(self, prefix="/status"):
         """create a dictionary of WorkerDescriptions"""
 
+        if prefix in self.wdcache:
+            return self.wdcache[prefix]
+
         # find all the workers that are mentioned
         wnames = {w.get("id") for w in self.leftxml.xpath(prefix + "/worker")} | {w.get("id") for w in self.rightxml.xpath(prefix + "/worker")}
 
-        return {n: WorkerDescription(n, prefix) for n in wnames}
+        self.wdcache[prefix] = {n: WorkerDescription(n, prefix)
+                                for n in wnames}
+        return self.wdcache[prefix]
 
     def wudeps(self, statedeps):
         """Combine state dependencies with worklist to find work dependencies.
@@ -1704,6 +2570,7 @@ class AssertionCompiler(object):
           wc: a machination.webclient.WebClient
         """
         self.doc = etree.ElementTree()
+        self.index = MRXIndex(self.doc)
         self.wc = wc
 
     def compile(self, data):
@@ -1713,6 +2580,7 @@ class AssertionCompiler(object):
           data: as returned by wc.call("GetAssertionList")
         """
         self.doc = etree.ElementTree()
+        self.index = MRXIndex(self.doc)
         mpolicies = {}
         res_idx = {}
         mp_map = {}
@@ -1794,14 +2662,14 @@ class AssertionCompiler(object):
             if self.doc.getroot() is None:
                 return False
 
-            if self.doc.xpath(mpath.to_xpath()):
+            if self.index.resolve(mpath) is not None:
                 return True
             else:
                 return False
         elif op == 'notexists':
             if self.doc.getroot() is None:
                 return True
-            if self.doc.xpath(mpath.to_xpath()):
+            if self.index.resolve(mpath) is not None:
                 return False
             else:
                 return True
@@ -1809,15 +2677,15 @@ class AssertionCompiler(object):
             if self.doc.getroot() is None:
                 return False
 
-            nodes = self.doc.xpath(mpath.to_xpath())
-            if len(nodes) == 0:
+            node = self.index.resolve(mpath)
+            if node is None:
                 return False
-            if isinstance(nodes[0], etree._Element):
+            if isinstance(node, etree._Element):
                 # element
-                content = nodes[0].text
+                content = node.text
             else:
                 # attribute
-                content = nodes[0]
+                content = node
 
             # now look at which of the hastext assertions this is
             if op == 'hastext':
@@ -1847,35 +2715,35 @@ class AssertionCompiler(object):
         elif op == 'first':
             if mpath.is_attribute():
                 raise Exception("can't assert the order of attributes")
-            elts = self.doc.xpath(mpath.to_xpath())
-            if not elts:
+            elt = self.index.resolve(mpath)
+            if elt is None:
                 return True
-            if elts[0] is elts[0].getparent()[0]:
+            if elt is elt.getparent()[0]:
                 return True
             else:
                 return False
         elif op == 'last':
             if mpath.is_attribute():
                 raise Exception("can't assert the order of attributes")
-            elts = self.doc.xpath(mpath.to_xpath())
-            if not elts:
+            elt = self.index.resolve(mpath)
+            if elt is None:
                 return True
-            if elts[0] is elts[0].getparent()[-1]:
+            if elt is elt.getparent()[-1]:
                 return True
             else:
                 return False
         elif op == 'before':
             if mpath.is_attribute():
                 raise Exception("can't assert the order of attributes")
-            src_elts = self.doc.xpath(mpath.to_xpath())
-            if not src_elts:
+            src_elt = self.index.resolve(mpath)
+            if src_elt is None:
                 return True
-            src_idx = src_elts[0].index()
+            src_idx = src_elt.index()
             tgt_mrx = MRXpath(arg)
-            tgt_elts = self.doc.xpath(tgt_mrx.to_xpath())
-            if not tgt_elts:
+            tgt_elt = self.index.resolve(tgt_mrx)
+            if tgt_elt is None:
                 return True
-            tgt_idx = tgt_elts[0].index()
+            tgt_idx = tgt_elt.index()
             if src_idx < tgt_idx:
                 return True
             else:
@@ -1883,15 +2751,15 @@ class AssertionCompiler(object):
         elif op == 'after':
             if mpath.is_attribute():
                 raise Exception("can't assert the order of attributes")
-            src_elts = self.doc.xpath(mpath.to_xpath())
-            if not src_elts:
+            src_elt = self.index.resolve(mpath)
+            if src_elt is None:
                 return True
-            src_idx = src_elts[0].index()
+            src_idx = src_elt.index()
             tgt_mrx = MRXpath(arg)
-            tgt_elts = self.doc.xpath(tgt_mrx.to_xpath())
-            if not tgt_elts:
+            tgt_elt = self.index.resolve(tgt_mrx)
+            if tgt_elt is None:
                 return True
-            tgt_idx = tgt_elts[0].index()
+            tgt_idx = tgt_elt.index()
             if src_idx > tgt_idx:
                 return True
             else:
@@ -1992,10 +2860,10 @@ class AssertionCompiler(object):
                 pelt = new
                 continue
 
-            children = pelt.xpath(p.to_xpath())
-            if children:
+            child = self.index.resolve(p)
+            if child is not None:
                 # node p already exists
-                pelt = children[0]
+                pelt = child
                 continue
 
             context.logger.dmsg('creating element {}'.format(
@@ -2028,10 +2896,7 @@ class AssertionCompiler(object):
         lineage.reverse()
 
         # find the node to be set
-        if self.doc.getroot() is None:
-            nodes = []
-        else:
-            nodes = self.doc.xpath(mpath.to_xpath())
+        node = self.index.resolve(mpath)
 
         # test to see if a notexists takes precedence
         for p in lineage:
@@ -2043,13 +2908,13 @@ class AssertionCompiler(object):
                         return
                     # Check if the node has some text already - abort
                     # if it does.
-                    if nodes:
+                    if node is not None:
                         if (mpath.is_element() and
-                            nodes[0].text is not None and
-                            nodes[0].text != ''):
+                            node.text is not None and
+                            node.text != ''):
                             return
                         elif (mpath.is_attribute() and
-                              nodes[0] != ''):
+                              node != ''):
                             return
                 elif poldir == 0:
                     # check there is no mandatory notextists for mpath
@@ -2059,20 +2924,20 @@ class AssertionCompiler(object):
                         return
                     # check if the node has some mandatory text
                     # already, abort if it does
-                    if(nodes and
+                    if(node is not None and
                        res_idx[p.to_xpath()]['is_mandatory'] == "1" and
                        res_idx[p.to_xpath()]['ass_op'].startswith('hastext')):
                         return
 
         # create the element if it doesn't already exist
-        if len(nodes) == 0:
+        if node is None:
 #            print("\ncalling create {}\n".format(mpath.to_abbrev_xpath()))
             self.action_create(a,
                                res_idx,
                                poldir,
                                stack,
                                record_index=False)
-            nodes = self.doc.xpath(mpath.to_xpath())
+            node = self.index.resolve(mpath)
 
         # default to the assertion argument if the action argument is
         # missing
@@ -2086,13 +2951,13 @@ class AssertionCompiler(object):
 
         if mpath.is_element():
             # element: clear and set text
-            nodes[0].tail = None
-            for child in nodes[0].iterchildren():
-                nodes[0].remove(child)
-            nodes[0].text = content
+            node.tail = None
+            for child in node.iterchildren():
+                node.remove(child)
+            node.text = content
         else:
             # attribute: need to set it from the parent
-            pelt = self.doc.xpath(mpath.parent().to_xpath())[0]
+            pelt = self.index.resolve(mpath.parent())
             pelt.set(mpath.name(), content)
 
         res_idx[mpath.to_xpath()] = a
@@ -2130,11 +2995,11 @@ class AssertionCompiler(object):
     def delete_mpath(mpath):
         """Delete an mpath (MRXPath) from the document"""
         if mpath.is_element():
-            elt = self.doc.xpath(mpath.to_xpath())[0]
+            elt = self.index.resolve(mpath)
             elt.getparent().remove(elt)
         else:
             # an attribute
-            pelt = self.doc.xpath(mpath.parent().to_xpath())[0]
+            pelt = self.index.resolve(mpath.parent())
             del pelt.attributes[mpath.name()]
 
 
@@ -2145,7 +3010,7 @@ class AssertionCompiler(object):
         itemidtext = '{} {} {}'.format(a['mpath'], a['ass_op'], a['ass_arg'])
         itemid = hashlib.sha256(itemidtext.encode('utf8')).hexdigest()
         itemxp = '/status/__scratch__/libAdded/item[@id="{}"]'.format(itemid)
-        if len(self.doc.xpath(itemxp)) != 0:
+        if self.index.resolve(itemxp) is not None:
             context.logger.dmsg("seen {} before".format(itemidtext))
             return
 
@@ -2185,7 +3050,7 @@ class AssertionCompiler(object):
 
         # Find the node to be moved. It must exist - we wouldn't have
         # got to this action if not.
-        node = self.doc.xpath(mpath.to_xpath())[0]
+        node = self.index.resolve(mpath)
 
         # test to see if a reorderlast or reorderafter takes precedence
         if poldir == -1:
@@ -2211,7 +3076,7 @@ class AssertionCompiler(object):
 
         # Find the node to be moved. It must exist - we wouldn't have
         # got to this action if not.
-        node = self.doc.xpath(mpath.to_xpath())[0]
+        node = self.index.resolve(mpath)
 
         # test to see if a reorderfirst or reorderbefore takes precedence
         if poldir == -1:
@@ -2256,11 +3121,11 @@ class AssertionCompiler(object):
 
         # Find the node to be moved. It must exist - we wouldn't have
         # got to this action if not.
-        node = self.doc.xpath(mpath.to_xpath())[0]
+        node = self.index.resolve(mpath)
         # same goes for the target element
         tmrx = MRXpath(mpath)
         tmrx.id(a['ass_arg'])
-        tnode = self.doc.xpath(tmrx.to_xpath())[0]
+        tnode = self.index.resolve(tmrx)
 
         # No policy or mandatory overrides - go on and move.
         p = node.getparent()
@@ -2293,11 +3158,11 @@ class AssertionCompiler(object):
 
         # Find the node to be moved. It must exist - we wouldn't have
         # got to this action if not.
-        node = self.doc.xpath(mpath.to_xpath())[0]
+        node = self.index.resolve(mpath)
         # Same goes for the target element.
         tmrx = MRXpath(mpath)
         tmrx.id(a['ass_arg'])
-        tnode = self.doc.xpath(tmrx.to_xpath())[0]
+        tnode = self.index.resolve(tmrx)
 
         # No policy or mandatory overrides - go on and move.
         p = node.getparent()
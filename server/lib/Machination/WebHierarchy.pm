@@ -42,6 +42,8 @@ $Data::Dumper::Indent=1;
 use XML::LibXML;
 use File::Path qw(make_path);
 use URI;
+use Digest::SHA qw(sha256_hex);
+use Encode qw(encode_utf8);
 
 use Machination::HAccessor;
 use Machination::XMLDumper;
@@ -104,6 +106,7 @@ my %calls =
 
    # assertions/instructions/profiles
    GetAssertionList => undef,
+   GetAssertionListIfChanged => undef,
    GetLibraryItem => undef,
 
 
@@ -165,6 +168,8 @@ sub handler {
 
   # find config file
   $r->content_type("text/plain");
+  # Tell clients that they may send several calls in one request.
+  $r->headers_out->set('X-Machination-Batch' => 1);
 
   my $machination_config = $r->dir_config('MachinationConfig');
   $machination_config = $machination_config_default
@@ -271,11 +276,39 @@ sub handler {
     return Apache2::Const::OK;
   }
 
+  my $answer;
+  if($req->getAttribute("call") eq "Batch") {
+    # Several calls in one request: answer each of them in turn, in
+    # order, in a <batch> element.
+    $answer = XML::LibXML::Element->new('batch');
+    foreach my $call_req ($req->findnodes("r")) {
+      $answer->appendChild(dispatch($rem_user, $call_req));
+    }
+  } else {
+    $answer = dispatch($rem_user, $req);
+  }
+  print $answer->toString . "\n";
+
+  return Apache2::Const::OK;
+}
+
+=item B<dispatch>
+
+$answer = dispatch($rem_user, $req)
+
+Perform the call described by <r> element $req and return the answer
+(or an <error> element) as an XML::LibXML::Element.
+
+=cut
+
+sub dispatch {
+  my ($rem_user, $req) = @_;
+  my $cat = "WebHierarchy.dispatch";
+
   my $call = $req->getAttribute("call");
 
   unless(exists $calls{$call}) {
-    error("no such call \"$call\"");
-    return Apache2::Const::OK;
+    return error_elt("no such call \"$call\"");
   }
   $call = "call_" . $call;
 
@@ -286,25 +319,14 @@ sub handler {
     $_->parentNode->removeChild($_);
   }
 
-  my $args;
+  my $call_args;
   eval {
-    $args = $xmld->to_perl($req);
+    $call_args = $xmld->to_perl($req);
   };
   if($@) {
-    error($@);
-    return Apache2::Const::OK;
+    return error_elt($@);
   }
 
-#    if($call eq "call_CreateLibItem") {
-#	my $err = $req->sprint;
-#	$err .= "\n" . Dumper($args);
-#	error($err);
-#	return Apache2::Const::OK;
-#    }
-
-#    print Dumper($args);
-
-  my $call_args = $xmld->to_perl($req);
   $log->dmsg($cat,"calling:\n$call($rem_user,[" .
              join(",",@approval) . "],\n" . Dumper($call_args) . ")",4);
   my $ret;
@@ -312,16 +334,13 @@ sub handler {
     $ret = &$call($rem_user,\@approval,@$call_args);
   };
   if($@) {
-    &error("your call didn't work because:\n$@");
-    return Apache2::Const::OK;
+    return error_elt("your call didn't work because:\n$@");
   }
   $log->dmsg($cat, "call worked - answer:\n" . Dumper($ret), 4);
-  $log->dmsg($cat, $xmld->to_xml($ret)->toString , 9);
-#  my $rep = &perl_to_xrep($ret);
-
-  print $xmld->to_xml($ret)->toString . "\n";
+  my $answer = $xmld->to_xml($ret);
+  $log->dmsg($cat, $answer->toString , 9);
 
-  return Apache2::Const::OK;
+  return $answer;
 }
 
 =item B<hierarchy_channel>
@@ -1169,6 +1188,38 @@ sub call_GetAssertionList {
   return $info;
 }
 
+=item B<GetAssertionListIfChanged>
+
+GetAssertionListIfChanged($type_name, $obj_name, $revision)
+
+As GetAssertionList, but returns
+
+ {revision => $new_revision, assertions => $assertion_list}
+
+or, if the assertion list is the same as the one $revision was given
+for,
+
+ {revision => $revision, not_modified => 1}
+
+so that clients which have already compiled that list needn't
+download it again. $revision is a hash of the whole list.
+
+=cut
+
+sub call_GetAssertionListIfChanged {
+  my ($owner,$approval,$type_name,$obj_name,$revision) = @_;
+
+  my $info = call_GetAssertionList($owner,$approval,$type_name,$obj_name);
+  local $Data::Dumper::Sortkeys = 1;
+  local $Data::Dumper::Indent = 0;
+  local $Data::Dumper::Terse = 1;
+  my $new_revision = sha256_hex(encode_utf8(Dumper($info)));
+  if(defined $revision && $revision eq $new_revision) {
+    return {revision => $revision, not_modified => 1};
+  }
+  return {revision => $new_revision, assertions => $info};
+}
+
 # sorting function used by GetAssertionList
 sub lineage_sort {
   my $i = 0;
@@ -1841,6 +1892,18 @@ sub call_GetSpecialSet {
 sub error {
     my ($error,$opts) = @_;
 
+    print error_elt($error,$opts)->toString . "\n";
+}
+
+=item * error_elt($error)
+
+Return an <error> element for $error.
+
+=cut
+
+sub error_elt {
+    my ($error,$opts) = @_;
+
     $log->emsg("WebHierarchy.error",$error,1)
       if defined $log;
     my $e = XML::LibXML::Element->new('error');
@@ -1852,8 +1915,7 @@ sub error {
     $e->appendChild($m);
     $log->dmsg("WebHierarchy.error", "sending back error:\n" . $e->toString,4)
       if defined $log;
-    print $e->toString . "\n";
-
+    return $e;
 }
 
 =item * authz()
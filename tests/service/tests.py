@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+import unittest
+import inspect
+import os
+import socket
+import threading
+import time
+
+mydir = os.path.dirname(inspect.getfile(inspect.currentframe()))
+os.environ['MACHINATION_BOOTSTRAP_DIR'] = os.path.join(
+    mydir, '..', 'update', 'cache'
+    )
+from machination.service import resident
+
+
+class FakeUpdate(object):
+    """Just enough of Update for ResidentDaemon."""
+
+    def __init__(self):
+        self.workers = {}
+        self.before_import = None
+        # called after workers are imported in each cycle
+        self.during = lambda: None
+        self.cycles = 0
+        self.new_cycles = 0
+        self.forgotten = []
+
+    def new_cycle(self):
+        self.new_cycles += 1
+
+    def do_update(self):
+        self.cycles += 1
+        if 'fetcher' not in self.workers:
+            self.before_import('fetcher')
+            self.workers['fetcher'] = object()
+        self.during()
+
+    def forget_worker(self, name):
+        self.forgotten.append(name)
+        self.workers.pop(name, None)
+
+
+class ResidentDaemonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.u = FakeUpdate()
+        self.d = resident.ResidentDaemon(update=self.u, address='127.0.0.1',
+                                         port=0, sleeptime=0)
+
+    def kick(self):
+        # Wait for the daemon to be listening again.
+        for i in range(500):
+            sock = self.d.sock
+            if sock is not None:
+                try:
+                    socket.create_connection(
+                        ('127.0.0.1', self.d.port), timeout=1).close()
+                    return
+                except OSError:
+                    pass
+            time.sleep(0.01)
+        self.fail('daemon never listened')
+
+    def test_serve(self):
+        t = threading.Thread(target=self.d.serve, kwargs={'cycles': 2})
+        t.start()
+        self.kick()
+        # Wait for the first cycle to finish before kicking again.
+        while self.u.cycles < 1:
+            time.sleep(0.01)
+        self.kick()
+        t.join(10)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(self.u.cycles, 2)
+        self.assertEqual(self.u.new_cycles, 2)
+        self.assertIsNone(self.d.sock)
+
+    def test_stamp_on_import(self):
+        self.d.run_cycle()
+        self.assertIn('fetcher', self.d.worker_stamps)
+        self.assertEqual(self.d.worker_stamps['fetcher'],
+                         self.d.worker_stamp('fetcher'))
+
+    def test_reload_unchanged(self):
+        self.d.run_cycle()
+        self.d.reload_changed()
+        self.assertEqual(self.u.forgotten, [])
+        self.assertIn('fetcher', self.u.workers)
+
+    def test_reload_changed_worker(self):
+        self.d.run_cycle()
+        self.d.worker_stamps['fetcher'] = []
+        self.d.reload_changed()
+        self.assertEqual(self.u.forgotten, ['fetcher'])
+        self.assertNotIn('fetcher', self.d.worker_stamps)
+        # Stamped again once it has been remade.
+        self.d.run_cycle()
+        self.assertIn('fetcher', self.d.worker_stamps)
+
+    def test_changed_during_cycle(self):
+        stamps = {'fetcher': ['old']}
+        self.d.worker_stamp = lambda name: list(stamps[name])
+
+        def change():
+            stamps['fetcher'] = ['new']
+        self.u.during = change
+        self.d.run_cycle()
+        self.assertEqual(self.d.worker_stamps['fetcher'], ['old'])
+        self.d.reload_changed()
+        self.assertEqual(self.u.forgotten, ['fetcher'])
+
+
+class TreeStampTestCase(unittest.TestCase):
+
+    def test_skip(self):
+        top = resident.package_dir
+        wdir = os.path.join(top, 'workers')
+        full = resident.tree_stamp(top)
+        skipped = resident.tree_stamp(top, skip=(wdir,))
+        self.assertLess(len(skipped), len(full))
+        self.assertEqual(skipped, resident.tree_stamp(top, skip=(wdir,)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+"""Benchmark Update.run_graph() with a slow fetcher bundle.
+
+usage: bench-schedule.py [number_of_bundles] [max_workers]
+
+Builds the work of a typical software rollout: the fetcher downloads
+a number of bundles and packageman installs a package from each
+bundle once it has arrived. One bundle is big and slow to download;
+everything else takes a few milliseconds. Fake fetcher and packageman
+workers "do" each work unit by sleeping, and Update.run_graph() hands
+the work out on a thread pool of max_workers threads, two ways:
+
+  batched: the fetcher does all of its ready bundles in one batch at
+    a time (info:concurrentWork="1").
+  per node: the fetcher gets a batch per bundle and does up to four
+    at once (info:concurrentWork="4", as its description says).
+
+For each, the time to do everything and the mean time at which the
+packages were installed are shown.
+"""
+
+import inspect
+import os
+import sys
+import threading
+import time
+
+mydir = os.path.dirname(inspect.getfile(inspect.currentframe()))
+os.environ['MACHINATION_BOOTSTRAP_DIR'] = os.path.join(mydir, 'cache')
+from lxml.builder import E
+from machination import context
+from machination.update import Update, WorkGraph
+from machination.xmltools import MRXpath
+
+# Keep the log quiet: only warnings and errors.
+for dest in context.logger.loggers:
+    dest[1] = 1
+
+
+class SleepWorker(object):
+    """Does each work unit by sleeping for durations[wu id]."""
+
+    def __init__(self, durations, finished):
+        self.durations = durations
+        self.finished = finished
+        self.lock = threading.Lock()
+
+    def do_work(self, wus):
+        results = E.results()
+        for wu in wus:
+            time.sleep(self.durations[wu.get('id')])
+            with self.lock:
+                self.finished[wu.get('id')] = time.perf_counter()
+            results.append(E.wu(id=wu.get('id'), status='success'))
+        return results
+
+
+def make_work(nbundles, fast=0.005, slow=0.5):
+    """Return [durations, depends, status] for the rollout."""
+    durations = {}
+    depends = {}
+    bundles = []
+    packages = []
+    for i in range(nbundles):
+        bid = 'b{}'.format(i)
+        bundle = "/status/worker[@id='fetcher']/bundle[@id='{}']".format(bid)
+        package = "/status/worker[@id='packageman']/package[@id='{}']".format(
+            bid)
+        durations[bundle] = slow if i == 0 else fast
+        durations[package] = fast
+        depends[package] = [bundle]
+        bundles.append(E.bundle('old', id=bid))
+        packages.append(E.package('old', id=bid))
+    status = E.status(E.worker(*bundles, id='fetcher'),
+                      E.worker(*packages, id='packageman'))
+    return [durations, depends, status]
+
+
+def run(durations, depends, status, max_workers, fetcher_concurrency):
+    """Return [seconds taken, mean seconds until a package was done]."""
+    finished = {}
+    u = Update()
+    u.dispatch_config = lambda: ['thread', max_workers]
+    u.work_concurrency = lambda name: (
+        fetcher_concurrency if name == 'fetcher' else 1)
+    for wname in ('fetcher', 'packageman'):
+        u.workers[wname] = SleepWorker(durations, finished)
+    wus = [E.wu(E(MRXpath(wid).name(), 'new', id=MRXpath(wid).id()),
+                op='datamod', id=wid)
+           for wid in durations]
+    graph = WorkGraph(durations, depends)
+    start = time.perf_counter()
+    u.run_graph(graph, wus, depends, {}, status)
+    taken = time.perf_counter() - start
+    installed = [t - start for wid, t in finished.items()
+                 if 'packageman' in wid]
+    return [taken, sum(installed) / len(installed)]
+
+
+if __name__ == '__main__':
+    nbundles = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    durations, depends, status = make_work(nbundles)
+    print('{} bundles and packages, {} workers, {:.2f}s of work'.format(
+            nbundles, max_workers, sum(durations.values())))
+    results = [
+        ('batched', run(durations, depends, status, max_workers, 1)),
+        ('per node', run(durations, depends, status, max_workers, 4)),
+        ]
+    print('{:10} {:>8} {:>16}'.format('', 'total', 'mean installed'))
+    for name, [taken, installed] in results:
+        print('{:10} {:7.3f}s {:15.3f}s'.format(name, taken, installed))
+    print('speedup of mean installed time: {:.2f}x'.format(
+            results[0][1][1] / results[1][1][1]))
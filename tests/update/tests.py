@@ -8,19 +8,45 @@ from lxml.builder import E
 import pkgutil
 import importlib
 import sys
+import copy
+import shutil
+import tempfile
+import threading
 
 myfile = inspect.getfile(inspect.currentframe())
 mydir = os.path.dirname(inspect.getfile(inspect.currentframe()))
 os.environ['MACHINATION_BOOTSTRAP_DIR'] = os.path.join(mydir, 'cache')
+from machination import update
 from machination.update import Update
+from machination.update import WorkGraph
 from machination.workers import dummyordered as do
 from machination import xmltools
+from machination.xmltools import MRXpath
 from machination.webclient import WebClient
+sys.path.insert(0, os.path.join(mydir, '..', 'webclient'))
+from standin import StandInHierarchy, AssertionSource
 
 
-class UpdateTestCase(unittest.TestCase):
+class CacheDirTestCase(unittest.TestCase):
+    """Points context.cache_dir() at a temporary directory."""
 
     def setUp(self):
+        self.cachedir = tempfile.TemporaryDirectory()
+        self.oldcache = os.environ.get('MACHINATION_CACHE_DIR')
+        os.environ['MACHINATION_CACHE_DIR'] = self.cachedir.name
+
+    def tearDown(self):
+        if self.oldcache is None:
+            del os.environ['MACHINATION_CACHE_DIR']
+        else:
+            os.environ['MACHINATION_CACHE_DIR'] = self.oldcache
+        self.cachedir.cleanup()
+
+
+class UpdateTestCase(CacheDirTestCase):
+
+    def setUp(self):
+        CacheDirTestCase.setUp(self)
         self.u = Update()
         st = etree.fromstring(
             """
@@ -62,8 +88,547 @@ class UpdateTestCase(unittest.TestCase):
         print()
         print(xmltools.pstring(st))
 
+class WorkGraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # a -> b -> d, c -> d, e on its own
+        self.g = WorkGraph(['a', 'b', 'c', 'e'],
+                           {'b': ['a'], 'd': ['b', 'c']})
+
+    def test_initially_ready(self):
+        self.assertEqual(self.g.take_ready(), ['a', 'c', 'e'])
+        self.assertEqual(self.g.take_ready(), [])
+        # 'd' was only mentioned as a dependent
+        self.assertIn('d', self.g.unfinished)
+
+    def test_ready_without_level_barrier(self):
+        self.g.take_ready()
+        # 'b' only needs 'a': it shouldn't wait for 'c' or 'e'
+        self.g.finish('a')
+        self.assertEqual(self.g.take_ready(), ['b'])
+        self.g.finish('b')
+        self.assertEqual(self.g.take_ready(), [])
+        self.g.finish('c')
+        self.assertEqual(self.g.take_ready(), ['d'])
+
+    def test_finish_twice(self):
+        self.g.take_ready()
+        self.g.finish('a')
+        self.g.finish('a')
+        self.assertEqual(self.g.take_ready(), ['b'])
+
+    def test_cycle_never_ready(self):
+        g = WorkGraph([], {'x': ['y'], 'y': ['x']})
+        self.assertEqual(g.take_ready(), [])
+        self.assertEqual(g.unfinished, {'x', 'y'})
+
+class FakeWorker(object):
+
+    def __init__(self, name, barrier=None):
+        self.name = name
+        self.barrier = barrier
+        self.generated = 0
+        self.thread = None
+
+    def generate_status(self):
+        self.generated += 1
+        self.thread = threading.current_thread()
+        if self.barrier is not None:
+            # Only gets through if all the workers sharing the barrier
+            # are generating their statuses at once.
+            self.barrier.wait()
+        return E.worker(E.item('gen{}'.format(self.generated), id='1'),
+                        id=self.name)
+
+
+class PartialWorker(object):
+    """Has items 1 (changed) and 3 (new); item 2 has gone."""
+
+    def __init__(self, name):
+        self.name = name
+        self.asked = []
+
+    def generate_status(self, paths=None):
+        self.asked.append(paths)
+        items = {'1': 'new1', '3': 'new3'}
+        welt = E.worker(id=self.name)
+        if paths is None:
+            wanted = sorted(items)
+        else:
+            wanted = [MRXpath(p).id() for p in paths]
+        for i in wanted:
+            if i in items:
+                welt.append(E.item(items[i], id=i))
+        return welt
+
+
+class GatherStatusTestCase(CacheDirTestCase):
+
+    def setUp(self):
+        CacheDirTestCase.setUp(self)
+        self.u = Update(desired_status=E.status(E.worker(id='new')))
+        self.u.load_previous_status = lambda: E.status(
+            E.worker(E.item('old', id='1'), id='a'),
+            E.worker(E.item('old', id='1'), id='nogen'),
+            E.worker(E.item('old', id='1'), id='b'),
+            )
+        self.u.dispatch_config = lambda: ['thread', 4]
+        self.ttls = {}
+        self.u.status_ttl = lambda name: self.ttls.get(name, 0)
+        self.u.workers = {
+            'a': FakeWorker('a'),
+            'b': FakeWorker('b'),
+            'new': FakeWorker('new'),
+            'nogen': object(),
+            }
+
+    def items(self, status):
+        return [[w.get('id'), w[0].text] for w in status]
+
+    def test_concurrent(self):
+        barrier = threading.Barrier(3, timeout=5)
+        for name in ['a', 'b', 'new']:
+            self.u.workers[name].barrier = barrier
+        status = self.u.gather_status()
+        self.assertFalse(barrier.broken)
+        self.assertEqual(self.items(status),
+                         [['a', 'gen1'], ['nogen', 'old'],
+                          ['b', 'gen1'], ['new', 'gen1']])
+
+    def test_caller_thread(self):
+        self.u.in_caller_thread = lambda name: name == 'a'
+        self.u.gather_status()
+        self.assertIs(self.u.workers['a'].thread, threading.current_thread())
+        self.assertIsNot(self.u.workers['b'].thread,
+                         threading.current_thread())
+
+    def test_ttl(self):
+        self.ttls['a'] = 60
+        self.u.gather_status()
+        status = self.u.gather_status()
+        self.assertEqual(self.items(status),
+                         [['a', 'gen1'], ['nogen', 'old'],
+                          ['b', 'gen2'], ['new', 'gen2']])
+        self.assertEqual(self.u.workers['a'].generated, 1)
+
+    def test_invalidate(self):
+        self.ttls['a'] = 60
+        self.u.gather_status()
+        self.u.invalidate_status('a')
+        status = self.u.gather_status()
+        self.assertEqual(status[0][0].text, 'gen2')
+
+    def test_broken_description(self):
+        # Statuses are still gathered, with the default settings.
+        del self.u.status_ttl
+
+        def broken(name, prefix=None):
+            raise etree.XMLSyntaxError('broken', None, 1, 1)
+        saved = update.WorkerDescription
+        update.WorkerDescription = broken
+        try:
+            self.assertEqual(self.u.status_ttl('a'), 0)
+            self.assertFalse(self.u.in_caller_thread('a'))
+            status = self.u.gather_status()
+        finally:
+            update.WorkerDescription = saved
+        self.assertEqual(self.items(status),
+                         [['a', 'gen1'], ['nogen', 'old'],
+                          ['b', 'gen1'], ['new', 'gen1']])
+
+    def test_refresh_some(self):
+        start = self.u.load_previous_status()
+        status = self.u.refresh_status(workers={'b', 'new'}, status=start)
+        self.assertEqual(self.items(status),
+                         [['a', 'old'], ['nogen', 'old'],
+                          ['b', 'gen1'], ['new', 'gen1']])
+        self.assertEqual(self.u.workers['a'].generated, 0)
+        # status itself is left alone
+        self.assertEqual(self.items(start),
+                         [['a', 'old'], ['nogen', 'old'], ['b', 'old']])
+
+    def path(self, wname, i):
+        return "/status/worker[@id='{}']/item[@id='{}']".format(wname, i)
+
+    def partial_setup(self):
+        self.u.workers['p'] = PartialWorker('p')
+        start = E.status(
+            E.worker(E.item('old1', id='1'), E.item('old2', id='2'),
+                     E.item('old4', id='4'), id='p'),
+            E.worker(E.item('old', id='1'), id='a'),
+            )
+        xmltools.mhash(start)
+        return start
+
+    def test_refresh_partial(self):
+        start = self.partial_setup()
+        paths = {'p': [self.path('p', i) for i in ('1', '2', '3')],
+                 'a': [self.path('a', '1')]}
+        status = self.u.refresh_status(workers=['p', 'a'], status=start,
+                                       paths=paths)
+        self.assertEqual(self.u.workers['p'].asked, [paths['p']])
+        self.assertEqual(
+            [[i.get('id'), i.text] for i in status[0]],
+            [['1', 'new1'], ['4', 'old4'], ['3', 'new3']])
+        # 'a' can't do partial status, so regenerates all of it
+        self.assertEqual(self.items(status)[1], ['a', 'gen1'])
+        # stored hashes are as if calculated from scratch
+        rehashed = copy.deepcopy(status)
+        xmltools.mhash(rehashed)
+        self.assertEqual(etree.tostring(status), etree.tostring(rehashed))
+
+    def test_refresh_partial_whole_worker(self):
+        start = self.partial_setup()
+        status = self.u.refresh_status(
+            workers=['p'], status=start,
+            paths={'p': ["/status/worker[@id='p']"]})
+        self.assertEqual(self.u.workers['p'].asked,
+                         [["/status/worker[@id='p']"], None])
+        self.assertEqual([i.get('id') for i in status[0]], ['1', '3'])
+
+    def test_refresh_none(self):
+        status = self.u.refresh_status(workers=[])
+        self.assertEqual(self.items(status),
+                         [['a', 'old'], ['nogen', 'old'], ['b', 'old']])
+
+
+class RecordingWorker(object):
+    """Does work by reporting success, except for wus in fail."""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.done = []
+
+    def do_work(self, wus):
+        results = E.results()
+        for wu in wus:
+            self.done.append([wu.get('op'), MRXpath(wu.get('id')).id()])
+            if wu.get('id') in self.fail:
+                results.append(E.wu(id=wu.get('id'), status='error',
+                                    message='told to fail'))
+            else:
+                results.append(E.wu(id=wu.get('id'), status='success'))
+        return results
+
+
+class DoUpdateTestCase(CacheDirTestCase):
+
+    def setUp(self):
+        CacheDirTestCase.setUp(self)
+        self.written = []
+
+    def update(self, initial, desired, deps=(), fail=(), refresh=None):
+        """Run do_update() with a RecordingWorker as dummyordered."""
+        desired = E.status(E.worker(*desired, id='dummyordered'),
+                           E.deps(*deps))
+        u = Update(
+            initial_status=E.status(E.worker(*initial, id='dummyordered')),
+            desired_status=desired)
+        u.workers['dummyordered'] = RecordingWorker(
+            [self.path(i) for i in fail])
+        u.write_status = lambda status, fname: (
+            self.written.append(copy.deepcopy(status)))
+        if refresh is not None:
+            u.refresh_status = refresh
+        u.do_update()
+        return u.workers['dummyordered'].done
+
+    def path(self, i, tag='sysitem'):
+        return "/status/worker[@id='dummyordered']/{}[@id='{}']".format(
+            tag, i)
+
+    def items(self):
+        return [[elt.tag, elt.get('id'), elt.text]
+                for elt in self.written[-1].xpath('/status/worker/*')]
+
+    def test_do_update(self):
+        done = self.update(
+            [E.sysitem('one', id='1'), E.sysitem('two', id='2'),
+             E.sysitem('three', id='3'), E.notordered('x', id='x')],
+            [E.sysitem('ONE', id='1'), E.sysitem('two', id='2'),
+             E.sysitem('four', id='4'), E.notordered('x', id='x'),
+             E.notordered('y', id='y')])
+        self.assertEqual(sorted(done),
+                         [['add', '4'], ['add', 'y'], ['datamod', '1'],
+                          ['remove', '3']])
+        self.assertEqual(self.items(),
+                         [['sysitem', '1', 'ONE'], ['sysitem', '2', 'two'],
+                          ['sysitem', '4', 'four'],
+                          ['notordered', 'x', 'x'],
+                          ['notordered', 'y', 'y']])
+        # previous-status is written once per cycle
+        self.assertEqual(len(self.written), 1)
+
+    def test_refresh_fails(self):
+        # The calculated status is kept if gathering the new one fails.
+        def refresh(**kwargs):
+            raise RuntimeError('generate_status failed')
+        with self.assertRaises(RuntimeError):
+            self.update([E.sysitem('one', id='1')],
+                        [E.sysitem('ONE', id='1')], refresh=refresh)
+        self.assertEqual(len(self.written), 1)
+        self.assertEqual(self.items(), [['sysitem', '1', 'ONE']])
+
+    def test_statuses_not_altered(self):
+        initial = E.status(E.worker(E.sysitem('one', id='1'),
+                                    id='dummyordered'))
+        before = etree.tostring(initial)
+        u = Update(initial_status=initial, desired_status=E.status())
+        self.assertEqual(etree.tostring(initial), before)
+        self.assertIsNotNone(
+            u.initial_status().get(xmltools.HASH_ATT))
+
+    def test_same_id_in_batch(self):
+        u = Update()
+        cid = self.path('c')
+        status = E.status(E.worker(
+                E.sysitem('a', id='a'), E.sysitem('b', id='b'),
+                E.sysitem('c', id='c'), id='dummyordered'))
+        workelt = E.wus(
+            E.wu(E.sysitem('c2', id='c'), op='datamod', id=cid),
+            E.wu(op='move', id=cid, pos='<first>'),
+            worker='dummyordered')
+        outcome = [True, RecordingWorker().do_work(workelt)]
+        work_status = {}
+        u.merge_outcome('dummyordered', workelt, outcome, work_status,
+                        status, {})
+        self.assertEqual([r[1].get('op') for r in work_status[cid]],
+                         ['datamod', 'move'])
+        self.assertEqual([[e.get('id'), e.text] for e in status[0]],
+                         [['c', 'c2'], ['a', 'a'], ['b', 'b']])
+
+    def test_modified_and_moved(self):
+        done = self.update(
+            [E.sysitem('a', id='a'), E.sysitem('b', id='b'),
+             E.sysitem('c', id='c')],
+            [E.sysitem('changed', id='c'), E.sysitem('a', id='a'),
+             E.sysitem('b', id='b')])
+        self.assertEqual(done, [['datamod', 'c'], ['move', 'c']])
+        self.assertEqual(self.items(),
+                         [['sysitem', 'c', 'changed'], ['sysitem', 'a', 'a'],
+                          ['sysitem', 'b', 'b']])
+
+    def test_add_after_failed_add(self):
+        dep = E.dep(id='d', src=self.path('y', 'notordered'),
+                    op='requires', tgt=self.path('4'))
+        done = self.update(
+            [E.sysitem('one', id='1')],
+            [E.sysitem('one', id='1'), E.sysitem('four', id='4'),
+             E.notordered('y', id='y'), E.notordered('z', id='z')],
+            deps=[dep], fail=['4'])
+        # z goes after y, which is never added: it ends up where y
+        # would have gone.
+        self.assertEqual(done, [['add', '4'], ['add', 'z']])
+        self.assertEqual(self.items(),
+                         [['sysitem', '1', 'one'],
+                          ['notordered', 'z', 'z']])
+
+    def test_failed_dependency(self):
+        dep = E.dep(id='d', src=self.path('y', 'notordered'),
+                    op='requires', tgt=self.path('4'))
+        done = self.update(
+            [E.sysitem('one', id='1')],
+            [E.sysitem('one', id='1'), E.sysitem('four', id='4'),
+             E.notordered('z', id='z'), E.notordered('y', id='y')],
+            deps=[dep], fail=['4'])
+        # y waits for 4, which fails, so y is never attempted.
+        self.assertEqual(done, [['add', '4'], ['add', 'z']])
+        self.assertEqual(self.items(),
+                         [['sysitem', '1', 'one'],
+                          ['notordered', 'z', 'z']])
+
+
+class BlockingWorker(RecordingWorker):
+    """Holds up the wu for item 'slow' until the one for 'after' is done."""
+
+    def __init__(self):
+        RecordingWorker.__init__(self)
+        self.after_done = threading.Event()
+
+    def do_work(self, wus):
+        for wu in wus:
+            item = MRXpath(wu.get('id')).id()
+            if item == 'slow':
+                self.waited = self.after_done.wait(5)
+            elif item == 'after':
+                self.after_done.set()
+        return RecordingWorker.do_work(self, wus)
+
+
+class RunGraphTestCase(CacheDirTestCase):
+
+    def path(self, i):
+        return "/status/worker[@id='dummyordered']/sysitem[@id='{}']".format(
+            i)
+
+    def test_slow_wu_holds_up_only_dependents(self):
+        u = Update()
+        u.dispatch_config = lambda: ['thread', 4]
+        u.work_concurrency = lambda name: 2
+        worker = BlockingWorker()
+        u.workers['dummyordered'] = worker
+        items = ['slow', 'fast', 'after']
+        status = E.status(E.worker(
+                *[E.sysitem('old', id=i) for i in items], id='dummyordered'))
+        wus = [E.wu(E.sysitem('new', id=i), op='datamod', id=self.path(i))
+               for i in items]
+        depends = {self.path('after'): [self.path('fast')]}
+        graph = WorkGraph([self.path(i) for i in items], depends)
+        work_status = {}
+        ran = u.run_graph(graph, wus, depends, work_status, status)
+        # 'after' ran while 'slow' was still going.
+        self.assertTrue(worker.waited)
+        self.assertEqual(sorted(ran['dummyordered']),
+                         sorted(self.path(i) for i in items))
+        self.assertEqual([e.text for e in status[0]], ['new'] * 3)
+
+    def test_caller_thread(self):
+        u = Update()
+        u.dispatch_config = lambda: ['thread', 4]
+        u.in_caller_thread = lambda name: True
+        threads = []
+        worker = RecordingWorker()
+        worker.do_work = lambda wus: (
+            threads.append(threading.current_thread()) or
+            RecordingWorker.do_work(worker, wus))
+        u.workers['dummyordered'] = worker
+        status = E.status(E.worker(E.sysitem('old', id='1'),
+                                   id='dummyordered'))
+        wus = [E.wu(E.sysitem('new', id='1'), op='datamod',
+                    id=self.path('1'))]
+        graph = WorkGraph([self.path('1')], {})
+        u.run_graph(graph, wus, {}, {}, status)
+        self.assertEqual(threads, [threading.current_thread()])
+        self.assertEqual(status[0][0].text, 'new')
+
+
+class ProcessWorkTestCase(CacheDirTestCase):
+
+    def tearDown(self):
+        CacheDirTestCase.tearDown(self)
+        update._process_update = None
+
+    def test_worker_kept(self):
+        update._process_update = Update()
+        worker = RecordingWorker()
+        update._process_update.workers['rec'] = worker
+        for i in ('1', '2'):
+            wus = E.wus(E.wu(op='add', id="/status/worker[@id='rec']/"
+                             "item[@id='{}']".format(i)))
+            outcome = update.run_work_in_process('rec', etree.tostring(wus))
+            self.assertTrue(outcome[0])
+        self.assertEqual(worker.done, [['add', '1'], ['add', '2']])
+
+
+assertion_data = {
+    'hcs': [['1']],
+    'mps': [['1']],
+    'mpolicy_attachments': {},
+    'attachments': [
+        {'id': '1', 'hc_id': '1', 'is_mandatory': '0',
+         'mpath': "/status/worker[@id='__machination__']/item[@id='1']",
+         'ass_op': 'hastext', 'ass_arg': 'one',
+         'action_op': 'settext', 'action_arg': None},
+        ],
+    }
+
+
+class DesiredStatusTestCase(CacheDirTestCase):
+
+    def setUp(self):
+        CacheDirTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.source = AssertionSource(copy.deepcopy(assertion_data))
+        self.server = StandInHierarchy(self.source.calls()).start()
+        test = self
+
+        class U(Update):
+            written = []
+
+            def webclient(self, service_id):
+                return WebClient(test.server.url, 'public', 'os_instance')
+
+            def assertion_list_file(self):
+                return os.path.join(test.dir, 'assertion-list.xml')
+
+            def write_status(self, status, fname):
+                U.written.append(etree.tostring(status))
+        self.U = U
+
+    def tearDown(self):
+        CacheDirTestCase.tearDown(self)
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def calls(self):
+        return [r.get('call') for r in self.server.requests]
+
+    def item(self, status):
+        return status.xpath(
+            '/status/worker[@id="__machination__"]/item[@id="1"]/text()'
+            )
+
+    def test_first(self):
+        status = self.U().desired_status()
+        self.assertEqual(self.item(status), ['one'])
+        self.assertEqual(len(self.U.written), 1)
+        self.assertEqual(self.calls(), ['GetAssertionListIfChanged'])
+        revision, fetched, data = self.U().load_assertion_list()
+        self.assertEqual(revision, self.source.revision())
+        self.assertEqual(data, assertion_data)
+
+    def test_unchanged(self):
+        self.U().desired_status()
+        status = self.U().desired_status()
+        # The desired status from context, not compiled again.
+        self.assertEqual(self.item(status), [])
+        self.assertEqual(len(self.U.written), 1)
+        self.assertEqual(self.server.requests[1][2].text,
+                         self.source.revision())
+
+    def test_changed(self):
+        self.U().desired_status()
+        self.source.data['attachments'][0]['ass_arg'] = 'two'
+        status = self.U().desired_status()
+        self.assertEqual(self.item(status), ['two'])
+        self.assertEqual(len(self.U.written), 2)
+        self.assertEqual(self.U().load_assertion_list()[0],
+                         self.source.revision())
+
+    def test_too_old(self):
+        self.U().desired_status()
+        revision, fetched, data = self.U().load_assertion_list()
+        elt = etree.parse(self.U().assertion_list_file()).getroot()
+        elt.set('fetched', repr(fetched - update.ASSERTION_LIST_MAX_AGE - 1))
+        etree.ElementTree(elt).write(self.U().assertion_list_file())
+        self.U().desired_status()
+        self.assertEqual(len(self.U.written), 2)
+        self.assertEqual(self.server.requests[1][2].tag, 'u')
+
+    def test_old_server(self):
+        self.source.if_changed = False
+        self.server.calls = self.source.calls()
+        status = self.U().desired_status()
+        self.assertEqual(self.item(status), ['one'])
+        self.assertEqual(self.calls(),
+                         ['GetAssertionListIfChanged', 'GetAssertionList'])
+        self.assertEqual(self.U().load_assertion_list()[0], None)
+
+
 if __name__ == '__main__':
     upsuite = unittest.TestLoader().loadTestsFromTestCase(UpdateTestCase)
+    wgsuite = unittest.TestLoader().loadTestsFromTestCase(WorkGraphTestCase)
+    gssuite = unittest.TestLoader().loadTestsFromTestCase(GatherStatusTestCase)
+    dssuite = unittest.TestLoader().loadTestsFromTestCase(DesiredStatusTestCase)
+    dusuite = unittest.TestLoader().loadTestsFromTestCase(DoUpdateTestCase)
+    pwsuite = unittest.TestLoader().loadTestsFromTestCase(ProcessWorkTestCase)
+    rgsuite = unittest.TestLoader().loadTestsFromTestCase(RunGraphTestCase)
     alltests = unittest.TestSuite([])
 #    unittest.TextTestRunner(verbosity=2).run(alltests)
     unittest.TextTestRunner(verbosity=2).run(upsuite)
+    unittest.TextTestRunner(verbosity=2).run(wgsuite)
+    unittest.TextTestRunner(verbosity=2).run(gssuite)
+    unittest.TextTestRunner(verbosity=2).run(dssuite)
+    unittest.TextTestRunner(verbosity=2).run(dusuite)
+    unittest.TextTestRunner(verbosity=2).run(pwsuite)
+    unittest.TextTestRunner(verbosity=2).run(rgsuite)
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+"""Benchmark WebClient calls to a local HTTPS stand-in hierarchy.
+
+usage: bench-keepalive.py [number_of_calls]
+
+Times 'cert' authenticated calls made as WebClient used to make them
+(urlopen() with a new SSLContext, certificate load, TCP connection
+and TLS handshake every call) against calls over the persistent
+connection pool, and over the pool when the server closes every
+connection (so only the cached context and TLS session resumption
+help).
+"""
+
+import inspect
+import os
+import shutil
+import ssl
+import sys
+import tempfile
+import time
+
+mydir = os.path.dirname(inspect.getfile(inspect.currentframe()))
+os.environ['MACHINATION_BOOTSTRAP_DIR'] = os.path.join(
+    mydir, '..', 'update', 'cache'
+    )
+sys.path.insert(0, mydir)
+from machination import context
+from machination import webclient
+from machination.webclient import WebClient
+from standin import StandInHierarchy, make_certificate
+
+# Only the timings are wanted.
+context.logger.loggers = []
+
+
+class OldHandler(webclient.HTTPSClientAuthHandler):
+    """HTTPSClientAuthHandler as it was: a new SSLContext every time.
+
+    (Less the PROTOCOL_TLSv1 pin, which OpenSSL now refuses.)
+    """
+
+    def getConnection(self, host, timeout=None):
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+        ctx.load_cert_chain(certfile=self.cert, keyfile=self.key)
+        return webclient.http_client.HTTPSConnection(host, context=ctx)
+
+
+def per_call(wc, ncalls):
+    wc.call('Echo', 'warm up')
+    start = time.perf_counter()
+    for i in range(ncalls):
+        wc.call('Echo', str(i))
+    return (time.perf_counter() - start) / ncalls
+
+
+if __name__ == '__main__':
+    ncalls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    tmpdir = tempfile.mkdtemp()
+    try:
+        certificate = make_certificate(tmpdir)
+        if certificate is None:
+            print('need openssl to make a certificate')
+            sys.exit(1)
+        key, cert = certificate
+        cred = {'key': key, 'cert': cert}
+        calls = {'Echo': lambda *args: list(args)}
+        results = []
+
+        with StandInHierarchy(calls, certificate) as server:
+            wc = WebClient(server.url, 'cert', 'os_instance',
+                           credentials=cred)
+            wc.use_pool = False
+            wc.opener = webclient.urllib_request.build_opener(
+                OldHandler(key, cert)
+                )
+            results.append(('urlopen (old)', per_call(wc, ncalls),
+                            server.connections, server.resumed))
+
+        with StandInHierarchy(calls, certificate) as server:
+            wc = WebClient(server.url, 'cert', 'os_instance',
+                           credentials=cred)
+            results.append(('pool', per_call(wc, ncalls),
+                            server.connections, server.resumed))
+            wc.pool().close()
+
+        with StandInHierarchy(calls, certificate,
+                              keep_alive=False) as server:
+            wc = WebClient(server.url, 'cert', 'os_instance',
+                           credentials=cred)
+            results.append(('pool, no keep-alive', per_call(wc, ncalls),
+                            server.connections, server.resumed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('{} calls'.format(ncalls))
+    print('{:20} {:>10} {:>12} {:>8}'.format(
+            '', 'ms/call', 'connections', 'resumed'))
+    for name, taken, conns, resumed in results:
+        print('{:20} {:10.3f} {:12} {:8}'.format(
+                name, taken * 1000, conns, resumed))
+    print('speedup {:.1f}x'.format(results[0][1] / results[1][1]))
@@ -0,0 +1,309 @@
+"""A local stand-in for a Machination hierarchy, for tests.
+
+StandInHierarchy speaks the hierarchy's call protocol (an <r
+call="Name"> element POSTed to the server, transport XML back) over
+HTTP/1.1 with keep-alive, optionally over TLS, and answers calls from
+a dictionary of python functions. AsyncStandInHierarchy does the same
+with asyncio, in the caller's event loop, and its calls may be
+coroutines.
+"""
+
+import asyncio
+import hashlib
+import http.client
+import io
+import os
+import ssl
+import subprocess
+import threading
+from lxml import etree
+from machination.xmldata import from_xml, to_xml
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+
+def make_certificate(directory):
+    """Make a self signed key and certificate in directory.
+
+    Returns (keyfile, certfile), or None if openssl isn't available.
+    """
+    keyfile = os.path.join(directory, 'standin.key')
+    certfile = os.path.join(directory, 'standin.crt')
+    try:
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+             '-keyout', keyfile, '-out', certfile, '-days', '1',
+             '-subj', '/CN=localhost'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return keyfile, certfile
+
+
+class AssertionSource(object):
+    """The assertion list calls of a stand-in hierarchy.
+
+    Serves self.data (which may be changed between calls) through
+    GetAssertionList and, unless if_changed=False, through
+    GetAssertionListIfChanged with revisions as WebHierarchy makes
+    them: a hash of the whole list.
+    """
+
+    def __init__(self, data, if_changed=True):
+        self.data = data
+        self.if_changed = if_changed
+
+    def revision(self):
+        return hashlib.sha256(etree.tostring(to_xml(self.data))).hexdigest()
+
+    def get(self, type_name, obj_name):
+        return self.data
+
+    def get_if_changed(self, type_name, obj_name, revision):
+        if revision == self.revision():
+            return {'revision': revision, 'not_modified': '1'}
+        return {'revision': self.revision(), 'assertions': self.data}
+
+    def calls(self):
+        """Return {call name: function} for StandInHierarchy."""
+        calls = {'GetAssertionList': self.get}
+        if self.if_changed:
+            calls['GetAssertionListIfChanged'] = self.get_if_changed
+        return calls
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately: don't let Nagle's
+    # algorithm hold the body back waiting for a delayed ACK.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.note_connection(self.connection)
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = etree.fromstring(self.rfile.read(length))
+        self.server.requests.append(request)
+        status, body = self.server.answer(request, self.headers)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        if self.server.batch:
+            self.send_header('X-Machination-Batch', '1')
+        if not self.server.keep_alive:
+            self.send_header('Connection', 'close')
+        if not self.server.keep_alive or self.server.drop_idle:
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInHierarchy(ThreadingMixIn, HTTPServer):
+    """A stand-in hierarchy server running in a thread.
+
+    calls maps call names to functions taking the call's arguments.
+    With certificate=(keyfile, certfile) the server talks TLS. With
+    keep_alive=False the server closes each connection after one
+    request; with drop_idle=True it does so without telling the client,
+    like a server timing out an idle connection. With batch=True the
+    server takes several calls in one <r call="Batch"> request and
+    says so in an X-Machination-Batch header.
+
+    After some calls, self.requests holds the <r> elements received,
+    self.connections the number of connections accepted and
+    self.resumed how many of those resumed an earlier TLS session.
+    """
+    daemon_threads = True
+
+    def __init__(self, calls=None, certificate=None, keep_alive=True,
+                 drop_idle=False, batch=False):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.calls = calls or {}
+        self.keep_alive = keep_alive
+        self.drop_idle = drop_idle
+        self.batch = batch
+        self.requests = []
+        self.connections = 0
+        self.resumed = 0
+        self.lock = threading.Lock()
+        self.scheme = 'http'
+        if certificate is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile=certificate[1],
+                                    keyfile=certificate[0])
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+            self.scheme = 'https'
+        self.thread = None
+
+    @property
+    def url(self):
+        """The hierarchy URL to give a WebClient."""
+        return '{}://127.0.0.1:{}/hierarchy'.format(self.scheme,
+                                                    self.server_port)
+
+    def note_connection(self, conn):
+        with self.lock:
+            self.connections += 1
+            if getattr(conn, 'session_reused', False):
+                self.resumed += 1
+
+    def answer(self, request, headers):
+        """Return (HTTP status, body) for <r> element request."""
+        if self.batch and request.get('call') == 'Batch':
+            elt = etree.Element('batch')
+            for call_req in request.iterchildren('r'):
+                elt.append(self.result(call_req))
+        else:
+            elt = self.result(request)
+        return 200, etree.tostring(elt, encoding='utf-8')
+
+    def result(self, request):
+        """Return the answer element for one <r> call element."""
+        name = request.get('call')
+        if name not in self.calls:
+            elt = etree.Element('error')
+            etree.SubElement(elt, 'message').text = (
+                'no such call {}'.format(name)
+                )
+        else:
+            try:
+                elt = to_xml(self.calls[name](
+                        *[from_xml(arg) for arg in request]
+                        ))
+            except Exception as e:
+                elt = etree.Element('error')
+                etree.SubElement(elt, 'message').text = str(e)
+        return elt
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class AsyncStandInHierarchy(object):
+    """A stand-in hierarchy server for an asyncio event loop.
+
+    calls maps call names to functions or coroutine functions taking
+    the call's arguments. With chunked=True answers are sent with
+    chunked transfer encoding, as mod_perl does for output of unknown
+    length.
+
+    self.requests, self.connections are as for StandInHierarchy;
+    self.in_flight is the number of calls being answered right now and
+    self.max_in_flight the most there have been at once.
+    """
+
+    def __init__(self, calls=None, chunked=False):
+        self.calls = calls or {}
+        self.chunked = chunked
+        self.requests = []
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.server = None
+
+    @property
+    def url(self):
+        """The hierarchy URL to give a WebClient."""
+        port = self.server.sockets[0].getsockname()[1]
+        return 'http://127.0.0.1:{}/hierarchy'.format(port)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                head = []
+                while True:
+                    line = await reader.readline()
+                    head.append(line)
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                headers = http.client.parse_headers(io.BytesIO(b''.join(head)))
+                request = etree.fromstring(await reader.readexactly(
+                        int(headers.get('Content-Length', 0))
+                        ))
+                self.requests.append(request)
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                try:
+                    body = etree.tostring(await self.result(request),
+                                          encoding='utf-8')
+                finally:
+                    self.in_flight -= 1
+                head = b'HTTP/1.1 200 OK\r\nContent-Type: text/xml\r\n'
+                if self.chunked:
+                    half = len(body) // 2
+                    writer.write(
+                        head + b'Transfer-Encoding: chunked\r\n\r\n' +
+                        b''.join(b'%x\r\n%s\r\n' % (len(c), c)
+                                 for c in (body[:half], body[half:]) if c) +
+                        b'0\r\n\r\n'
+                        )
+                else:
+                    writer.write(head + b'Content-Length: %d\r\n\r\n'
+                                 % len(body) + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def result(self, request):
+        """Return the answer element for one <r> call element."""
+        name = request.get('call')
+        if name not in self.calls:
+            elt = etree.Element('error')
+            etree.SubElement(elt, 'message').text = (
+                'no such call {}'.format(name)
+                )
+            return elt
+        try:
+            ret = self.calls[name](*[from_xml(arg) for arg in request])
+            if asyncio.iscoroutine(ret):
+                ret = await ret
+            return to_xml(ret)
+        except Exception as e:
+            elt = etree.Element('error')
+            etree.SubElement(elt, 'message').text = str(e)
+            return elt
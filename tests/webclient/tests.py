@@ -0,0 +1,403 @@
+#!/usr/bin/python
+
+import unittest
+import asyncio
+import inspect
+import os
+import shutil
+import sys
+import tempfile
+
+mydir = os.path.dirname(inspect.getfile(inspect.currentframe()))
+os.environ['MACHINATION_BOOTSTRAP_DIR'] = os.path.join(
+    mydir, '..', 'update', 'cache'
+    )
+sys.path.insert(0, mydir)
+from lxml import etree
+from machination import context
+from machination import webclient
+from machination.webclient import WebClient
+from machination.asyncwebclient import AsyncWebClient
+from machination.responsecache import ResponseCache
+from standin import StandInHierarchy, AsyncStandInHierarchy, make_certificate
+
+calls = {
+    'Echo': lambda *args: list(args),
+    'Fail': lambda: 1 / 0,
+    'Help': lambda: 'help',
+    }
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInHierarchy(calls).start()
+        self.wc = WebClient(self.server.url, 'public', 'person')
+
+    def tearDown(self):
+        self.wc.pool().close()
+        self.server.stop()
+
+    def test_call(self):
+        self.assertEqual(self.wc.call('Echo', 'a', ['b']), ['a', ['b']])
+
+    def test_keep_alive(self):
+        for i in range(10):
+            self.assertEqual(self.wc.call('Echo', str(i)), [str(i)])
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.requests), 10)
+
+    def test_shared(self):
+        self.wc.call('Echo')
+        other = WebClient(self.server.url, 'public', 'person')
+        self.assertIs(other.pool(), self.wc.pool())
+        other.call('Echo')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_server_closes(self):
+        self.server.drop_idle = True
+        self.wc.call('Echo')
+        self.assertEqual(len(self.wc.pool().idle), 1)
+        # Help is read only: sent again on a new connection.
+        self.assertEqual(self.wc.call('Help'), 'help')
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_server_closes_not_read_only(self):
+        self.server.drop_idle = True
+        self.wc.call('Echo')
+        with self.assertRaises(ConnectionError):
+            self.wc.call('Echo', 'x')
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_no_keep_alive(self):
+        self.server.keep_alive = False
+        self.wc.call('Echo')
+        self.wc.call('Echo')
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.wc.pool().idle, [])
+
+    def test_error(self):
+        with self.assertRaises(Exception):
+            self.wc.call('Fail')
+        # The connection is still good afterwards.
+        self.assertEqual(self.wc.call('Echo', 'x'), ['x'])
+        self.assertEqual(self.server.connections, 1)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def fetch(self, cache, name, key):
+        def func():
+            self.calls.append(key)
+            return {'key': key.decode(), 'list': ['a', None]}
+        return cache.get(name, key, func)
+
+    def test_hit(self):
+        cache = ResponseCache()
+        first = self.fetch(cache, 'Thing', b'<r a="1"/>')
+        self.assertIs(self.fetch(cache, 'Thing', b'<r a="1"/>'), first)
+        self.fetch(cache, 'Thing', b'<r a="2"/>')
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['misses'], 2)
+
+    def test_ttl(self):
+        cache = ResponseCache(ttl=60, calls={'Short': [-1, False]})
+        self.fetch(cache, 'Short', b'<r/>')
+        self.fetch(cache, 'Short', b'<r/>')
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(cache.stats['expired'], 1)
+        self.fetch(cache, 'Long', b'<r x="1"/>')
+        self.fetch(cache, 'Long', b'<r x="1"/>')
+        self.assertEqual(len(self.calls), 3)
+
+    def test_lru(self):
+        cache = ResponseCache(max_entries=2)
+        for key in (b'<r a="1"/>', b'<r a="2"/>', b'<r a="1"/>',
+                    b'<r a="3"/>'):
+            self.fetch(cache, 'Thing', key)
+        self.assertEqual(list(cache.entries),
+                         [b'<r a="1"/>', b'<r a="3"/>'])
+        self.assertEqual(cache.stats['evictions'], 1)
+
+    def test_disk(self):
+        calls = {'TypeInfo': [60, True]}
+        key = b'<r call="TypeInfo"><s>1</s></r>'
+        cache = ResponseCache(calls=calls, store_dir=self.dir)
+        result = self.fetch(cache, 'TypeInfo', key)
+        self.fetch(cache, 'Other', b'<r call="Other"/>')
+        self.assertEqual(len(os.listdir(self.dir)), 1)
+        # A new cache (in another process, say) finds it on disk.
+        other = ResponseCache(calls=calls, store_dir=self.dir)
+        self.assertEqual(self.fetch(other, 'TypeInfo', key), result)
+        self.assertEqual(other.stats['disk_hits'], 1)
+        self.assertEqual(len(self.calls), 2)
+        other.clear()
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_disk_expired(self):
+        key = b'<r call="TypeInfo"/>'
+        cache = ResponseCache(calls={'TypeInfo': [-1, True]},
+                              store_dir=self.dir)
+        self.fetch(cache, 'TypeInfo', key)
+        self.fetch(ResponseCache(calls={'TypeInfo': [60, True]},
+                                 store_dir=self.dir), 'TypeInfo', key)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_disk_corrupt(self):
+        key = b'<r call="TypeInfo"/>'
+        cache = ResponseCache(store_dir=self.dir)
+        with open(cache.disk_name(key), 'w') as f:
+            f.write('<memo')
+        self.fetch(cache, 'TypeInfo', key)
+        self.assertEqual(len(self.calls), 1)
+        self.fetch(ResponseCache(store_dir=self.dir), 'TypeInfo', key)
+        self.assertEqual(len(self.calls), 1)
+
+
+class MemoTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInHierarchy(calls).start()
+        self.wc = WebClient(self.server.url, 'public', 'person')
+
+    def tearDown(self):
+        self.wc.pool().close()
+        self.server.stop()
+
+    def test_memo(self):
+        self.assertEqual(self.wc.memo('Echo', 'a', {'b': 'c'}),
+                         ['a', {'b': 'c'}])
+        self.assertEqual(self.wc.memo('Echo', 'a', {'b': 'c'}),
+                         ['a', {'b': 'c'}])
+        self.wc.memo('Echo', 'b')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.wc.memo_cache.stats['hits'], 1)
+
+    def test_config(self):
+        melt = etree.fromstring(
+            '<memo maxEntries="10" ttl="5" disk="1">'
+            '<call id="Echo" disk="1"/>'
+            '<call id="TypeInfo" ttl="7"/>'
+            '</memo>'
+            )
+        context.machination_worker_elt.append(melt)
+        try:
+            cache = WebClient(self.server.url, 'public', 'person').memo_cache
+        finally:
+            context.machination_worker_elt.remove(melt)
+        self.assertEqual(cache.max_entries, 10)
+        self.assertEqual(cache.call_ttl('Other'), 5)
+        self.assertEqual(cache.call_ttl('Echo'), 5)
+        self.assertEqual(cache.call_ttl('TypeInfo'), 7)
+        self.assertEqual(cache.call_ttl('AllTypesInfo'), 3600)
+        self.assertTrue(cache.on_disk('Echo'))
+        self.assertFalse(cache.on_disk('TypeInfo'))
+        self.assertTrue(cache.store_dir.startswith(context.cache_dir()))
+        self.assertIsNone(self.wc.memo_cache.store_dir)
+
+    def test_not_shared(self):
+        self.wc.memo('Echo', 'a')
+        WebClient(self.server.url, 'public', 'person').memo('Echo', 'a')
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInHierarchy(calls, batch=True).start()
+        self.wc = WebClient(self.server.url, 'public', 'person')
+
+    def tearDown(self):
+        self.wc.pool().close()
+        self.server.stop()
+
+    def test_call_many(self):
+        self.assertEqual(
+            self.wc.call_many([('Echo', ['a']), ('Echo', ()),
+                               ('Echo', ('b', ['c']))]),
+            [['a'], [], ['b', ['c']]]
+            )
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue(self.wc.batch_supported)
+
+    def test_batch(self):
+        with self.wc.batch() as b:
+            one = b.call('Echo', '1')
+            two = b.call('Echo', '2')
+            self.assertIsNone(one.result)
+        self.assertEqual(one.result, ['1'])
+        self.assertEqual(two.result, ['2'])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_error(self):
+        with self.assertRaises(Exception) as cm:
+            self.wc.call_many([('Echo', ()), ('Fail', ()), ('Nope', ())])
+        self.assertIn('division', str(cm.exception))
+        # The other calls were still made.
+        self.assertEqual(len(self.server.requests[0]), 3)
+
+    def test_small(self):
+        self.assertEqual(self.wc.call_many([]), [])
+        self.assertEqual(self.wc.call_many([('Echo', 'x')]), [['x']])
+        self.assertEqual(self.server.requests[0].get('call'), 'Echo')
+
+    def test_unsupported(self):
+        self.server.batch = False
+        self.assertEqual(
+            self.wc.call_many([('Echo', ['a']), ('Echo', ['b'])]),
+            [['a'], ['b']]
+            )
+        self.assertFalse(self.wc.batch_supported)
+        # One failed batch, then one by one from then on.
+        self.assertEqual(
+            [r.get('call') for r in self.server.requests],
+            ['Batch', 'Echo', 'Echo']
+            )
+        self.wc.call_many([('Echo', ['a']), ('Echo', ['b'])])
+        self.assertEqual(len(self.server.requests), 5)
+
+
+async def slow_echo(*args):
+    await asyncio.sleep(0.02)
+    return list(args)
+
+async_calls = dict(calls, Slow=slow_echo)
+
+
+class AsyncWebClientTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = await AsyncStandInHierarchy(async_calls).start()
+        self.wc = AsyncWebClient(self.server.url, 'public', 'person',
+                                 max_concurrent=4)
+
+    async def asyncTearDown(self):
+        await self.wc.close()
+        await self.server.stop()
+
+    async def test_call(self):
+        self.assertEqual(await self.wc.call('Echo', 'a', ['b']),
+                         ['a', ['b']])
+        with self.assertRaises(Exception):
+            await self.wc.call('Fail')
+
+    async def test_keep_alive(self):
+        for i in range(5):
+            self.assertEqual(await self.wc.call('Echo', str(i)), [str(i)])
+        self.assertEqual(self.server.connections, 1)
+
+    async def test_chunked(self):
+        self.server.chunked = True
+        for i in range(1, 4):
+            self.assertEqual(await self.wc.call('Echo', 'x' * 500 * i),
+                             ['x' * 500 * i])
+        self.assertEqual(self.server.connections, 1)
+
+    async def test_concurrency(self):
+        results = await self.wc.call_many(
+            [('Slow', [str(i)]) for i in range(20)]
+            )
+        self.assertEqual(results, [[str(i)] for i in range(20)])
+        self.assertEqual(self.server.max_in_flight, 4)
+        self.assertEqual(self.server.connections, 4)
+
+    async def test_memo(self):
+        results = await asyncio.gather(
+            *[self.wc.memo('Slow', 'a') for i in range(5)]
+            )
+        self.assertEqual(results, [['a']] * 5)
+        self.assertEqual(await self.wc.memo('Slow', 'a'), ['a'])
+        self.assertEqual(len(self.server.requests), 1)
+
+    async def test_memo_shared(self):
+        await self.wc.memo('Echo', 'a')
+        self.assertEqual(self.wc.wc.memo('Echo', 'a'), ['a'])
+        self.assertEqual(len(self.server.requests), 1)
+
+    async def test_memo_failure(self):
+        for i in range(2):
+            with self.assertRaises(Exception):
+                await self.wc.memo('Fail')
+        self.assertEqual(len(self.server.requests), 2)
+
+    async def test_threaded_server(self):
+        # Against the threaded stand-in, which closes idle connections.
+        server = StandInHierarchy(calls, drop_idle=True).start()
+        try:
+            wc = AsyncWebClient(server.url, 'public', 'person')
+            self.assertEqual(await wc.call('Echo', 'a'), ['a'])
+            self.assertEqual(await wc.call('Help'), 'help')
+            self.assertEqual(server.connections, 2)
+            # Echo isn't read only, so isn't sent again.
+            with self.assertRaises(ConnectionError):
+                await wc.call('Echo', 'b')
+            self.assertEqual(len(server.requests), 2)
+            await wc.close()
+        finally:
+            server.stop()
+
+
+class TLSTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.certificate = make_certificate(cls.dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def setUp(self):
+        if self.certificate is None:
+            self.skipTest('no openssl to make a certificate with')
+        self.server = StandInHierarchy(calls, self.certificate).start()
+        key, cert = self.certificate
+        self.wc = WebClient(self.server.url, 'cert', 'os_instance',
+                            credentials={'key': key, 'cert': cert})
+
+    def tearDown(self):
+        self.wc.pool().close()
+        self.server.stop()
+
+    def test_context_cached(self):
+        key, cert = self.certificate
+        self.assertIs(webclient.client_ssl_context(key, cert),
+                      webclient.client_ssl_context(key, cert))
+
+    def test_keep_alive(self):
+        for i in range(5):
+            self.assertEqual(self.wc.call('Echo', str(i)), [str(i)])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_async(self):
+        key, cert = self.certificate
+
+        async def calls():
+            wc = AsyncWebClient(self.server.url, 'cert', 'os_instance',
+                                credentials={'key': key, 'cert': cert})
+            async with wc:
+                return await wc.call_many([('Echo', [str(i)])
+                                           for i in range(3)])
+        self.assertEqual(asyncio.run(calls()), [['0'], ['1'], ['2']])
+
+    def test_session_resumed(self):
+        self.server.keep_alive = False
+        for i in range(3):
+            self.wc.call('Echo')
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(self.server.resumed, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
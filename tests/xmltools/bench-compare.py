@@ -0,0 +1,89 @@
+#!/usr/bin/python
+"""Benchmark the indexed XMLCompare engine against the xpath one.
+
+usage: bench-compare.py [number_of_items]
+
+Builds a synthetic status document with roughly 4 x number_of_items
+elements and a copy with some data, attribute, order and structural
+changes, then times the engines and checks that they agree.
+"""
+
+import copy
+import inspect
+import os
+import sys
+import time
+from lxml import etree
+
+mydir = os.path.dirname(inspect.getfile(inspect.currentframe()))
+os.environ['MACHINATION_BOOTSTRAP_DIR'] = mydir
+from machination.xmltools import XMLCompare
+from machination.xmltools import mhash
+
+
+def make_status(nitems, changed=False):
+    status = etree.Element('status')
+    nworkers = 10
+    for w in range(nworkers):
+        welt = etree.SubElement(status, 'worker', id='w{}'.format(w))
+        ids = list(range(nitems // nworkers))
+        if changed and w % 2:
+            # reorder a couple of items
+            ids[0], ids[1] = ids[1], ids[0]
+        for i in ids:
+            item = etree.SubElement(welt, 'item', id=str(i), att='a')
+            sub = etree.SubElement(item, 'sub')
+            kv = etree.SubElement(sub, 'kv', id='k')
+            kv.text = 'value {}'.format(i)
+            etree.SubElement(sub, 'flag').text = '1'
+            if changed and i % 50 == 0:
+                kv.text = 'changed {}'.format(i)
+            if changed and i % 70 == 0:
+                item.set('att', 'b')
+        if changed:
+            etree.SubElement(welt, 'item', id='new')
+    return status
+
+
+def best_of(n, func):
+    best = None
+    for i in range(n):
+        start = time.perf_counter()
+        res = func()
+        taken = time.perf_counter() - start
+        if best is None or taken < best:
+            best = taken
+    return best, res
+
+
+if __name__ == '__main__':
+    nitems = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    left = make_status(nitems)
+    right = make_status(nitems, changed=True)
+    nelts = sum(1 for e in left.iter())
+    print('{} elements in left status'.format(nelts))
+
+    t_xpath, old = best_of(3, lambda: XMLCompare(left, right, indexed=False))
+    t_index, new = best_of(3, lambda: XMLCompare(left, right))
+
+    if old.bystate != new.bystate or old.byxpath != new.byxpath:
+        print('MISMATCH between xpath and indexed engines')
+        sys.exit(1)
+    print('xpath engine:   {:.3f}s'.format(t_xpath))
+    print('indexed engine: {:.3f}s'.format(t_index))
+    print('speedup:        {:.1f}x'.format(t_xpath / t_index))
+
+    # Subtree hashes, as stored in previous-status.xml and
+    # desired-status.xml. Half of the workers differ.
+    mhash(left)
+    mhash(right)
+    t_hashed, hashed = best_of(3, lambda: XMLCompare(left, right, hashed=True))
+    if old.bystate != hashed.bystate or old.byxpath != hashed.byxpath:
+        print('MISMATCH between xpath and hashed engines')
+        sys.exit(1)
+    print('hashed engine:  {:.3f}s'.format(t_hashed))
+
+    # Converged: nothing differs
+    same = copy.deepcopy(left)
+    t_conv, conv = best_of(3, lambda: XMLCompare(left, same, hashed=True))
+    print('hashed engine (converged): {:.6f}s'.format(t_conv))
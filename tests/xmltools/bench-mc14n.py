@@ -0,0 +1,82 @@
+#!/usr/bin/python
+"""Benchmark loading canonical status files.
+
+usage: bench-mc14n.py [number_of_elements]
+
+Writes a synthetic, pretty printed status document (with the odd
+comment) and times loading it as Machination used to (etree.parse()
+followed by a recursive python mc14n) against statusfile.parse().
+"""
+
+import inspect
+import io
+import os
+import sys
+import time
+from lxml import etree
+
+mydir = os.path.dirname(inspect.getfile(inspect.currentframe()))
+os.environ['MACHINATION_BOOTSTRAP_DIR'] = mydir
+from machination import statusfile
+
+
+def make_status(nelts, nworkers=10):
+    status = etree.Element('status')
+    for w in range(nworkers):
+        welt = etree.SubElement(status, 'worker', id='w{}'.format(w))
+        for i in range(nelts // (4 * nworkers)):
+            item = etree.SubElement(welt, 'item', id=str(i))
+            if i % 100 == 0:
+                item.append(etree.Comment('item {}'.format(i)))
+            sect = etree.SubElement(item, 'section', id='s')
+            etree.SubElement(sect, 'kv', id='k').text = 'value {}'.format(i)
+            etree.SubElement(sect, 'kv', id='j').text = 'other {}'.format(i)
+    return etree.tostring(status, pretty_print=True)
+
+
+def old_mc14n(elt):
+    """mc14n() as it was: one python call per node."""
+    if isinstance(elt, etree._ElementTree):
+        elt = elt.getroot()
+    if isinstance(elt, etree._Comment):
+        elt.getparent().remove(elt)
+    elt.tail = None
+    children = 0
+    for e in elt.iterchildren():
+        old_mc14n(e)
+        children = children + 1
+    if children:
+        elt.text = None
+    return elt
+
+
+def best(func, data, repeat=7):
+    taken = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(io.BytesIO(data))
+        t = time.perf_counter() - start
+        if taken is None or t < taken:
+            taken = t
+    return taken
+
+
+if __name__ == '__main__':
+    nelts = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    data = make_status(nelts)
+    print('{} elements, {} bytes'.format(nelts, len(data)))
+
+    old = etree.tostring(old_mc14n(etree.parse(io.BytesIO(data))))
+    new = etree.tostring(statusfile.parse(io.BytesIO(data)).getroot())
+    if old != new:
+        print('MISMATCH')
+        sys.exit(1)
+
+    results = [
+        ('parse+mc14n', best(lambda f: old_mc14n(etree.parse(f)), data)),
+        ('parse only', best(etree.parse, data)),
+        ('statusfile', best(statusfile.parse, data)),
+        ]
+    for name, taken in results:
+        print('{:12} {:8.4f}s'.format(name, taken))
+    print('speedup      {:8.2f}x'.format(results[0][1] / results[2][1]))
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+"""Benchmark resolve() against etree xpath lookups.
+
+usage: bench-resolve.py [number_of_items]
+
+Looks up every item of a synthetic status document (see
+bench-compare.py) by MRXpath using ``elt.xpath()``, an uncached
+resolve() and an MRXIndex, and reports the cost per lookup.
+"""
+
+import inspect
+import os
+import sys
+import time
+from lxml import etree
+
+mydir = os.path.dirname(inspect.getfile(inspect.currentframe()))
+os.environ['MACHINATION_BOOTSTRAP_DIR'] = mydir
+from machination.xmltools import MRXpath
+from machination.xmltools import MRXIndex
+from machination.xmltools import resolve
+
+
+def make_status(nitems, nworkers=10):
+    status = etree.Element('status')
+    for w in range(nworkers):
+        welt = etree.SubElement(status, 'worker', id='w{}'.format(w))
+        for i in range(nitems // nworkers):
+            item = etree.SubElement(welt, 'item', id=str(i))
+            etree.SubElement(item, 'kv', id='k').text = 'value {}'.format(i)
+    return status
+
+
+def per_lookup(func, mrxs, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        for mrx in mrxs:
+            func(mrx)
+        taken = time.perf_counter() - start
+        if best is None or taken < best:
+            best = taken
+    return best / len(mrxs)
+
+
+if __name__ == '__main__':
+    nitems = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    status = make_status(nitems)
+    mrxs = [MRXpath(kv) for kv in status.iter('kv')]
+    print('{} lookups, {} items per worker'.format(len(mrxs),
+                                                   nitems // 10))
+
+    for mrx in mrxs:
+        if resolve(status, mrx) is not status.xpath(mrx.to_xpath())[0]:
+            print('MISMATCH for {}'.format(mrx))
+            sys.exit(1)
+
+    idx = MRXIndex(status)
+    results = [
+        ('etree xpath', per_lookup(
+                lambda m: status.xpath(m.to_xpath())[0], mrxs)),
+        ('resolve', per_lookup(lambda m: resolve(status, m), mrxs)),
+        ('MRXIndex', per_lookup(lambda m: resolve(idx, m), mrxs)),
+        ]
+    for name, taken in results:
+        print('{:12} {:8.2f}us per lookup'.format(name, taken * 1e6))
@@ -5,6 +5,9 @@ import inspect
 import os
 import pprint
 import copy
+import tempfile
+import pickle
+import io
 from lxml import etree
 from lxml.builder import E
 
@@ -13,10 +16,36 @@ mydir = os.path.dirname(inspect.getfile(inspect.currentframe()))
 os.environ['MACHINATION_BOOTSTRAP_DIR'] = mydir
 from machination import context
 from machination.xmltools import MRXpath
+from machination.xmltools import FrozenMRXpath
 from machination.xmltools import WorkerDescription
 from machination.xmltools import Status
 from machination.xmltools import XMLCompare
 from machination.xmltools import generate_wus
+from machination.xmltools import mc14n
+from machination.xmltools import mhash
+from machination.xmltools import HASH_ATT
+from machination.xmltools import MRXIndex
+from machination.xmltools import resolve
+from machination.xmltools import TreeJournal
+from machination.xmltools import apply_wu
+from machination.xmltools import apply_wus
+from machination import statusfile
+
+
+class CacheDirTestCase(unittest.TestCase):
+    """Points context.cache_dir() at a temporary directory."""
+
+    def setUp(self):
+        self.cachedir = tempfile.TemporaryDirectory()
+        self.oldcache = os.environ.get('MACHINATION_CACHE_DIR')
+        os.environ['MACHINATION_CACHE_DIR'] = self.cachedir.name
+
+    def tearDown(self):
+        if self.oldcache is None:
+            del os.environ['MACHINATION_CACHE_DIR']
+        else:
+            os.environ['MACHINATION_CACHE_DIR'] = self.oldcache
+        self.cachedir.cleanup()
 
 
 class MRXpathTestCase(unittest.TestCase):
@@ -79,10 +108,58 @@ class MRXpathTestCase(unittest.TestCase):
         self.assertEqual(mrx.strip_prefix('/status'), MRXpath('/worker[test]/splat/frog'))
         self.assertEqual(mrx.workername('/status'), 'test')
 
-
-class WDTestCase(unittest.TestCase):
+    def test_parse_forms(self):
+        self.assertEqual(MRXpath("/a/b[@id='x']/@att").rep,
+                         (('',), ('a',), ('b', 'x'), ('@att',)))
+        self.assertEqual(MRXpath('a/b["x"]/c[y.z]').rep,
+                         (('a',), ('b', 'x'), ('c', 'y.z')))
+        self.assertEqual(MRXpath("/a/b['it\\'s']").id(), "it's")
+        self.assertEqual(MRXpath("").rep, ())
+
+    def test_parse_errors(self):
+        for bad in ["/a/@att/b", "/a/b[x", "/a/b['x]", "/a/b[@foo='x']",
+                    "/a//b", "/a/b]"]:
+            self.assertRaises(Exception, MRXpath, bad)
+
+    def test_parse_interned(self):
+        mrx1 = MRXpath("/status/worker[@id='w']/item[1]")
+        mrx2 = MRXpath("/status/worker[@id='w']/item[1]")
+        self.assertIs(mrx1.rep, mrx2.rep)
+        mrx2.id("2")
+        self.assertEqual(mrx1.id(), "1")
+        self.assertEqual(str(mrx2), "/status/worker[@id='w']/item[@id='2']")
+
+    def test_frozen(self):
+        mrx = MRXpath("/a/b[1]/c")
+        fmrx = mrx.freeze()
+        self.assertIsInstance(fmrx, FrozenMRXpath)
+        self.assertEqual(fmrx, mrx)
+        self.assertEqual(mrx, fmrx)
+        self.assertEqual(hash(fmrx), hash(mrx))
+        self.assertEqual(fmrx.to_noid_path(), "/a/b/c")
+        self.assertIn(MRXpath("/a/b['1']/c"), {fmrx: 1})
+        self.assertNotEqual(fmrx, FrozenMRXpath("/a/b[2]/c"))
+        self.assertIs(fmrx.freeze(), fmrx)
+        self.assertIs(fmrx.reroot(), fmrx)
+        self.assertEqual(fmrx.parent(), MRXpath("/a/b[1]"))
+
+    def test_frozen_immutable(self):
+        fmrx = FrozenMRXpath("/a/b[1]/c")
+        self.assertRaises(Exception, fmrx.append, "d")
+        self.assertRaises(Exception, fmrx.id, "2")
+        self.assertRaises(Exception, fmrx.__setitem__, 0, "x")
+        self.assertRaises(Exception, FrozenMRXpath("a/b").reroot)
+        self.assertRaises(AttributeError, setattr, fmrx, "other", 1)
+        mrx = MRXpath(fmrx)
+        mrx.append("d")
+        self.assertEqual(str(fmrx), "/a/b[@id='1']/c")
+        self.assertEqual(str(mrx), "/a/b[@id='1']/c/d")
+
+
+class WDTestCase(CacheDirTestCase):
 
     def setUp(self):
+        CacheDirTestCase.setUp(self)
         self.wdesired = context.desired_status.xpath("worker[@id='test']")[0]
         self.wdesc = WorkerDescription("test")
         self.rng = etree.RelaxNG(self.wdesc.desc)
@@ -95,8 +172,108 @@ class WDTestCase(unittest.TestCase):
         self.assertEqual(self.wdesired.get("id"), "test")
 
 
-class XMLCompareTestCase(unittest.TestCase):
+class WDRegistryTestCase(CacheDirTestCase):
+
+    def setUp(self):
+        CacheDirTestCase.setUp(self)
+        WorkerDescription.clear_registry()
+
+    def tearDown(self):
+        CacheDirTestCase.tearDown(self)
+        WorkerDescription.clear_registry()
+
+    def test_shared(self):
+        wd1 = WorkerDescription('dummyordered', '/status')
+        wd2 = WorkerDescription('dummyordered')
+        self.assertIsNotNone(wd1.desc)
+        self.assertIs(wd1.desc, wd2.desc)
+        self.assertIs(wd1.paths, wd2.paths)
+        WorkerDescription.clear_registry()
+        wd3 = WorkerDescription('dummyordered')
+        self.assertIsNot(wd3.desc, wd1.desc)
+
+    def test_table(self):
+        wd = WorkerDescription('dummyordered', '/status')
+        wx = "/status/worker[@id='dummyordered']"
+        self.assertTrue(wd.is_workunit(wx))
+        self.assertTrue(wd.is_workunit(wx + "/tofile"))
+        self.assertFalse(wd.is_workunit(wx + "/tofile/item[@id='1']"))
+        self.assertEqual(wd.find_workunit(wx + "/tofile/item[@id='1']"),
+                         wx + "/tofile")
+        self.assertTrue(wd.is_ordered("/status/worker/tofile"))
+        self.assertFalse(wd.is_ordered("/status/worker/notordered"))
+        self.assertEqual(wd.get_description(wx + "/sysitem[@id='a']").get(
+                "name"), "sysitem")
+        self.assertEqual(wd.workunits(),
+                         {"/worker/sysitem", "/worker/tofile",
+                          "/worker/notordered"})
+
+    def test_disk_cache(self):
+        wd = WorkerDescription('dummyordered')
+        self.assertTrue(os.path.isfile(wd.cache_file()))
+        paths = wd.paths
+        # a new process: nothing registered, description not parsed
+        WorkerDescription.clear_registry()
+        wd = WorkerDescription('dummyordered')
+        self.assertIsNone(wd.entry['desc'])
+        self.assertEqual(wd.paths, paths)
+        self.assertTrue(wd.is_workunit("/worker/tofile"))
+        # the description is still there when it's asked for
+        self.assertEqual(wd.get_description("/worker/tofile").get("name"),
+                         "tofile")
+
+    def test_disk_cache_stale(self):
+        wd = WorkerDescription('dummyordered')
+        with open(wd.cache_file(), "rb") as f:
+            data = pickle.load(f)
+        data['mtime'] -= 10
+        data['sha1'] = 'different'
+        data['paths'] = {}
+        with open(wd.cache_file(), "wb") as f:
+            pickle.dump(data, f)
+        WorkerDescription.clear_registry()
+        wd = WorkerDescription('dummyordered')
+        self.assertTrue(wd.is_workunit("/worker/tofile"))
+        with open(wd.cache_file(), "rb") as f:
+            self.assertEqual(pickle.load(f)['paths'], wd.paths)
+
+    def test_disk_cache_foreign(self):
+        cfile = WorkerDescription('dummyordered').cache_file()
+        # not a dict, and a global that no longer exists
+        for data in [pickle.dumps(['paths']), b'cos\nno_such_thing\n.']:
+            with open(cfile, "wb") as f:
+                f.write(data)
+            WorkerDescription.clear_registry()
+            wd = WorkerDescription('dummyordered')
+            self.assertTrue(wd.is_workunit("/worker/tofile"))
+            with open(cfile, "rb") as f:
+                self.assertEqual(pickle.load(f)['paths'], wd.paths)
+
+    def test_from_element(self):
+        desc = etree.parse(os.path.join(mydir, "workers", "test",
+                                        "description.xml")).getroot()
+        wd = WorkerDescription(desc)
+        self.assertEqual(wd.workername, "test")
+        self.assertFalse(wd.is_workunit("/worker/iniFile/section"))
+        self.assertTrue(wd.is_workunit("/worker/orderedItems/item"))
+        self.assertTrue(wd.is_ordered("/worker/orderedItems"))
+
+    def test_status_ttl(self):
+        desc = etree.fromstring(
+            '<element name="worker"'
+            ' xmlns="http://relaxng.org/ns/structure/1.0"'
+            ' xmlns:info="https://github.com/machination/ns/info"'
+            ' info:statusTTL="90">'
+            '<attribute name="id"><value>ttl</value></attribute>'
+            '</element>')
+        self.assertEqual(WorkerDescription(desc).status_ttl(), 90)
+        del desc.attrib['{https://github.com/machination/ns/info}statusTTL']
+        self.assertIsNone(WorkerDescription(desc).status_ttl())
+
+
+class XMLCompareTestCase(CacheDirTestCase):
     def setUp(self):
+        CacheDirTestCase.setUp(self)
         self.tinfo = etree.parse(os.path.join(mydir, "worker-testinfo1.xml")).getroot()
         self.start = copy.deepcopy(self.tinfo.xpath("status[@id='start']")[0])
         del self.start.attrib['id']
@@ -125,9 +302,517 @@ class XMLCompareTestCase(unittest.TestCase):
         pprint.pprint(self.xmlc.actions())
 
 
-class StatusTestCase(unittest.TestCase):
+class XMLCompareIndexedTestCase(CacheDirTestCase):
+
+    left = """
+<status>
+  <worker id="w1">
+    <item id="1" att="a">one</item>
+    <item id="2">two</item>
+    <item id="3">three</item>
+    <conf><section id="s1" rem="x"><kv id="k">v</kv></section></conf>
+  </worker>
+  <worker id="w2">
+    <thing>text</thing>
+  </worker>
+</status>
+"""
+    right = """
+<status>
+  <worker id="w1">
+    <item id="2">two</item>
+    <item id="1" att="b">one</item>
+    <item id="4">four</item>
+    <conf><section id="s1" add="y"><kv id="k">changed</kv></section></conf>
+  </worker>
+  <worker id="w2">
+    <thing>other text</thing>
+  </worker>
+  <worker id="w3"/>
+</status>
+"""
+
+    def compare_both(self, left, right):
+        old = XMLCompare(mc14n(etree.fromstring(left)),
+                         mc14n(etree.fromstring(right)),
+                         indexed=False)
+        new = XMLCompare(mc14n(etree.fromstring(left)),
+                         mc14n(etree.fromstring(right)))
+        return old, new
+
+    def test_same_as_xpath_engine(self):
+        old, new = self.compare_both(self.left, self.right)
+        self.assertEqual(old.bystate, new.bystate)
+        self.assertEqual(old.byxpath, new.byxpath)
+
+    def test_same_as_xpath_engine_reversed(self):
+        old, new = self.compare_both(self.right, self.left)
+        self.assertEqual(old.bystate, new.bystate)
+        self.assertEqual(old.byxpath, new.byxpath)
+
+    def test_identical(self):
+        old, new = self.compare_both(self.left, self.left)
+        for state in new.bystate.values():
+            self.assertEqual(state, set())
+        self.assertEqual(new.byxpath, {})
+
+
+class Mc14nTestCase(unittest.TestCase):
+
+    xml = '''<!-- top -->
+<status>
+  <!-- one --><!-- two -->
+  <worker id="w1">
+    <kv id="a"> text stays </kv>
+    <kv id="b"><!-- c -->gone</kv>
+    <kv id="c"><![CDATA[ cdata ]]></kv>
+    <kv id="d">before<?pi x?>after</kv>
+  </worker>
+</status>'''
+
+    def test_canonical(self):
+        elt = mc14n(etree.fromstring(self.xml))
+        self.assertEqual(
+            etree.tostring(elt),
+            b'<status><worker id="w1"><kv id="a"> text stays </kv>'
+            b'<kv id="b"/><kv id="c"> cdata </kv>'
+            b'<kv id="d"><?pi x?></kv></worker></status>'
+            )
+
+    def test_parse_same_as_mc14n(self):
+        tree = statusfile.parse(io.BytesIO(self.xml.encode()))
+        self.assertEqual(etree.tostring(tree.getroot()),
+                         etree.tostring(mc14n(etree.fromstring(self.xml))))
+
+    def test_parse_keeps_cdata_space(self):
+        xml = '<status>\n  <kv> <![CDATA[x]]> </kv>\n</status>'
+        tree = statusfile.parse(io.StringIO(xml))
+        self.assertEqual(etree.tostring(tree.getroot()),
+                         b'<status><kv> x </kv></status>')
+
+    def test_subtree(self):
+        elt = etree.fromstring(self.xml)
+        worker = elt.find('worker')
+        mc14n(worker)
+        self.assertIsNone(worker.tail)
+        self.assertIsNone(worker.text)
+        # outside the subtree is left alone
+        self.assertIsNotNone(elt.text)
+
+
+class StatusFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.dir.name, 'previous-status.xml')
+        self.status = mc14n(etree.fromstring(
+                '<status><worker id="w1"><kv id="a">x</kv></worker></status>'
+                ))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_write_load(self):
+        statusfile.write(self.status, self.fname)
+        self.assertEqual(os.listdir(self.dir.name), ['previous-status.xml'])
+        self.assertEqual(etree.tostring(statusfile.load(self.fname).getroot()),
+                         etree.tostring(self.status))
+
+    def test_hand_edited(self):
+        statusfile.write(self.status, self.fname)
+        with open(self.fname, 'w') as f:
+            f.write('<status>\n  <worker id="w2"/>\n</status>\n')
+        self.assertEqual(etree.tostring(statusfile.load(self.fname).getroot()),
+                         b'<status><worker id="w2"/></status>')
+
+
+class StatusStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.dir.name, 'previous-status.xml')
+        self.store = statusfile.StatusStore(self.fname, generations=2)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def status(self, n):
+        return E.status(E.worker(id='w{}'.format(n)))
+
+    def loaded(self):
+        return self.store.load().getroot()[0].get('id')
+
+    def generation(self, n):
+        fname = self.store.generation_name(n)
+        return statusfile.parse(fname).getroot()[0].get('id')
+
+    def test_rotate(self):
+        for n in range(4):
+            self.store.write(self.status(n))
+        self.assertEqual(sorted(os.listdir(self.dir.name)),
+                         ['previous-status.xml',
+                          'previous-status.xml.1',
+                          'previous-status.xml.2'])
+        self.assertEqual(self.loaded(), 'w3')
+        self.assertEqual(self.generation(2), 'w1')
+
+    def test_fname_always_there(self):
+        # Readers opening fname directly never find it missing.
+        seen = []
+        rotate = self.store.rotate
+
+        def check():
+            rotate()
+            seen.append(statusfile.parse(self.fname).getroot()[0].get('id'))
+        self.store.write(self.status(0))
+        self.store.rotate = check
+        for n in (1, 2):
+            self.store.write(self.status(n))
+        self.assertEqual(seen, ['w0', 'w1'])
+        self.assertEqual(self.generation(1), 'w1')
+        self.assertEqual(self.generation(2), 'w0')
+
+    def test_one_generation(self):
+        store = statusfile.StatusStore(self.fname, generations=1)
+        for n in range(3):
+            store.write(self.status(n))
+        self.assertEqual(sorted(os.listdir(self.dir.name)),
+                         ['previous-status.xml', 'previous-status.xml.1'])
+        self.assertEqual(self.generation(1), 'w1')
+
+    def test_fall_back(self):
+        self.store.write(self.status(0))
+        self.store.write(self.status(1))
+        # Truncated by something other than us.
+        with open(self.fname, 'w') as f:
+            f.write('<status><wor')
+        self.assertEqual(self.loaded(), 'w0')
+        self.assertEqual(self.store.loaded_generation, 1)
+        # Removed by something other than us.
+        os.remove(self.fname)
+        self.assertEqual(self.loaded(), 'w0')
+
+    def test_nothing_to_load(self):
+        self.assertRaises(FileNotFoundError, self.store.load)
+        with open(self.fname, 'w') as f:
+            f.write('<status><wor')
+        self.assertRaises(etree.XMLSyntaxError, self.store.load)
+
+    def test_no_temp_files(self):
+        self.store.write(self.status(0))
+        self.assertEqual(os.listdir(self.dir.name), ['previous-status.xml'])
+        self.assertEqual(os.stat(self.fname).st_mode & 0o777, 0o644)
+
+
+class MhashTestCase(unittest.TestCase):
+
+    left = XMLCompareIndexedTestCase.left
+    right = XMLCompareIndexedTestCase.right
+
+    def hashed(self, xml):
+        elt = mc14n(etree.fromstring(xml))
+        mhash(elt)
+        return elt
+
+    def test_hash_changes_with_descendants(self):
+        elt = self.hashed(self.left)
+        before = elt.get(HASH_ATT)
+        kv = elt.xpath('/status/worker[@id="w1"]/conf/section/kv')[0]
+        kv.text = 'different'
+        self.assertNotEqual(mhash(elt), before)
+
+    def test_trust_stored(self):
+        elt = self.hashed(self.left)
+        before = elt.get(HASH_ATT)
+        # change a descendant without rehashing it: a trusting rehash
+        # of the root can't see the change
+        elt.xpath('/status/worker[@id="w2"]/thing')[0].text = 'x'
+        self.assertEqual(mhash(elt, trust_stored=True), before)
+        self.assertNotEqual(mhash(elt), before)
+
+    def test_hashes_not_compared(self):
+        hashed = self.hashed(self.left)
+        plain = mc14n(etree.fromstring(self.left))
+        comp = XMLCompare(hashed, plain)
+        self.assertEqual(comp.byxpath, {})
+
+    def test_hashed_compare_same_results(self):
+        right = self.right.replace('other text', 'text')
+        full = XMLCompare(self.hashed(self.left), self.hashed(right))
+        pruned = XMLCompare(self.hashed(self.left), self.hashed(right),
+                            hashed=True)
+        self.assertEqual(full.bystate, pruned.bystate)
+        self.assertEqual(full.byxpath, pruned.byxpath)
+        # w2 is the same on both sides, so nothing under it is looked at
+        self.assertLess(len(pruned.universalset), len(full.universalset))
+
+    def test_hashed_compare_identical(self):
+        comp = XMLCompare(self.hashed(self.left), self.hashed(self.left),
+                          hashed=True)
+        self.assertEqual(comp.byxpath, {})
+        self.assertEqual(comp.universalset, {'/status'})
+
+
+class ResolveTestCase(CacheDirTestCase):
+
+    doc = """
+<status>
+  <worker id="w1">
+    <item id="1" att="a">one</item>
+    <item id="it's">two</item>
+    <conf><section id="s1"><kv id="k">v</kv></section></conf>
+  </worker>
+  <worker id="w2"><thing>text</thing></worker>
+</status>
+"""
+    paths = ["/status",
+             "/status/worker[@id='w1']",
+             "/status/worker[@id='w1']/item[@id='1']",
+             "/status/worker[@id='w1']/item[@id='1']/@att",
+             "/status/worker[@id='w1']/conf/section[@id='s1']/kv[@id='k']",
+             "/status/worker[@id='w2']/thing",
+             "/status/worker",
+             "/status/worker[@id='w3']",
+             "/status/worker[@id='w1']/item[@id='1']/@nope",
+             "/other/worker[@id='w1']"]
+
+    def setUp(self):
+        CacheDirTestCase.setUp(self)
+        self.status = etree.fromstring(self.doc)
+
+    def xpath_first(self, root, path):
+        res = root.xpath(MRXpath(path).to_xpath())
+        if res:
+            return res[0]
+        return None
+
+    def test_same_as_xpath(self):
+        idx = MRXIndex(self.status)
+        inner = self.status[0][2]
+        for path in self.paths:
+            expected = self.xpath_first(self.status, path)
+            self.assertEqual(resolve(self.status, path), expected, path)
+            self.assertEqual(resolve(idx, path), expected, path)
+            # rooted paths start from the document element
+            self.assertEqual(resolve(inner, path), expected, path)
+
+    def test_relative(self):
+        welt = self.status[0]
+        self.assertIs(resolve(welt, "conf/section[s1]/kv[k]"),
+                      welt[2][0][0])
+        self.assertEqual(resolve(welt, "item[1]/@att"), "a")
+        self.assertIsNone(resolve(welt, "item[2]"))
+        # XPath 1.0 can't express this one at all
+        self.assertIs(resolve(welt, "item['it\\'s']"), welt[1])
+
+    def test_elementtree(self):
+        self.assertIs(resolve(etree.ElementTree(self.status), "/status"),
+                      self.status)
+        self.assertIsNone(resolve(etree.ElementTree(), "/status"))
+
+    def test_index_follows_changes(self):
+        idx = MRXIndex(self.status)
+        welt = resolve(idx, "/status/worker[w1]")
+        item1 = resolve(idx, "/status/worker[w1]/item[1]")
+        welt.remove(item1)
+        self.assertIsNone(resolve(idx, "/status/worker[w1]/item[1]"))
+        new = etree.SubElement(welt, "item", id="1")
+        self.assertIs(resolve(idx, "/status/worker[w1]/item[1]"), new)
+        new.set("id", "3")
+        self.assertIsNone(resolve(idx, "/status/worker[w1]/item[1]"))
+        self.assertIs(resolve(idx, "/status/worker[w1]/item[3]"), new)
+
+    def test_index_follows_reorder(self):
+        doc = etree.fromstring("<status><a><b>1</b><b>2</b></a></status>")
+        idx = MRXIndex(doc)
+        self.assertEqual(resolve(idx, "/status/a/b").text, "1")
+        a = doc[0]
+        a.insert(0, a[1])
+        self.assertEqual(resolve(idx, "/status/a/b").text, "2")
+        a.insert(0, etree.Element("b"))
+        self.assertIs(resolve(idx, "/status/a/b"), a[0])
+
+
+class TreeJournalTestCase(unittest.TestCase):
+
+    doc = """<w><a id="1" x="1">one</a><b id="2"><c/></b><d id="3"/></w>"""
+
+    def setUp(self):
+        self.doc = etree.fromstring(self.doc)
+        self.j = TreeJournal()
+
+    def change_everything(self):
+        a, b, d = self.doc
+        self.j.set(a, "x", "2")
+        self.j.set(a, "y", "new")
+        self.j.delete(b, "id")
+        self.j.set_text(a, "changed")
+        self.j.remove(d)
+        self.j.insert(b, 0, a)
+        self.j.insert(self.doc, 0, etree.Element("e"))
+        # move within the same parent
+        self.j.insert(b, 0, b[1])
+
+    def test_rollback_all(self):
+        self.change_everything()
+        self.assertNotEqual(etree.tostring(self.doc), self.__class__.doc.encode())
+        self.j.rollback()
+        self.assertEqual(etree.tostring(self.doc), self.__class__.doc.encode())
+        self.assertEqual(self.j.entries, [])
+
+    def test_rollback_to_mark(self):
+        a = self.doc[0]
+        self.j.set_text(a, "kept")
+        mark = self.j.mark()
+        self.change_everything()
+        self.j.rollback(mark)
+        self.assertEqual(
+            etree.tostring(self.doc),
+            self.__class__.doc.replace("one", "kept").encode())
+
+
+class ApplyWusTestCase(CacheDirTestCase):
+
+    doc = """<status><worker id="w"><item id="1">one</item><item id="2">two</item></worker></status>"""
+
+    def setUp(self):
+        CacheDirTestCase.setUp(self)
+        self.status = etree.fromstring(self.doc)
+        self.wus = [
+            etree.fromstring(
+                """<wu op="add" id="/status/worker[@id='w']/item[@id='3']" pos="item[@id='1']"><item id="3">three</item></wu>"""),
+            etree.fromstring(
+                """<wu op="datamod" id="/status/worker[@id='w']/item[@id='2']"><item id="2">TWO</item></wu>"""),
+            etree.fromstring(
+                """<wu op="move" id="/status/worker[@id='w']/item[@id='2']" pos="&lt;first&gt;"/>"""),
+            etree.fromstring(
+                """<wu op="remove" id="/status/worker[@id='w']/item[@id='1']"/>"""),
+            ]
+        self.expected = b'<status><worker id="w"><item id="2">TWO</item><item id="3">three</item></worker></status>'
+
+    def test_in_place(self):
+        worker = self.status[0]
+        self.assertIs(apply_wus(self.wus, self.status), self.status)
+        self.assertEqual(etree.tostring(self.status), self.expected)
+        self.assertIs(self.status[0], worker)
+
+    def test_same_as_apply_wu(self):
+        st = self.status
+        for wu in self.wus:
+            st = apply_wu(wu, st)
+        self.assertEqual(etree.tostring(st), self.expected)
+        # apply_wu leaves its argument alone
+        self.assertEqual(etree.tostring(self.status), self.doc.encode())
+
+    def test_prefix(self):
+        worker = self.status[0]
+        apply_wus(self.wus, worker, prefix="/status")
+        self.assertEqual(etree.tostring(self.status), self.expected)
+        wu = etree.fromstring(
+            """<wu op="remove" id="/status/worker[@id='other']/item[@id='2']"/>""")
+        self.assertRaises(IndexError, apply_wus, [wu], worker, "/status")
+
+    def test_add_map(self):
+        # add 5 after 4, which was never added: 4 was meant to go after 1
+        wu = etree.fromstring(
+            """<wu op="add" id="/status/worker[@id='w']/item[@id='5']" pos="item[@id='4']"><item id="5"/></wu>""")
+        self.assertRaises(IndexError, apply_wus, [wu], self.status)
+        add_map = {"/status/worker[@id='w']/item[@id='4']":
+                       "/status/worker[@id='w']/item[@id='1']"}
+        apply_wus([wu], self.status, add_map=add_map)
+        self.assertEqual([e.get('id') for e in self.status[0]],
+                         ['1', '5', '2'])
+
+
+class GenerateWusTestCase(CacheDirTestCase):
+
+    start = """
+<status>
+  <worker id="dummyordered">
+    <sysitem id="1">one</sysitem>
+    <sysitem id="2">two</sysitem>
+    <sysitem id="3">three</sysitem>
+    <tofile><directive>d</directive><item id="a">A</item><item id="b">B</item></tofile>
+    <notordered id="x">x</notordered>
+    <notordered id="y">y</notordered>
+  </worker>
+</status>
+"""
+    desired = """
+<status>
+  <worker id="dummyordered">
+    <sysitem id="2">two</sysitem>
+    <sysitem id="1">ONE</sysitem>
+    <sysitem id="4">four</sysitem>
+    <tofile><directive>d</directive><item id="b">B</item><item id="a">A2</item></tofile>
+    <notordered id="x">X</notordered>
+    <notordered id="y">y</notordered>
+    <other>new</other>
+  </worker>
+</status>
+"""
+    worker = "/status/worker[@id='dummyordered']"
+
+    def setUp(self):
+        CacheDirTestCase.setUp(self)
+        self.comp = XMLCompare(mc14n(etree.fromstring(self.start)),
+                               mc14n(etree.fromstring(self.desired)))
+
+    def test_leaves_comp(self):
+        comp = self.comp
+        before = [etree.tostring(comp.leftxml),
+                  etree.tostring(comp.rightxml)]
+        deepmods = comp.find_work() & comp.actions()['deepmod']
+        todos = [{x} for x in sorted(deepmods)]
+        todos.append(comp.find_work() - deepmods)
+        for todo in todos:
+            wus, working = generate_wus(todo, comp)
+            self.assertEqual([etree.tostring(comp.leftxml),
+                              etree.tostring(comp.rightxml)], before)
+            wus2, working2 = generate_wus(todo, comp, keep_working=False)
+            self.assertIsNone(working2)
+            self.assertEqual([etree.tostring(wu) for wu in wus2],
+                             [etree.tostring(wu) for wu in wus])
+
+    def test_parent_deepmod(self):
+        # A deepmod of the worker element shouldn't take the work units
+        # it contains out of working: they have work of their own.
+        wus, working = generate_wus(self.comp.find_work(), self.comp)
+        byid = {wu.get('id'): wu for wu in wus}
+        self.assertEqual([e.tag for e in byid[self.worker][0]], ['other'])
+        items = self.worker + "/sysitem"
+        self.assertEqual([e.get('id') for e in working.xpath(items)],
+                         ['2', '1', '4'])
+
+    def test_apply_wus(self):
+        wus, working = generate_wus(self.comp.find_work(), self.comp)
+        st = apply_wus(wus, copy.deepcopy(self.comp.leftxml))
+        # the worker deepmod must put back the items it stripped
+        self.assertEqual(etree.tostring(st), etree.tostring(working))
+        self.assertEqual(etree.tostring(st),
+                         etree.tostring(self.comp.rightxml))
+
+    def test_remove_worker(self):
+        # The worker and the work units inside it are all removed:
+        # each remove carries its element, whichever comes first.
+        comp = XMLCompare(mc14n(etree.fromstring(self.start)),
+                          mc14n(etree.fromstring('<status/>')))
+        before = etree.tostring(comp.leftxml)
+        wus, working = generate_wus(comp.find_work(), comp)
+        byid = {wu.get('id'): wu for wu in wus}
+        self.assertEqual(byid[self.worker][0].tag, 'worker')
+        self.assertEqual(len(byid[self.worker][0]), 6)
+        self.assertEqual(byid[self.worker + "/tofile"][0].tag, 'tofile')
+        self.assertEqual(
+            byid[self.worker + "/sysitem[@id='2']"][0].text, 'two')
+        self.assertEqual(len(working), 0)
+        self.assertEqual(etree.tostring(comp.leftxml), before)
+
+
+class StatusTestCase(CacheDirTestCase):
 
     def setUp(self):
+        CacheDirTestCase.setUp(self)
         self.tinfo = etree.parse(os.path.join(mydir, "worker-testinfo1.xml")).getroot()
         self.start = copy.deepcopy(self.tinfo.xpath("status[@id='start']")[0])
         del self.start.attrib['id']
@@ -162,9 +847,10 @@ class StatusTestCase(unittest.TestCase):
         print(w.index(res))
 
 
-class Testinfo1Case(unittest.TestCase):
+class Testinfo1Case(CacheDirTestCase):
 
     def setUp(self):
+        CacheDirTestCase.setUp(self)
         self.wdesc = WorkerDescription('test')
         self.rng = etree.RelaxNG(self.wdesc.desc)
         self.tinfo = etree.parse(os.path.join(mydir, "worker-testinfo1.xml")).getroot()